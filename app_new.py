@@ -4,6 +4,7 @@
 from settings import *
 
 import datetime
+import json
 import logging
 import os
 import secrets
@@ -14,7 +15,7 @@ from google_auth_oauthlib.flow import Flow
 from flask import Flask, request, abort, jsonify, redirect, url_for, session, render_template, send_from_directory
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from linebot.v3 import WebhookHandler
+from linebot.v3 import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import (
     MessageEvent,
@@ -40,7 +41,6 @@ from linebot.v3.messaging import (
 )
 
 import pymysql
-from celery import group, chord, chain
 from dbutils.pooled_db import PooledDB
 
 # 載入 Celery worker_app
@@ -49,15 +49,36 @@ from worker_app import (
     upload_file_to_drive_task,
     get_source_name,
     check_google_status,
-    download_line_file_task,
-    handle_upload_task,
+    start_media_workflow,
+    dispatch_media_workflows_task,
     showlog_task,
+    search_log_task,
+    search_upload_logs,
+    load_search_token,
+    drive_file_link,
+    SEARCH_KEYWORD_MIN_LENGTH,
     handle_list_group_task,
     handle_show_complete_group_task,
     handle_update_folder_task,
     retry_failed_uploads_task,
-    list_failed_uploads_task
+    list_failed_uploads_task,
+    set_spool_refs,
+    deadline_priority,
+    close_auth_breaker,
+    cache_add_group_user,
+    cache_remove_group_user,
+    cache_set_group_users,
+    bump_folder_map_version,
+    get_drive_free_bytes,
+    rebuild_upload_stats,
+    get_cached_report,
+    invalidate_report_cache,
+    get_upload_size_class,
+    record_drive_quota_skip_task,
+    METRICS_KEY,
+    DEAD_LETTER_KEY
 )
+from spool import get_spool_backend
 from redis import Redis
 from datetime import timedelta
 
@@ -73,7 +94,7 @@ app.logger.setLevel(logging.INFO)
 
 app.secret_key = FLASK_SECRET_KEY
 
-handler = WebhookHandler(CHANNEL_SECRET)
+parser = WebhookParser(CHANNEL_SECRET)
 configuration = Configuration(
     access_token=CHANNEL_ACCESS_TOKEN,
 )
@@ -96,7 +117,7 @@ db_pool = PooledDB(
 )
 
 # 初始化 Redis 連線
-redis_client = Redis(host='localhost', port=6379, db=1, decode_responses=True)
+redis_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
 
 def get_db_connection():
     """從連線池取得資料庫連線"""
@@ -148,6 +169,19 @@ def init_db():
                 )
             ''')
             
+            # 建立 folder_month_map 表格（DRIVE_FOLDER_LAYOUT = 'monthly' 時，來源資料夾下每個月的 YYYY/MM 子資料夾）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS folder_month_map (
+                    source_id VARCHAR(255),
+                    user_id VARCHAR(255),
+                    month CHAR(7),
+                    parent_folder_id VARCHAR(255) NOT NULL,
+                    folder_id VARCHAR(255) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source_id, user_id, month)
+                )
+            ''')
+
             # 建立 group_info 表格（記錄群組資訊）
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS group_info (
@@ -183,7 +217,44 @@ def init_db():
                 source_type VARCHAR(50),
                 source_id VARCHAR(255),
                 source_name VARCHAR(255),
-                status VARCHAR(255)
+                status VARCHAR(255),
+                drive_file_id VARCHAR(255) NULL,
+                FULLTEXT INDEX ft_upload_logs_names (file_name, source_name) WITH PARSER ngram
+                )
+            ''')
+
+            # 舊版 upload_logs 補上 drive_file_id 欄位與 !searchlog 使用的全文索引
+            cursor.execute("SHOW COLUMNS FROM upload_logs LIKE 'drive_file_id'")
+            if cursor.fetchone() is None:
+                cursor.execute("ALTER TABLE upload_logs ADD COLUMN drive_file_id VARCHAR(255) NULL")
+            cursor.execute("SHOW INDEX FROM upload_logs WHERE Key_name = 'ft_upload_logs_names'")
+            if cursor.fetchone() is None:
+                cursor.execute('''
+                    ALTER TABLE upload_logs
+                    ADD FULLTEXT INDEX ft_upload_logs_names (file_name, source_name) WITH PARSER ngram
+                ''')
+
+            # 建立 drive_change_cursors 表格（每位使用者 Drive Changes API 的讀取位置）
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS drive_change_cursors (
+                user_id VARCHAR(255) PRIMARY KEY,
+                page_token VARCHAR(255) NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    ON UPDATE CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # 建立 upload_stats_daily 表格（每位使用者每日依來源類型與結果彙總的上傳筆數）
+            cursor.execute("SHOW TABLES LIKE 'upload_stats_daily'")
+            stats_table_exists = cursor.fetchone() is not None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS upload_stats_daily (
+                user_id VARCHAR(255),
+                day DATE,
+                source_type VARCHAR(50),
+                outcome VARCHAR(50),
+                count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day, source_type, outcome)
                 )
             ''')
             
@@ -191,6 +262,10 @@ def init_db():
     finally:
         conn.close()
 
+    if not stats_table_exists:
+        # 第一次建立統計表時，由既有的上傳日誌補上統計
+        rebuild_upload_stats()
+
 def reply_loading_animation(chat_id, seconds=5):
     with ApiClient(configuration) as api_client:
         line_bot_api = MessagingApi(api_client)
@@ -223,13 +298,140 @@ def reply_message(reply_token, messages):
             )
         )
 
+def get_reply_deadline(event):
+    """由事件時間推算 reply token 的到期時間（epoch 秒）"""
+    return event.timestamp / 1000 + REPLY_TOKEN_TTL
+
+def enqueue_reply_task(task, event, *args):
+    """排程需要 reply token 的任務，越接近期限的任務優先權越高
+
+    參數:
+        task: Celery 任務，簽章為 (reply_token, user_id, *args, reply_deadline=None)
+        event: LINE 訊息事件
+        *args: 其他任務參數
+    """
+    reply_deadline = get_reply_deadline(event)
+    return task.apply_async(
+        (event.reply_token, event.source.user_id) + args,
+        kwargs={'reply_deadline': reply_deadline},
+        priority=deadline_priority(reply_deadline)
+    )
+
+def webhook_event_key(event):
+    """取得事件的去重鍵：優先使用 webhookEventId，舊版事件則使用訊息 ID"""
+    event_id = getattr(event, 'webhook_event_id', None)
+    if not event_id:
+        message = getattr(event, 'message', None)
+        event_id = getattr(message, 'id', None)
+    return f"webhook_event:{event_id}" if event_id else None
+
+def claim_webhook_events(events):
+    """整批事件的去重：以一次 pipeline 對每個事件 ID 做 SET NX
+
+    第一次收到的事件才會處理，LINE 重送（redelivery）的重複事件直接略過，
+    不會重複排程下載與上傳任務。Redis 無法使用時寧可重複處理，也不要遺失事件。
+
+    參數:
+        events (list): WebhookParser 解析出的事件
+
+    回傳:
+        list: 需要處理的 (event, 去重鍵) 列表，保持原本順序
+    """
+    keys = [webhook_event_key(event) for event in events]
+    first_seen = {}
+    if any(keys):
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                if key:
+                    pipe.set(key, 1, nx=True, ex=WEBHOOK_EVENT_TTL)
+            first_seen = dict(zip([key for key in keys if key], pipe.execute()))
+        except Exception as e:
+            app.logger.warning("[LINE] Idempotency check failed for %d events: %s", len(events), str(e))
+
+    claimed = []
+    duplicates = 0
+    for event, key in zip(events, keys):
+        delivery_context = getattr(event, 'delivery_context', None)
+        is_redelivery = bool(getattr(delivery_context, 'is_redelivery', False))
+        if key and not first_seen.get(key, True):
+            app.logger.info("[LINE] Dropped duplicate event %s (redelivery=%s)", key, is_redelivery)
+            duplicates += 1
+            continue
+        if is_redelivery:
+            app.logger.info("[LINE] Processing redelivered event %s", key)
+        claimed.append((event, key))
+    if duplicates:
+        redis_client.hincrby(METRICS_KEY, 'webhook_duplicate_events', duplicates)
+    return claimed
+
+def release_webhook_events(keys):
+    """處理失敗時移除去重記錄，讓重送的事件可以再處理一次"""
+    keys = [key for key in keys if key]
+    if keys:
+        redis_client.delete(*keys)
+
+def dispatch_webhook_events(events):
+    """依事件類型分組，整批處理同一個 webhook 請求中的所有事件
+
+    - 文字指令逐一處理（各自回覆）
+    - 圖片、影片、音訊與檔案訊息整批送出：多個事件只送出一則 Celery 訊息，由 worker 展開成各自的 chain
+    - 加入 / 離開群組共用一個資料庫連線
+
+    參數:
+        events (list): WebhookParser 解析出的事件
+    """
+    media_entries, media_keys = [], []
+    membership = []
+    failed_keys = []
+
+    for event, key in claim_webhook_events(events):
+        try:
+            if isinstance(event, MessageEvent):
+                if isinstance(event.message, TextMessageContent):
+                    handle_text_command_message(event)
+                elif isinstance(event.message, (ImageMessageContent, VideoMessageContent, AudioMessageContent)):
+                    entry = build_content_workflow(event)
+                    if entry:
+                        media_entries.append(entry)
+                        media_keys.append(key)
+                elif isinstance(event.message, FileMessageContent):
+                    entry = build_file_workflow(event)
+                    if entry:
+                        media_entries.append(entry)
+                        media_keys.append(key)
+            elif isinstance(event, (JoinEvent, LeaveEvent)):
+                membership.append(event)
+        except Exception as e:
+            app.logger.error("[LINE] Failed to handle event %s: %s", key, str(e))
+            failed_keys.append(key)
+
+    if membership:
+        handle_membership_events(membership)
+
+    if media_entries:
+        try:
+            if len(media_entries) == 1:
+                start_media_workflow(media_entries[0])
+            else:
+                dispatch_media_workflows_task.delay(media_entries)
+                app.logger.info("[LINE] Dispatched %d media events in one batch", len(media_entries))
+        except Exception as e:
+            app.logger.error("[LINE] Failed to dispatch %d media events: %s", len(media_entries), str(e))
+            failed_keys += media_keys
+
+    if failed_keys:
+        release_webhook_events(failed_keys)
+        raise RuntimeError(f"{len(failed_keys)} webhook events failed")
+
 @app.route("/linebot/callback_LineBot", methods=['POST'])
 def callback():
     try:
         signature = request.headers['X-Line-Signature']
         body = request.get_data(as_text=True)
         app.logger.info("[LINE] Received webhook request: %s", body)
-        handler.handle(body, signature)
+        events = parser.parse(body, signature)
+        dispatch_webhook_events(events)
     except InvalidSignatureError:
         app.logger.error("[LINE] Invalid signature detected")
         abort(400)
@@ -386,6 +588,7 @@ def handle_group_command(event, is_bind=True):
                         (line_group_id, line_user_id)
                     )
                     conn.commit()
+                    cache_add_group_user(line_group_id, line_user_id)
                     return "已將您與群組綁定成功！\n未來該群組收到的檔案都會同步上傳到您的 Google Drive。"
                 except pymysql.err.IntegrityError:
                     return "您已經與此群組綁定過了。"
@@ -401,6 +604,7 @@ def handle_group_command(event, is_bind=True):
                         (line_group_id, line_user_id)
                     )
                     conn.commit()
+                    cache_remove_group_user(line_group_id, line_user_id)
                     return "已解除綁定此群組。"
                 else:
                     return "您尚未綁定此群組。"
@@ -412,12 +616,13 @@ def handle_unbind_all_group(event):
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            # 先檢查使用者綁定的群組數量
+            # 先查詢使用者綁定的群組
             cursor.execute(
-                'SELECT COUNT(*) FROM group_users WHERE user_id = %s',
+                'SELECT group_id FROM group_users WHERE user_id = %s',
                 (event.source.user_id,)
             )
-            group_count = cursor.fetchone()[0]
+            group_ids = [row[0] for row in cursor.fetchall()]
+            group_count = len(group_ids)
             
             if group_count == 0:
                 reply_text = "您目前沒有綁定任何群組。"
@@ -428,6 +633,8 @@ def handle_unbind_all_group(event):
                     (event.source.user_id,)
                 )
                 conn.commit()
+                for group_id in group_ids:
+                    cache_remove_group_user(group_id, event.source.user_id)
                 reply_text = f"已成功解除綁定所有群組（共 {group_count} 個）。"
                 app.logger.info(
                     "[UNBIND_ALL] User %s unbound from %d groups",
@@ -537,7 +744,7 @@ def handle_check_google(event):
     app.logger.info("[test] check google")
     line_user_id = event.source.user_id
     reply_loading_animation(line_user_id, 10)
-    check_google_status.delay(event.reply_token, line_user_id)
+    enqueue_reply_task(check_google_status, event)
     return None
 
 def handle_switch_debug(event):
@@ -578,7 +785,7 @@ def handle_show_log(event):
     app.logger.info("[test] show log")
     line_user_id = event.source.user_id
     reply_loading_animation(line_user_id, 20)
-    showlog_task.delay(event.reply_token, line_user_id)
+    enqueue_reply_task(showlog_task, event)
     return None
 
 def handle_group_action(event):
@@ -612,27 +819,45 @@ def handle_group_action(event):
 def handle_list_group(event):
     app.logger.info("[test] list group")
     line_user_id = event.source.user_id
+    cached = get_cached_report(line_user_id, 'listgroup')
+    if cached:
+        # 快取命中時直接回覆，不經過 worker 與資料庫
+        reply_message(event.reply_token, cached)
+        return None
     reply_loading_animation(line_user_id, 10)
-    handle_list_group_task.delay(event.reply_token, line_user_id)
+    enqueue_reply_task(handle_list_group_task, event)
 
     return None
 
 def handle_show_complete_group(event):
     app.logger.info("[test] show complete group")
     line_user_id = event.source.user_id
+    cached = get_cached_report(line_user_id, 'showcompletegroup')
+    if cached:
+        reply_message(event.reply_token, cached)
+        return None
     reply_loading_animation(line_user_id, 10)
-    handle_show_complete_group_task.delay(event.reply_token, line_user_id)
+    enqueue_reply_task(handle_show_complete_group_task, event)
     return None
 
 def handle_test_upload(event):
     app.logger.info("[test] test upload")
     line_user_id = event.source.user_id
-    dist_path = "static/testimage.jpg"
     dist_name = "testimage.jpg"
     source_type = "user"
     source_id = line_user_id
-    
-    upload_file_to_drive_task.delay(dist_path, dist_name, source_type, source_id, source_id, event.reply_token)
+
+    # 將測試圖片放入暫存區，上傳完成後再刪除
+    spool_key = f"testimage-{secrets.token_hex(8)}.jpg"
+    get_spool_backend().put_file(os.path.join(BASE_DIR, 'static', 'testimage.jpg'), spool_key, move=False)
+
+    reply_deadline = get_reply_deadline(event)
+    set_spool_refs(spool_key, 1)
+    upload_file_to_drive_task.apply_async(
+        (spool_key, dist_name, source_type, source_id, source_id, event.reply_token),
+        kwargs={'reply_deadline': reply_deadline},
+        priority=deadline_priority(reply_deadline)
+    )
     reply_loading_animation(line_user_id, 15)
     return None
 
@@ -640,7 +865,18 @@ def handle_update_folder(event):
     app.logger.info("[test] update folder")
     line_user_id = event.source.user_id
     reply_loading_animation(line_user_id, 15)
-    handle_update_folder_task.delay(event.reply_token, line_user_id)
+    enqueue_reply_task(handle_update_folder_task, event)
+    return None
+
+def handle_search_log(event):
+    """處理 !searchlog <關鍵字> 指令：以檔名或來源名稱搜尋上傳紀錄"""
+    app.logger.info("[test] search log")
+    keyword = event.message.text.strip()[len("!searchlog"):].strip()
+    if len(keyword) < SEARCH_KEYWORD_MIN_LENGTH:
+        return f"請輸入至少 {SEARCH_KEYWORD_MIN_LENGTH} 個字的關鍵字，例如：!searchlog 報告.pdf"
+
+    reply_loading_animation(event.source.user_id, 10)
+    enqueue_reply_task(search_log_task, event, keyword)
     return None
 
 def handle_list_failed_uploads(event):
@@ -661,7 +897,7 @@ def handle_list_failed_uploads(event):
     
     # 啟動查詢任務
     reply_loading_animation(line_user_id, 10)
-    list_failed_uploads_task.delay(event.reply_token, line_user_id, hours)
+    enqueue_reply_task(list_failed_uploads_task, event, hours)
     return None
 
 def handle_retry_upload(event):
@@ -682,7 +918,7 @@ def handle_retry_upload(event):
     
     # 啟動補上傳任務
     reply_loading_animation(line_user_id, 20)
-    retry_failed_uploads_task.delay(event.reply_token, line_user_id, hours)
+    enqueue_reply_task(retry_failed_uploads_task, event, hours)
     return None
 
 def handle_help(event):
@@ -715,6 +951,8 @@ def handle_help(event):
             "4️⃣ 其他指令\n"
             "!listgroup - 查看已綁定的群組\n"
             "!updatefolder - 更新資料夾名稱與群組同步\n"
+            "!showlog - 顯示上傳紀錄\n"
+            f"!searchlog <關鍵字> - 依檔名或群組名稱搜尋近 {UPLOAD_LOG_RETENTION_DAYS} 天的上傳紀錄\n"
             "!listfailed [小時數] - 顯示失敗上傳記錄（預設24小時內）\n"
             "!retryupload [小時數] - 重試失敗的檔案上傳（預設24小時內）\n"
             "!help - 顯示此說明"
@@ -742,6 +980,7 @@ def handle_bind_group(event):
                             (line_group_id, line_user_id)
                         )
                         conn.commit()
+                        cache_add_group_user(line_group_id, line_user_id)
                         reply_text = (
                             "已將您與此群組綁定！\n"
                             "未來此群組的檔案都會同步上傳到您的 Google Drive。"
@@ -789,6 +1028,7 @@ def handle_unbind_group(event):
                         (line_group_id, line_user_id)
                     )
                     conn.commit()
+                    cache_remove_group_user(line_group_id, line_user_id)
                     reply_text = "已解除綁定此群組。"
                 else:
                     reply_text = "您尚未綁定此群組。"
@@ -814,7 +1054,6 @@ def handle_unbind_group(event):
     return None
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_command_message(event):
     text = event.message.text.strip()
     source_type = event.source.type  # "user" 表示私訊，"group" 表示群組
@@ -874,6 +1113,11 @@ def handle_text_command_message(event):
             "handler": handle_show_log,
             "allowed_context": ["user"],
         },
+        "search_log": {
+            "aliases": ["!searchlog"],
+            "handler": handle_search_log,
+            "allowed_context": ["user"],
+        },
         "group_action": {
             "aliases": ["!groupaction"],
             "handler": handle_group_action,  # 顯示群組相關操作的選單
@@ -958,8 +1202,12 @@ def handle_text_command_message(event):
         if reply_text:
             reply_message(event.reply_token, [TextMessage(text=reply_text)])
 
-@handler.add(MessageEvent, message=(ImageMessageContent, VideoMessageContent, AudioMessageContent))
-def handle_content_message(event):
+def build_content_workflow(event):
+    """圖片 / 影片 / 音訊訊息：產生「下載 -> 分派上傳」的工作項目（見 start_media_workflow）
+
+    回傳:
+        dict: 工作項目，不需處理時回傳 None
+    """
     # 1) 判斷副檔名
     ext_map = {
         ImageMessageContent: 'jpg',
@@ -969,7 +1217,7 @@ def handle_content_message(event):
     ext = ext_map.get(type(event.message), None)
     
     if not ext:
-        return 'OK'
+        return None
 
     # 2) 收集事件資料
     source_type = event.source.type  # "user" or "group"
@@ -977,129 +1225,162 @@ def handle_content_message(event):
     event_data = {
         'source_type': source_type,
         'source_id': source_id,
-        'reply_token': event.reply_token
+        'reply_token': event.reply_token,
+        'reply_deadline': get_reply_deadline(event)
     }
 
-    message_id = event.message.id
-
-    # 3) 建立 Celery chain: 先下載 -> 再上傳
-    workflow = chain(
-        download_line_file_task.s(message_id, ext),
-        handle_upload_task.s(event_data)
-    )
-    workflow.apply_async()
+    # 3) 先下載 -> 再上傳，由 dispatch_webhook_events 整批送出
+    return {
+        'message_id': event.message.id,
+        'ext': ext,
+        'event_data': event_data
+    }
 
-    # 4) 立即回 OK, 不阻塞
-    return 'OK'
+def build_file_workflow(event):
+    """檔案訊息：產生「下載 -> 分派上傳」的工作項目（見 start_media_workflow）
 
-@handler.add(MessageEvent, message=FileMessageContent)
-def handle_file_message(event):
+    回傳:
+        dict: 工作項目，Drive 空間不足而略過時回傳 None
+    """
     # 假設檔案副檔名為 'file'，或可從 event.message.file_name 動態擷取
     ext = 'file'
 
     source_type = event.source.type
     source_id = event.source.user_id if source_type == 'user' else event.source.group_id
+
+    # 私訊的檔案大小已知，Drive 空間不足時連下載都省略
+    if source_type == 'user':
+        free_bytes = get_drive_free_bytes([source_id]).get(source_id)
+        if free_bytes is not None and event.message.file_size > free_bytes:
+            record_drive_quota_skip_task.delay(source_id, event.message.file_name, source_type, source_id, free_bytes)
+            return None
+
     event_data = {
         'source_type': source_type,
         'source_id': source_id,
-        'reply_token': event.reply_token
+        'reply_token': event.reply_token,
+        'reply_deadline': get_reply_deadline(event)
     }
 
-    message_id = event.message.id
-
-    workflow = chain(
-        download_line_file_task.s(message_id, ext, event.message.file_name),
-        handle_upload_task.s(event_data)
-    )
-    workflow.apply_async()
+    entry = {
+        'message_id': event.message.id,
+        'ext': ext,
+        'file_name': event.message.file_name,
+        'event_data': event_data
+    }
+    size_class = get_upload_size_class(event.message.file_size)
+    if size_class is not UPLOAD_SIZE_CLASSES[0]:
+        # 大型檔案的下載也交給該級別的 worker，不佔用處理一般訊息的 ingest worker
+        entry['queue'] = size_class['QUEUE']
+    return entry
 
-    return 'OK'
+def record_join(cursor, event):
+    """記錄或更新加入的群組資訊
 
-@handler.add(JoinEvent)
-def handle_join(event):
-    """處理加入群組事件
-    
     參數:
+        cursor: 資料庫游標（由呼叫端負責 commit）
         event (JoinEvent): LINE 加入事件物件
     """
     source_type = event.source.type
     source_id = event.source.group_id if source_type == 'group' else event.source.room_id
     source_name = get_source_name(source_type, source_id)
-    
-    # 記錄或更新群組資訊到資料庫
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cursor:
-            # 檢查群組是否已存在
-            cursor.execute(
-                'SELECT status FROM group_info WHERE group_id = %s',
-                (source_id,)
-            )
-            existing_group = cursor.fetchone()
-            
-            if existing_group:
-                # 群組已存在，更新狀態和加入時間
-                cursor.execute(
-                    '''UPDATE group_info 
-                       SET status = 'active',
-                           joined_at = CURRENT_TIMESTAMP,
-                           name = %s,
-                           left_at = NULL
-                       WHERE group_id = %s''',
-                    (source_name, source_id)
-                )
-                app.logger.info(f"[JOIN] Updated {source_type} info: {source_id} ({source_name})")
-            else:
-                # 新群組，插入記錄
-                cursor.execute(
-                    'INSERT INTO group_info (group_id, name, type, status) VALUES (%s, %s, %s, %s)',
-                    (source_id, source_name, source_type, 'active')
-                )
-                app.logger.info(f"[JOIN] Recorded new {source_type}: {source_id} ({source_name})")
-            
-        conn.commit()
-    except Exception as e:
-        app.logger.error(f"[JOIN] Failed to record/update {source_type}: {str(e)}")
-        conn.rollback()
-    finally:
-        conn.close()
 
-@handler.add(LeaveEvent)
-def handle_leave(event):
-    """處理離開群組事件
-    
+    # 檢查群組是否已存在
+    cursor.execute(
+        'SELECT status FROM group_info WHERE group_id = %s',
+        (source_id,)
+    )
+    existing_group = cursor.fetchone()
+
+    if existing_group:
+        # 群組已存在，更新狀態和加入時間
+        cursor.execute(
+            '''UPDATE group_info 
+               SET status = 'active',
+                   joined_at = CURRENT_TIMESTAMP,
+                   name = %s,
+                   left_at = NULL
+               WHERE group_id = %s''',
+            (source_name, source_id)
+        )
+        app.logger.info(f"[JOIN] Updated {source_type} info: {source_id} ({source_name})")
+    else:
+        # 新群組，插入記錄
+        cursor.execute(
+            'INSERT INTO group_info (group_id, name, type, status) VALUES (%s, %s, %s, %s)',
+            (source_id, source_name, source_type, 'active')
+        )
+        app.logger.info(f"[JOIN] Recorded new {source_type}: {source_id} ({source_name})")
+
+def record_leave(cursor, event):
+    """清除離開的群組的綁定與資料夾映射，並更新群組狀態
+
     參數:
+        cursor: 資料庫游標（由呼叫端負責 commit）
         event (LeaveEvent): LINE 離開事件物件
+
+    回傳:
+        tuple: (群組 ID, 原本綁定的使用者列表)，commit 後用來清除快取
     """
     source_type = event.source.type
     source_id = event.source.group_id if source_type == 'group' else event.source.room_id
-    
+
     app.logger.info("[LEAVE] Bot left %s: %s", source_type, source_id)
-    
-    # 更新資料庫記錄
+
+    # 記下原本綁定的使用者，稍後清除他們的報表快取
+    cursor.execute('SELECT user_id FROM group_users WHERE group_id = %s', (source_id,))
+    bound_users = [row[0] for row in cursor.fetchall()]
+
+    # 刪除群組使用者綁定關係
+    cursor.execute('DELETE FROM group_users WHERE group_id = %s', (source_id,))
+
+    # 刪除群組資料夾映射
+    cursor.execute('DELETE FROM folder_map WHERE source_id = %s', (source_id,))
+    cursor.execute('DELETE FROM folder_month_map WHERE source_id = %s', (source_id,))
+
+    # 更新群組資訊狀態
+    cursor.execute(
+        '''UPDATE group_info 
+           SET left_at = CURRENT_TIMESTAMP,
+               status = 'left'
+           WHERE group_id = %s''',
+        (source_id,)
+    )
+    return source_id, bound_users
+
+def handle_membership_events(events):
+    """處理同一批 webhook 中的加入 / 離開群組事件，共用一個資料庫連線
+
+    每個事件各自 commit，單一事件失敗時只回滾該事件並記錄錯誤。
+
+    參數:
+        events (list): JoinEvent 或 LeaveEvent 的列表
+    """
     conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            # 刪除群組使用者綁定關係
-            cursor.execute('DELETE FROM group_users WHERE group_id = %s', (source_id,))
-            
-            # 刪除群組資料夾映射
-            cursor.execute('DELETE FROM folder_map WHERE source_id = %s', (source_id,))
-            
-            # 更新群組資訊狀態
-            cursor.execute(
-                '''UPDATE group_info 
-                   SET left_at = CURRENT_TIMESTAMP,
-                       status = 'left'
-                   WHERE group_id = %s''',
-                (source_id,)
-            )
-        conn.commit()
-        app.logger.info("[LEAVE] Successfully updated database records for %s: %s", 
-                       source_type, source_id)
-    except Exception as e:
-        app.logger.error("[LEAVE] Failed to update database records: %s", str(e))
-        conn.rollback()
+        for event in events:
+            if isinstance(event, JoinEvent):
+                try:
+                    with conn.cursor() as cursor:
+                        record_join(cursor, event)
+                    conn.commit()
+                except Exception as e:
+                    app.logger.error(f"[JOIN] Failed to record/update {event.source.type}: {str(e)}")
+                    conn.rollback()
+                continue
+
+            try:
+                with conn.cursor() as cursor:
+                    source_id, bound_users = record_leave(cursor, event)
+                conn.commit()
+            except Exception as e:
+                app.logger.error("[LEAVE] Failed to update database records: %s", str(e))
+                conn.rollback()
+                continue
+            cache_set_group_users(source_id, [])
+            bump_folder_map_version(source_id)
+            invalidate_report_cache(*bound_users)
+            app.logger.info("[LEAVE] Successfully updated database records for %s", source_id)
     finally:
         conn.close()
 
@@ -1121,6 +1402,55 @@ def serve_logs(filename):
     
     return send_from_directory(STATIC_LOGS_PATH, filename)
 
+@app.route('/linebot/searchlog')
+def search_log_view():
+    """!searchlog 的搜尋結果網頁（連結帶有簽章，SEARCH_LOG_LINK_TTL 後失效）"""
+    token = request.args.get('token', '')
+    search = load_search_token(token)
+    if not search:
+        abort(403, description="連結已過期或無效，請重新輸入 !searchlog")
+    user_id, keyword = search
+    page = max(1, request.args.get('page', 1, type=int))
+    rows, has_more = search_upload_logs(user_id, keyword, page)
+    return render_template(
+        'searchlog.html',
+        keyword=keyword,
+        rows=rows,
+        page=page,
+        has_more=has_more,
+        token=token,
+        retention_days=UPLOAD_LOG_RETENTION_DAYS,
+        drive_file_link=drive_file_link
+    )
+
+def check_admin_token():
+    """檢查管理用端點的存取權杖，不符合時回傳 403"""
+    token = request.args.get('token', '')
+    if not ADMIN_TOKEN or not secrets.compare_digest(token, ADMIN_TOKEN):
+        abort(403)
+
+@app.route('/linebot/metrics')
+def metrics():
+    """回傳 worker 回報的系統指標（需帶上 ADMIN_TOKEN）"""
+    check_admin_token()
+    return jsonify(redis_client.hgetall(METRICS_KEY))
+
+@app.route('/linebot/deadletters')
+def dead_letters():
+    """檢視 dead-letter queue 中放棄重試的任務（需帶上 ADMIN_TOKEN）
+
+    查詢參數:
+        limit (int): 回傳筆數，預設 50
+        classification (str): 只顯示指定分類（permanent / user_action / retryable）
+    """
+    check_admin_token()
+    limit = request.args.get('limit', 50, type=int)
+    classification = request.args.get('classification')
+    entries = [json.loads(item) for item in redis_client.lrange(DEAD_LETTER_KEY, 0, limit - 1)]
+    if classification:
+        entries = [entry for entry in entries if entry.get('classification') == classification]
+    return jsonify({'total': redis_client.llen(DEAD_LETTER_KEY), 'entries': entries})
+
 @app.route('/linebot/authorize')
 def authorize():
     """處理 Google OAuth 授權請求
@@ -1220,6 +1550,9 @@ def oauth2callback():
             app.logger.info("[AUTH] Successfully stored token for user_id=%s", line_user_id)
         finally:
             conn.close()
+
+        # 重新綁定後恢復該帳號的上傳
+        close_auth_breaker(line_user_id)
         
         return render_template('oauth_success.html')
         
@@ -0,0 +1,119 @@
+# archive.py
+#
+# upload_logs 封存區：超過保留期限的日誌匯出成壓縮的 JSON Lines 檔案
+# 每次匯出都寫入新的分段檔（只新增、不修改既有檔案），檔名帶有日誌日期，
+# 例如 upload_logs-2026-10-12-1760745600-3fa9c2d1.jsonl.gz
+
+# === 基本設定 ===
+from settings import *
+
+import os
+import re
+import gzip
+import json
+import secrets
+import tempfile
+import datetime
+
+from spool import LocalSpoolBackend, S3SpoolBackend
+
+ARCHIVE_PREFIX = 'upload_logs'
+ARCHIVE_KEY_RE = re.compile(rf'^{ARCHIVE_PREFIX}-(\d{{4}}-\d{{2}}-\d{{2}})-[\w-]+\.jsonl\.gz$')
+# 匯出與下載分段檔用的暫存目錄，不可與上傳暫存區（STATIC_TMP_PATH）共用，
+# 否則會被 clean_spool 計入容量並清除，也可能被 !retryupload 的檔名比對選中
+ARCHIVE_TMP_PATH = os.path.join(tempfile.gettempdir(), 'linebot-archive')
+
+def archive_tmp_dir():
+    """匯出分段檔時的暫存目錄：本機後端放在封存區下的子目錄，移入時不需跨檔案系統複製"""
+    if UPLOAD_LOG_ARCHIVE.get('BACKEND', 'local') == 'local':
+        return os.path.join(UPLOAD_LOG_ARCHIVE['ROOT'], '.tmp')
+    return ARCHIVE_TMP_PATH
+
+_archive_backend = None
+
+def get_archive_backend():
+    """依 UPLOAD_LOG_ARCHIVE 設定取得封存區後端（沿用暫存區的後端實作，每個行程只建立一次）"""
+    global _archive_backend
+    if _archive_backend is None:
+        backend = UPLOAD_LOG_ARCHIVE.get('BACKEND', 'local')
+        if backend == 's3':
+            _archive_backend = S3SpoolBackend(
+                bucket=SPOOL_S3['BUCKET'],
+                prefix=UPLOAD_LOG_ARCHIVE.get('S3_PREFIX', 'archive/'),
+                endpoint_url=SPOOL_S3.get('ENDPOINT_URL'),
+                access_key=SPOOL_S3.get('ACCESS_KEY'),
+                secret_key=SPOOL_S3.get('SECRET_KEY'),
+                region=SPOOL_S3.get('REGION'),
+                cache_dir=ARCHIVE_TMP_PATH,
+            )
+        elif backend == 'local':
+            _archive_backend = LocalSpoolBackend(UPLOAD_LOG_ARCHIVE['ROOT'])
+        else:
+            raise ValueError(f"Unknown UPLOAD_LOG_ARCHIVE backend: {backend}")
+    return _archive_backend
+
+def archive_day(key):
+    """由分段檔名取得日誌日期，不是封存檔時回傳 None"""
+    match = ARCHIVE_KEY_RE.match(key)
+    return datetime.date.fromisoformat(match.group(1)) if match else None
+
+def write_archive_part(day, rows, backend=None):
+    """將同一天的日誌寫成一個新的分段檔
+
+    參數:
+        day (datetime.date): 日誌日期
+        rows (list): 日誌列（dict），datetime 欄位會轉成 ISO 格式字串
+        backend: 封存區後端，預設為 get_archive_backend()
+
+    回傳:
+        str: 分段檔的 key
+    """
+    backend = backend or get_archive_backend()
+    key = f"{ARCHIVE_PREFIX}-{day.isoformat()}-{int(datetime.datetime.now().timestamp())}-{secrets.token_hex(4)}.jsonl.gz"
+    tmp_dir = archive_tmp_dir()
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=tmp_dir, prefix='archive-', suffix='.jsonl.gz')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+            for row in rows:
+                gz.write(json.dumps(row, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+        backend.put_file(path, key, move=True)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return key
+
+def list_archive_parts(since=None, until=None, backend=None):
+    """列出封存的分段檔
+
+    參數:
+        since (datetime.date): 只列出此日期（含）之後的日誌
+        until (datetime.date): 只列出此日期（含）之前的日誌
+
+    回傳:
+        list: 依日期排序的 (日期, key, 大小) 列表
+    """
+    backend = backend or get_archive_backend()
+    parts = []
+    for key, size, _ in backend.list():
+        day = archive_day(key)
+        if day is None or (since and day < since) or (until and day > until):
+            continue
+        parts.append((day, key, size))
+    return sorted(parts)
+
+def iter_archive_rows(keys, backend=None):
+    """依序讀出分段檔中的日誌列
+
+    同一筆日誌可能因匯出後刪除前中斷而出現在兩個分段檔中，以 id 去除重複。
+    """
+    backend = backend or get_archive_backend()
+    seen_ids = set()
+    for key in keys:
+        with backend.local_copy(key) as path, gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                if row.get('id') in seen_ids:
+                    continue
+                seen_ids.add(row.get('id'))
+                yield row
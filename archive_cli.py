@@ -0,0 +1,84 @@
+# archive_cli.py
+#
+# 查詢 upload_logs 封存區（見 archive.py 與 UPLOAD_LOG_ARCHIVE）
+#
+# 用法:
+#   python archive_cli.py list [--since 2026-01-01] [--until 2026-01-31]
+#   python archive_cli.py query --user U123 --since 2026-01-01 [--source-id C456] [--status success]
+#                               [--keyword 報告] [--json]
+
+import sys
+import json
+import argparse
+import datetime
+
+from archive import list_archive_parts, iter_archive_rows
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式應為 YYYY-MM-DD: {value}")
+
+
+def row_matches(row, args):
+    """依查詢條件過濾日誌列"""
+    if args.user and row.get('user_id') != args.user:
+        return False
+    if args.source_id and row.get('source_id') != args.source_id:
+        return False
+    if args.status and not (row.get('status') or '').startswith(args.status):
+        return False
+    if args.keyword:
+        keyword = args.keyword.lower()
+        if keyword not in (row.get('file_name') or '').lower() and keyword not in (row.get('source_name') or '').lower():
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查詢 upload_logs 封存區")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = subparsers.add_parser('list', help="列出封存的分段檔")
+    query_parser = subparsers.add_parser('query', help="查詢封存的日誌")
+    for sub in (list_parser, query_parser):
+        sub.add_argument('--since', type=parse_date, help="起始日期（含）")
+        sub.add_argument('--until', type=parse_date, help="結束日期（含）")
+    query_parser.add_argument('--user', help="LINE 使用者 ID")
+    query_parser.add_argument('--source-id', help="來源（群組或使用者）ID")
+    query_parser.add_argument('--status', help="狀態前綴，例如 success、http_error")
+    query_parser.add_argument('--keyword', help="檔名或來源名稱包含的關鍵字")
+    query_parser.add_argument('--limit', type=int, default=0, help="最多輸出筆數（0 表示不限）")
+    query_parser.add_argument('--json', action='store_true', help="以 JSON Lines 輸出")
+    args = parser.parse_args()
+
+    parts = list_archive_parts(args.since, args.until)
+
+    if args.command == 'list':
+        total = 0
+        for day, key, size in parts:
+            print(f"{day}\t{size}\t{key}")
+            total += size
+        print(f"{len(parts)} 個分段檔，共 {total} 位元組", file=sys.stderr)
+        return 0
+
+    count = 0
+    for row in iter_archive_rows([key for _, key, _ in parts]):
+        if not row_matches(row, args):
+            continue
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            print(f"{row.get('upload_time')}\t{row.get('user_id')}\t{row.get('source_name')}\t"
+                  f"{row.get('file_name')}\t{row.get('status')}")
+        count += 1
+        if args.limit and count >= args.limit:
+            break
+    print(f"{count} 筆", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
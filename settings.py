@@ -25,6 +25,11 @@ DATABASE = {
     'USER': 'host',
     'PASSWORD': '<password>',
     'DB': 'drivetoken',
+    # 唯讀副本（選用）：報表查詢（!showlog、!listgroup 等）改讀副本，避免與上傳流程的寫入競爭
+    # 例如 {'HOST': 'replica.local', 'PORT': 3306}，未指定的 USER / PASSWORD / DB 沿用主資料庫
+    'REPLICA': None,
+    'REPLICA_MAX_LAG': 10,            # 副本複寫延遲超過此秒數時改讀主資料庫
+    'REPLICA_LAG_CHECK_INTERVAL': 10, # 每個行程重新檢查複寫延遲的間隔（秒）
 }
 
 # 靜態檔案路徑設定
@@ -35,6 +40,146 @@ STATIC_LOGS_PATH = os.path.join(BASE_DIR, 'static', 'logs')
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
 CELERY_BACKEND_URL = 'redis://127.0.0.1:6379/0'
 
+# Celery worker 設定檔（worker_launcher.py 使用）
+# 每個設定檔啟動一個獨立的 worker，分別設定處理的佇列、並行數與預取數量
+CELERY_WORKER_PROFILES = {
+    'ingest': {'queues': ['ingest'], 'concurrency': 4, 'prefetch_multiplier': 4},
+    'upload': {'queues': ['upload'], 'concurrency': 8, 'prefetch_multiplier': 1},
+    'upload_large': {'queues': ['upload_large'], 'concurrency': 2, 'prefetch_multiplier': 1},
+    'interactive': {'queues': ['interactive'], 'concurrency': 4, 'prefetch_multiplier': 1},
+    'maintenance': {'queues': ['maintenance'], 'concurrency': 1, 'prefetch_multiplier': 1},
+}
+CELERY_WORKER_RUN_PATH = os.path.join(BASE_DIR, 'run')  # worker 的 pid 與 log 檔存放位置
+
+# 依目標使用者分片的上傳佇列：小型檔案依使用者 ID 做一致性雜湊，固定送到同一個分片佇列，
+# 讓同一使用者的憑證、Drive service 與資料夾 ID 留在同一個 worker 行程的快取中（0 表示停用）
+# 每個分片由 worker_launcher.py 啟動一個 upload-shard-N worker
+UPLOAD_SHARDS = 0
+UPLOAD_SHARD_CONCURRENCY = 2           # 每個分片 worker 的並行數
+UPLOAD_SHARD_VNODES = 64               # 雜湊環上每個分片的虛擬節點數
+UPLOAD_SHARD_HEARTBEAT_INTERVAL = 10   # 分片 worker 回報存活的間隔（秒）
+UPLOAD_SHARD_TTL = 30                  # 超過此秒數沒有回報的分片視為離線，其使用者改分配到其他分片
+
+# worker 行程內快取（Drive service、資料夾 ID 等）的保存時間（秒）與筆數上限（超過時淘汰最久未使用的項目）
+WORKER_CACHE_TTL = 5 * 60
+WORKER_CACHE_MAX_ENTRIES = 256
+
+# LINE reply token 有效時間（秒），worker 端逾時則改用 push message
+REPLY_TOKEN_TTL = 30
+REPLY_DEADLINE_MARGIN = 3  # 距離期限少於此秒數時直接改用 push message
+
+# LINE 影片 / 音訊轉檔狀態輪詢（內容準備好才開始下載）
+LINE_CONTENT_POLL = {
+    'INITIAL_INTERVAL': 1.0,  # 第一次輪詢的間隔（秒）
+    'BACKOFF': 1.5,           # 每次輪詢後間隔的倍數
+    'MAX_INTERVAL': 15.0,     # 輪詢間隔上限（秒）
+    'INLINE_BUDGET': 20,      # 在 worker 內等待的秒數上限，超過則延後重試任務
+    'MAX_DEFERRALS': 40,      # 因內容尚未準備好而延後重試的額外次數上限
+}
+
+# 已處理的 webhook 事件 ID 保存時間（秒），用來丟棄 LINE 重送（redelivery）的重複事件
+WEBHOOK_EVENT_TTL = 24 * 60 * 60
+
+# Redis 設定（快取、計數器等非 Celery 用途）
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 1
+
+# 管理用端點（例如 /linebot/metrics）的存取權杖，None 表示停用
+ADMIN_TOKEN = None
+
+# Google Drive 請求頻率限制（所有 worker 共用的 Redis token bucket）
+DRIVE_RATE_LIMIT = {
+    'USER_RATE': 3.0,      # 每位使用者每秒補充的請求數
+    'USER_BURST': 10,      # 每位使用者最多可累積的請求數
+    'CLIENT_RATE': 100.0,  # 整個 OAuth client 每秒補充的請求數
+    'CLIENT_BURST': 300,   # 整個 OAuth client 最多可累積的請求數
+    'MAX_WAIT': 5,         # 在 worker 內等待額度的秒數上限，超過則延後重試任務
+    'MAX_DEFERRALS': 20,   # 因頻率限制延後重試的額外次數上限
+}
+
+# Google Drive 可續傳上傳設定
+DRIVE_UPLOAD_CHUNK_SIZE = 1024 * 1024           # 每個區塊大小（必須是 256KB 的倍數）
+DRIVE_RESUMABLE_SESSION_TTL = 6 * 24 * 60 * 60  # 續傳 session 保存時間（秒），Drive session 約一週後失效
+
+# 依檔案大小分級上傳：由小到大比對 MAX_BYTES（None 表示沒有上限），
+# 每個級別使用獨立的佇列與時間限制，大型影片不會佔住小檔案的 worker
+UPLOAD_SIZE_CLASSES = [
+    {'NAME': 'small', 'MAX_BYTES': 20 * 1024 * 1024, 'QUEUE': 'upload',
+     'TIME_LIMIT': 300, 'SOFT_TIME_LIMIT': 270},
+    {'NAME': 'large', 'MAX_BYTES': None, 'QUEUE': 'upload_large',
+     'TIME_LIMIT': 3600, 'SOFT_TIME_LIMIT': 3540},
+]
+
+# 群組檔案合併上傳：同一群組在同一時間窗口內收到的小型檔案合併成一個批次任務（0 表示停用）
+UPLOAD_COALESCE_WINDOW = 5       # 時間窗口（秒）
+UPLOAD_COALESCE_GRACE = 2        # 窗口結束後再等待的秒數，讓仍在下載的檔案趕上
+UPLOAD_COALESCE_MAX_FILES = 20   # 每個批次任務最多的檔案數
+UPLOAD_BATCH_TIME_LIMIT = 1800   # 批次上傳任務的時間上限（秒）
+
+# Google Drive 儲存空間快照（about().get(fields='storageQuota')）
+DRIVE_QUOTA_REFRESH_INTERVAL = 60 * 60      # 定期重新取得快照的間隔（秒）
+DRIVE_QUOTA_CACHE_TTL = 3 * 60 * 60         # 快照保存時間（秒），過期後視為未知、不略過上傳
+DRIVE_QUOTA_NOTICE_INTERVAL = 24 * 60 * 60  # 空間不足通知的最短間隔（秒）
+
+# Drive 資料夾結構：'flat' 所有檔案直接放在來源資料夾；'monthly' 依上傳月份放在來源資料夾下的 YYYY/MM 子資料夾
+# 子資料夾 ID 記錄在 folder_month_map，每個月只有第一次上傳需要建立資料夾
+DRIVE_FOLDER_LAYOUT = 'flat'
+
+# 以 Drive Changes API 追蹤資料夾被刪除、移到垃圾桶或改名的間隔（秒）
+DRIVE_CHANGES_SYNC_INTERVAL = 10 * 60
+
+# 群組綁定使用者快取的保存時間（秒），綁定 / 解除綁定時會同步更新
+GROUP_USERS_CACHE_TTL = 24 * 60 * 60
+
+# !searchlog 上傳紀錄搜尋
+SEARCH_LOG_PAGE_SIZE = 10       # LINE 回覆與搜尋結果網頁的每頁筆數
+SEARCH_LOG_LINK_TTL = 30 * 60   # 搜尋結果網頁連結的有效時間（秒）
+
+# !listgroup / !showcompletegroup 回覆內容的快取時間（秒），綁定或資料夾變更時會立即清除
+REPORT_CACHE_TTL = 10 * 60
+
+# Google 授權失效的斷路器保存時間（秒），使用者重新綁定時會立即關閉
+AUTH_BREAKER_TTL = 30 * 24 * 60 * 60
+
+# 任務重試與 dead-letter queue
+RETRY_BACKOFF_BASE = 10         # 指數退避的基準秒數
+RETRY_BACKOFF_MAX = 600         # 單次退避的上限秒數
+DEAD_LETTER_MAX_ENTRIES = 1000  # dead-letter queue 保留的最大筆數
+
+# 原始上傳日誌（upload_logs）保留天數，!searchlog、!listfailed 等指令只能查到這段期間的紀錄
+UPLOAD_LOG_RETENTION_DAYS = 7
+
+# 每日上傳統計（upload_stats_daily）保留天數
+UPLOAD_STATS_RETENTION_DAYS = 400
+
+# upload_logs 封存：超過 UPLOAD_LOG_RETENTION_DAYS 天的日誌刪除前先匯出成每日的 gzip JSON Lines 分段檔（None 表示不封存，直接刪除）
+# 可用 archive_cli.py 查詢封存的日誌
+UPLOAD_LOG_ARCHIVE = {
+    'BACKEND': 'local',                           # 'local'（存放於 ROOT）或 's3'（使用 SPOOL_S3 的 bucket）
+    'ROOT': os.path.join(BASE_DIR, 'archive'),
+    'S3_PREFIX': 'archive/',                      # 與暫存區使用不同的前綴
+    'BATCH_SIZE': 5000,                           # 每次匯出並刪除的筆數
+}
+
+# 暫存區（spool）設定
+SPOOL_MAX_BYTES = 5 * 1024 * 1024 * 1024  # 暫存區容量上限（位元組）
+SPOOL_RETENTION_HOURS = 24                 # 上傳失敗的檔案保留供重試的時間（小時）
+SPOOL_INFLIGHT_GRACE_MINUTES = 15          # 新檔案視為處理中、不會被清除的時間（分鐘）
+SPOOL_REFS_TTL = 7 * 24 * 60 * 60          # 暫存檔參照計數的保存時間（秒），避免任務遺失時留下計數
+
+# 暫存區後端：'local'（存放於 STATIC_TMP_PATH）或 's3'（S3 相容物件儲存，需安裝 boto3）
+# 使用 's3' 時下載與上傳 worker 可以在不同主機上執行
+SPOOL_BACKEND = 'local'
+SPOOL_S3 = {
+    'ENDPOINT_URL': 'http://127.0.0.1:9000',  # MinIO 位址；使用 AWS S3 時設為 None
+    'BUCKET': 'linebot-spool',
+    'PREFIX': 'spool/',
+    'ACCESS_KEY': 'minioadmin',
+    'SECRET_KEY': 'minioadmin',
+    'REGION': None,
+}
+
 # 匯入 local_settings.py 中的覆寫設定（若存在的話）
 try:
     from local_settings import *
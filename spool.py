@@ -0,0 +1,216 @@
+# spool.py
+
+# === 基本設定 ===
+from settings import *
+
+import os
+import stat
+import shutil
+import tempfile
+import logging
+from contextlib import contextmanager
+
+
+class SpoolBackend:
+    """暫存區（spool）後端介面
+
+    任務之間只傳遞 spool key（檔名），實際檔案存放位置由後端決定，
+    讓下載與上傳可以在不同主機上的 worker 執行。
+    """
+
+    def put_file(self, local_path, key, move=True):
+        """將本機檔案存入暫存區
+
+        參數:
+            local_path (str): 本機檔案路徑
+            key (str): spool key
+            move (bool): 存入後是否刪除本機檔案
+        """
+        raise NotImplementedError
+
+    def local_copy(self, key):
+        """取得檔案本機路徑的 context manager（離開 with 區塊後本機副本可能被刪除）"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        """回傳檔案大小（位元組），檔案不存在時拋出 FileNotFoundError"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """刪除檔案
+
+        回傳:
+            bool: 檔案存在且已刪除時回傳 True
+        """
+        raise NotImplementedError
+
+    def list(self):
+        """列出暫存區中的檔案
+
+        回傳:
+            list: (key, 大小, 最後使用時間) 的列表
+        """
+        raise NotImplementedError
+
+
+def _check_key(key):
+    """spool key 只能是單純檔名，避免跳出暫存區目錄"""
+    if not key or os.path.basename(key) != key or key in ('.', '..'):
+        raise ValueError(f"Invalid spool key: {key!r}")
+    return key
+
+
+class LocalSpoolBackend(SpoolBackend):
+    """本機磁碟後端（預設），檔案存放於 root 目錄"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, _check_key(key))
+
+    def put_file(self, local_path, key, move=True):
+        if move:
+            shutil.move(local_path, self.path(key))
+        else:
+            shutil.copyfile(local_path, self.path(key))
+
+    @contextmanager
+    def local_copy(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        yield path
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self):
+        entries = []
+        for filename in os.listdir(self.root):
+            try:
+                st = os.stat(os.path.join(self.root, filename))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                entries.append((filename, st.st_size, max(st.st_atime, st.st_mtime)))
+        return entries
+
+
+class S3SpoolBackend(SpoolBackend):
+    """S3 相容物件儲存後端（AWS S3、MinIO 等），需要安裝 boto3"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, access_key=None,
+                 secret_key=None, region=None, cache_dir=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise ImportError("S3 spool backend requires boto3: pip install boto3") from e
+
+        self._client_error = ClientError
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=region,
+        )
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir or tempfile.gettempdir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _object_key(self, key):
+        return f"{self.prefix}{_check_key(key)}"
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self._client_error as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def put_file(self, local_path, key, move=True):
+        self.client.upload_file(local_path, self.bucket, self._object_key(key))
+        if move:
+            os.remove(local_path)
+
+    @contextmanager
+    def local_copy(self, key):
+        if self._head(key) is None:
+            raise FileNotFoundError(key)
+        fd, path = tempfile.mkstemp(dir=self.cache_dir, prefix='s3-', suffix=f"-{key}")
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self._object_key(key), path)
+            yield path
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head['ContentLength']
+
+    def delete(self, key):
+        if self._head(key) is None:
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        return True
+
+    def list(self):
+        entries = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(self.prefix):]
+                if key and '/' not in key:
+                    entries.append((key, obj['Size'], obj['LastModified'].timestamp()))
+        return entries
+
+
+_spool_backend = None
+
+def get_spool_backend():
+    """依 SPOOL_BACKEND 設定取得暫存區後端（每個行程只建立一次）"""
+    global _spool_backend
+    if _spool_backend is None:
+        if SPOOL_BACKEND == 's3':
+            _spool_backend = S3SpoolBackend(
+                bucket=SPOOL_S3['BUCKET'],
+                prefix=SPOOL_S3.get('PREFIX', ''),
+                endpoint_url=SPOOL_S3.get('ENDPOINT_URL'),
+                access_key=SPOOL_S3.get('ACCESS_KEY'),
+                secret_key=SPOOL_S3.get('SECRET_KEY'),
+                region=SPOOL_S3.get('REGION'),
+                cache_dir=STATIC_TMP_PATH,
+            )
+        elif SPOOL_BACKEND == 'local':
+            _spool_backend = LocalSpoolBackend(STATIC_TMP_PATH)
+        else:
+            raise ValueError(f"Unknown SPOOL_BACKEND: {SPOOL_BACKEND}")
+        logging.getLogger('celery').info("[SPOOL] Using %s spool backend", SPOOL_BACKEND)
+    return _spool_backend
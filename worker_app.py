@@ -8,12 +8,25 @@ import json
 import logging
 import tempfile
 import datetime
-from celery import Celery, chord, group
+import random
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+import urllib.parse
+from contextlib import contextmanager
+from celery import Celery, chain
 from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_ready, worker_shutdown, worker_process_init
+from kombu import Queue
 from googleapiclient.errors import HttpError
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.http import MediaFileUpload
 from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
+import httplib2
+import urllib3
 import pymysql
 from linebot.v3.messaging import (
     ReplyMessageRequest,
@@ -28,39 +41,158 @@ from linebot.v3.messaging import (
     ShowLoadingAnimationRequest,
     URIAction,
     CarouselColumn,
-    CarouselTemplate
+    CarouselTemplate,
+    PushMessageRequest,
+    Message
 )
+from linebot.v3.messaging.exceptions import ApiException
 from dbutils.pooled_db import PooledDB  # 改用 PooledDB
+from redis import Redis
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import time
 
+from spool import get_spool_backend
+from archive import write_archive_part
+
 
 configuration = Configuration(
     access_token=CHANNEL_ACCESS_TOKEN,
 )
 
+# 行程內共用的 LINE ApiClient，重複使用與 LINE API 的 HTTPS 連線
+_line_api_client = None
+
+def get_line_api_client():
+    global _line_api_client
+    if _line_api_client is None:
+        _line_api_client = ApiClient(configuration)
+    return _line_api_client
+
+@contextmanager
+def line_api_client():
+    """取得行程內共用的 LINE ApiClient（離開 with 區塊時不關閉）"""
+    yield get_line_api_client()
+
+# Drive v3 discovery 文件，每個行程只從套件內建的檔案讀取一次
+_drive_discovery_doc = None
+
+def load_drive_discovery_doc():
+    global _drive_discovery_doc
+    if _drive_discovery_doc is None:
+        _drive_discovery_doc = get_static_doc('drive', 'v3')
+    return _drive_discovery_doc
+
+def build_drive_service(credentials):
+    """建立 Google Drive v3 service（套件未內建 discovery 文件時改由 build 線上取得）"""
+    discovery_doc = load_drive_discovery_doc()
+    if discovery_doc is None:
+        return build('drive', 'v3', credentials=credentials)
+    return build_from_document(discovery_doc, credentials=credentials)
+
 celery = Celery('worker_app', broker=CELERY_BROKER_URL, backend=CELERY_BACKEND_URL)
 
 # 設定時區
 celery.conf.timezone = 'UTC'
 
+# 依工作類型分流到不同佇列，避免大量上傳拖慢互動指令
+# 每個佇列由獨立的 worker 處理（見 worker_launcher.py 與 CELERY_WORKER_PROFILES）
+celery.conf.task_queues = (
+    Queue('ingest'),       # 從 LINE 下載檔案、分派上傳
+    Queue('upload'),       # 上傳到 Google Drive（小型檔案）
+    Queue('upload_large'), # 上傳大型檔案（見 UPLOAD_SIZE_CLASSES）
+    Queue('interactive'),  # 回覆使用者指令的查詢任務
+    Queue('maintenance'),  # 定期清理與其他未指定的任務
+) + tuple(Queue(f'upload-shard-{shard}') for shard in range(UPLOAD_SHARDS))  # 依使用者分片的上傳佇列
+celery.conf.task_default_queue = 'maintenance'
+celery.conf.task_routes = {
+    'worker_app.download_line_file_task': {'queue': 'ingest'},
+    'worker_app.handle_upload_task': {'queue': 'ingest'},
+    'worker_app.flush_upload_batch': {'queue': 'ingest'},
+    'worker_app.record_drive_quota_skip_task': {'queue': 'ingest'},
+    'worker_app.dispatch_media_workflows_task': {'queue': 'ingest'},
+    'worker_app.upload_file_to_drive_task': {'queue': 'upload'},
+    'worker_app.upload_batch_to_drive_task': {'queue': 'upload'},
+    'worker_app.retry_failed_uploads_task': {'queue': 'upload'},
+    'worker_app.check_google_status': {'queue': 'interactive'},
+    'worker_app.showlog_task': {'queue': 'interactive'},
+    'worker_app.search_log_task': {'queue': 'interactive'},
+    'worker_app.handle_list_group_task': {'queue': 'interactive'},
+    'worker_app.handle_show_complete_group_task': {'queue': 'interactive'},
+    'worker_app.handle_update_folder_task': {'queue': 'interactive'},
+    'worker_app.list_failed_uploads_task': {'queue': 'interactive'},
+    'worker_app.clean_*': {'queue': 'maintenance'},
+}
+# 任務結果不寫入 result backend（暫存檔清理改用參照計數，不再使用 chord）
+celery.conf.task_ignore_result = True
+
+# 預設每次只預取一個任務，各佇列的預取數量由 worker 啟動參數覆寫
+celery.conf.worker_prefetch_multiplier = 1
+
+# 佇列優先權（Redis 中數字越小越優先）
+# 帶有 reply token 的任務依剩餘時間使用 0~8，其餘任務使用預設值 9（排在所有有期限的任務之後）
+celery.conf.broker_transport_options = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+DEFAULT_TASK_PRIORITY = 9
+celery.conf.task_default_priority = DEFAULT_TASK_PRIORITY
+
 # 設定定期任務
 celery.conf.beat_schedule = {
     'clean-old-upload-logs-every-day': {
         'task': 'worker_app.clean_old_upload_logs',
         'schedule': 86400.0,  # 每86400秒（即每天執行一次）
-        'args': (7,)  # 傳遞參數，這裡是保留7天的日誌
+        'args': (UPLOAD_LOG_RETENTION_DAYS,)  # 傳遞參數，日誌保留天數
     },
     'clean-tmp-logs-every-10-minutes': {
         'task': 'worker_app.clean_tmp_logs',
         'schedule': 600.0,  # 每600秒（即10分鐘執行一次）
         'args': (30,)  # 傳遞參數，這裡是保留30分鐘的日誌
     },
+    'clean-spool-every-10-minutes': {
+        'task': 'worker_app.clean_spool',
+        'schedule': 600.0,  # 每600秒檢查一次暫存區容量
+    },
+    'refresh-drive-quotas': {
+        'task': 'worker_app.refresh_drive_quotas',
+        'schedule': float(DRIVE_QUOTA_REFRESH_INTERVAL),
+    },
+    'sync-drive-folder-changes': {
+        'task': 'worker_app.sync_drive_folder_changes',
+        'schedule': float(DRIVE_CHANGES_SYNC_INTERVAL),
+    },
 }
+if UPLOAD_SHARDS:
+    celery.conf.beat_schedule['drain-offline-upload-shards'] = {
+        'task': 'worker_app.drain_offline_upload_shards',
+        'schedule': float(UPLOAD_SHARD_TTL),
+    }
 
 class UserCredentialsError(Exception):
     """使用者憑證錯誤"""
     pass
 
+class ResumableSessionExpired(Exception):
+    """儲存的 Drive 可續傳上傳 session 已失效，需要重新開始上傳"""
+    pass
+
+class LineContentNotReady(Exception):
+    """LINE 影片 / 音訊仍在轉檔中，wait 為建議的下次檢查秒數"""
+    def __init__(self, wait):
+        super().__init__(f"LINE content is still processing, check again in {wait:.1f}s")
+        self.wait = wait
+
+class LineContentFailed(Exception):
+    """LINE 回報影片 / 音訊轉檔失敗，內容無法下載"""
+    pass
+
+class DriveRateLimited(Exception):
+    """Google Drive 請求額度不足，wait 為建議等待秒數"""
+    def __init__(self, wait):
+        super().__init__(f"Drive rate limited, retry after {wait:.1f}s")
+        self.wait = wait
+
 # 日誌設定
 logging.basicConfig(
     level=logging.INFO,
@@ -68,23 +200,335 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# 建立資料庫連線池
-db_pool = PooledDB(
-    creator=pymysql,
-    maxconnections=6,      # 連線池允許的最大連線數
-    mincached=2,           # 初始化時，連線池中至少建立的空閒連線數量
-    maxcached=4,           # 連線池中允許的最大空閒連線數量
-    maxshared=2,           # 共享連線數量
-    blocking=True,         # 連線池滿時是否等待
-    host=DATABASE["HOST"],
-    user=DATABASE["USER"],
-    password=DATABASE["PASSWORD"],
-    database=DATABASE["DB"],
-    charset='utf8mb4',
-    autocommit=False,
-)
+# 資料庫連線池：每個行程各自建立（見 get_db_pool），prefork 子行程不會共用父行程的連線
+def create_db_pool():
+    return PooledDB(
+        creator=pymysql,
+        maxconnections=6,      # 連線池允許的最大連線數
+        mincached=2,           # 初始化時，連線池中至少建立的空閒連線數量
+        maxcached=4,           # 連線池中允許的最大空閒連線數量
+        maxshared=2,           # 共享連線數量
+        blocking=True,         # 連線池滿時是否等待
+        host=DATABASE["HOST"],
+        user=DATABASE["USER"],
+        password=DATABASE["PASSWORD"],
+        database=DATABASE["DB"],
+        charset='utf8mb4',
+        autocommit=False,
+        connect_timeout=DATABASE.get('CONNECT_TIMEOUT', 5),
+    )
+
+def create_replica_pool():
+    """唯讀副本連線池（DATABASE['REPLICA'] 未設定時回傳 None，報表查詢改讀主資料庫）"""
+    if not DATABASE.get('REPLICA'):
+        return None
+    return PooledDB(
+        creator=pymysql,
+        maxconnections=4,
+        mincached=0,           # 副本無法連線時不影響 worker 啟動
+        maxcached=2,
+        maxshared=0,
+        blocking=True,
+        host=DATABASE['REPLICA']['HOST'],
+        port=DATABASE['REPLICA'].get('PORT', 3306),
+        user=DATABASE['REPLICA'].get('USER', DATABASE['USER']),
+        password=DATABASE['REPLICA'].get('PASSWORD', DATABASE['PASSWORD']),
+        database=DATABASE['REPLICA'].get('DB', DATABASE['DB']),
+        charset='utf8mb4',
+        autocommit=True,
+        connect_timeout=DATABASE.get('CONNECT_TIMEOUT', 5),
+    )
+
+_db_pools = {'pid': None}
+_db_pools_lock = threading.Lock()
+_inherited_db_pools = []
+
+def get_db_pool(name='primary'):
+    """取得目前行程的資料庫連線池
+
+    參數:
+        name (str): 'primary' 或 'replica'
+
+    回傳:
+        PooledDB: 未設定唯讀副本時 'replica' 回傳 None
+    """
+    pid = os.getpid()
+    if _db_pools['pid'] != pid:
+        with _db_pools_lock:
+            if _db_pools['pid'] != pid:
+                # fork 前建立的連線池保留參照但不再使用：關閉它會連帶關掉父行程仍在使用的連線
+                if _db_pools['pid'] is not None:
+                    _inherited_db_pools.append(dict(_db_pools))
+                _db_pools.update(pid=pid, primary=create_db_pool(), replica=create_replica_pool())
+    return _db_pools[name]
+
+# 初始化 Redis 連線（快取與指標用）
+redis_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                     socket_connect_timeout=5)
+
+# 指標儲存的 Redis hash 名稱
+METRICS_KEY = 'metrics'
+
+def incr_metric(name, amount=1):
+    """累加指標數值（失敗時只記錄警告，不影響主流程）"""
+    try:
+        redis_client.hincrbyfloat(METRICS_KEY, name, amount)
+    except Exception as e:
+        logging.getLogger('celery').warning("[METRICS] Failed to update %s: %s", name, str(e))
+
+def set_metric(name, value):
+    """設定指標數值（失敗時只記錄警告，不影響主流程）"""
+    try:
+        redis_client.hset(METRICS_KEY, name, value)
+    except Exception as e:
+        logging.getLogger('celery').warning("[METRICS] Failed to set %s: %s", name, str(e))
+
+# Drive 分散式 token bucket：同時檢查每位使用者與整個 OAuth client 的額度
+# KEYS: 使用者 bucket, client bucket, 使用者退避鍵, client 退避鍵
+# ARGV: 現在時間, 消耗量, 使用者補充速率, 使用者容量, client 補充速率, client 容量
+# 回傳需要等待的秒數（0 表示已取得額度）
+DRIVE_RATE_LIMIT_LUA = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+for i = 3, 4 do
+  local pttl = redis.call('PTTL', KEYS[i])
+  if pttl > 0 then
+    wait = math.max(wait, pttl / 1000)
+  end
+end
+if wait > 0 then
+  return tostring(wait)
+end
+local tokens = {}
+for i = 1, 2 do
+  local rate = tonumber(ARGV[1 + i * 2])
+  local burst = tonumber(ARGV[2 + i * 2])
+  local data = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+  local current = tonumber(data[1]) or burst
+  local ts = tonumber(data[2]) or now
+  current = math.min(burst, current + math.max(0, now - ts) * rate)
+  tokens[i] = current
+  if current < cost then
+    wait = math.max(wait, (cost - current) / rate)
+  end
+end
+for i = 1, 2 do
+  local rate = tonumber(ARGV[1 + i * 2])
+  local burst = tonumber(ARGV[2 + i * 2])
+  local remaining = tokens[i]
+  if wait == 0 then
+    remaining = remaining - cost
+  end
+  redis.call('HSET', KEYS[i], 'tokens', remaining, 'ts', now)
+  redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 60)
+end
+return tostring(wait)
+"""
+drive_rate_limit_script = redis_client.register_script(DRIVE_RATE_LIMIT_LUA)
+
+def acquire_drive_quota(user_id, client_id, cost=1):
+    """向所有 worker 共用的 token bucket 取得 Drive 請求額度
+
+    等待時間在 DRIVE_RATE_LIMIT['MAX_WAIT'] 以內時直接在 worker 中等待，
+    否則拋出 DriveRateLimited，由呼叫端延後重試。
+
+    參數:
+        user_id (str): LINE 使用者 ID（每位使用者對應一個 Google 帳號）
+        client_id (str): OAuth client ID
+        cost (int): 預計發出的 Drive 請求數
+    """
+    waited = 0.0
+    while True:
+        wait = float(drive_rate_limit_script(
+            keys=[
+                f"drive_rl:user:{user_id}",
+                f"drive_rl:client:{client_id}",
+                f"drive_backoff:user:{user_id}",
+                f"drive_backoff:client:{client_id}",
+            ],
+            args=[
+                time.time(), cost,
+                DRIVE_RATE_LIMIT['USER_RATE'], DRIVE_RATE_LIMIT['USER_BURST'],
+                DRIVE_RATE_LIMIT['CLIENT_RATE'], DRIVE_RATE_LIMIT['CLIENT_BURST'],
+            ]
+        ))
+        if wait <= 0:
+            if waited:
+                incr_metric('drive_rate_limit_wait_seconds', waited)
+            return
+        if waited + wait > DRIVE_RATE_LIMIT['MAX_WAIT']:
+            incr_metric('drive_rate_limit_deferred')
+            raise DriveRateLimited(wait)
+        time.sleep(wait)
+        waited += wait
+
+def get_drive_error_reason(error):
+    """從 Drive 的 HttpError 取得錯誤原因（例如 userRateLimitExceeded），無法解析時回傳空字串"""
+    try:
+        details = json.loads(error.content.decode('utf-8'))
+        return details['error']['errors'][0].get('reason', '')
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return ''
+
+def record_drive_rate_limit(error, user_id, client_id):
+    """若 HttpError 為 Drive 頻率限制，記錄退避時間讓所有 worker 暫停對該帳號發出請求
+
+    退避時間優先採用回應中的 Retry-After，否則依連續被限制的次數做指數退避。
+
+    回傳:
+        float: 建議的重試等待秒數；不是頻率限制錯誤時回傳 None
+    """
+    status = error.resp.status
+    reason = get_drive_error_reason(error)
+    if status == 429 or reason == 'userRateLimitExceeded':
+        scope, scope_id = 'user', user_id
+    elif status == 403 and reason == 'rateLimitExceeded':
+        scope, scope_id = 'client', client_id
+    else:
+        return None
+
+    try:
+        hint = max(1.0, float(error.resp.get('retry-after')))
+    except (TypeError, ValueError):
+        strikes = redis_client.incr(f"drive_backoff_strikes:{scope}:{scope_id}")
+        redis_client.expire(f"drive_backoff_strikes:{scope}:{scope_id}", 600)
+        hint = min(64.0, 2.0 ** strikes) + random.uniform(0, 1)
+
+    redis_client.set(f"drive_backoff:{scope}:{scope_id}", 1, px=int(hint * 1000))
+    incr_metric('drive_rate_limited_responses')
+    return hint
+
+# 錯誤分類：決定任務要重試、直接放棄，或是需要使用者處理（例如重新綁定帳號）
+ERROR_RETRYABLE = 'retryable'
+ERROR_PERMANENT = 'permanent'
+ERROR_USER_ACTION = 'user_action'
+
+# Drive 403 錯誤原因分類
+DRIVE_RETRYABLE_REASONS = {'userRateLimitExceeded', 'rateLimitExceeded', 'backendError', 'internalError'}
+DRIVE_USER_ACTION_REASONS = {'storageQuotaExceeded', 'insufficientFilePermissions', 'insufficientPermissions',
+                             'domainPolicy', 'dailyLimitExceeded'}
+
+def classify_error(error):
+    """將 Drive / LINE 任務的例外分類
+
+    回傳:
+        str: ERROR_RETRYABLE、ERROR_PERMANENT 或 ERROR_USER_ACTION
+    """
+    if isinstance(error, (UserCredentialsError, RefreshError)):
+        return ERROR_USER_ACTION
+    if isinstance(error, (SoftTimeLimitExceeded, DriveRateLimited, ResumableSessionExpired, httplib2.HttpLib2Error,
+                          urllib3.exceptions.HTTPError)):
+        return ERROR_RETRYABLE
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 401:
+            return ERROR_USER_ACTION
+        if status == 403:
+            reason = get_drive_error_reason(error)
+            if reason in DRIVE_RETRYABLE_REASONS:
+                return ERROR_RETRYABLE
+            if reason in DRIVE_USER_ACTION_REASONS:
+                return ERROR_USER_ACTION
+            return ERROR_PERMANENT
+        # 404 時資料夾映射已被刪除，重試會重新建立資料夾
+        if status in (404, 408, 429) or status >= 500:
+            return ERROR_RETRYABLE
+        return ERROR_PERMANENT
+    if isinstance(error, ApiException):
+        if error.status in (408, 429) or (error.status or 0) >= 500 or not error.status:
+            return ERROR_RETRYABLE
+        return ERROR_PERMANENT
+    if isinstance(error, LineContentFailed):
+        return ERROR_PERMANENT
+    if isinstance(error, FileNotFoundError):
+        # 暫存檔已不存在，重試也無法成功
+        return ERROR_PERMANENT
+    if isinstance(error, OSError):
+        # 連線中斷、逾時等網路錯誤
+        return ERROR_RETRYABLE
+    return ERROR_PERMANENT
+
+def retry_backoff_countdown(retries, base=RETRY_BACKOFF_BASE):
+    """指數退避加上隨機抖動（full jitter），避免大量任務同時重試
+
+    參數:
+        retries (int): 目前已重試次數
+        base (float): 第一次重試的基準秒數
+    """
+    return 1 + random.uniform(0, min(RETRY_BACKOFF_MAX, base * 2 ** retries))
+
+DEAD_LETTER_KEY = 'dead_letter'
+
+def send_to_dead_letter(task_name, args, kwargs, error, classification):
+    """將不再重試的任務記錄到 dead-letter queue（Redis list，最新的在前）"""
+    entry = {
+        'task': task_name,
+        'args': args,
+        'kwargs': kwargs,
+        'error_type': type(error).__name__,
+        'error': str(error)[:1000],
+        'classification': classification,
+        'failed_at': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+    try:
+        pipe = redis_client.pipeline()
+        pipe.lpush(DEAD_LETTER_KEY, json.dumps(entry, ensure_ascii=False, default=str))
+        pipe.ltrim(DEAD_LETTER_KEY, 0, DEAD_LETTER_MAX_ENTRIES - 1)
+        pipe.execute()
+    except Exception as e:
+        logging.getLogger('celery').error("[DLQ] Failed to record dead letter for %s: %s", task_name, str(e))
+    incr_metric(f'dead_letter_{classification}')
+
+def task_deferrals(task):
+    """任務已延後重試的次數（記錄在 deferrals 參數，延後時由 defer_or_dead_letter 遞增）"""
+    return (task.request.kwargs or {}).get('deferrals', 0)
+
+def task_error_retries(task):
+    """任務因錯誤重試的次數（request.retries 也包含延後重試，需扣除）"""
+    return task.request.retries - task_deferrals(task)
+
+def retry_or_dead_letter(task, error, classification=None, countdown_base=RETRY_BACKOFF_BASE):
+    """可重試的錯誤以抖動指數退避重試（拋出 Retry），其餘送進 dead-letter queue 後返回
+
+    重試次數只計算錯誤重試，頻率限制或轉檔等待造成的延後重試不佔用 task.max_retries。
+    直接呼叫任務（非經由 worker）時不重試也不記錄，交由呼叫端處理例外。
+    """
+    if task.request.called_directly:
+        return
+    classification = classification or classify_error(error)
+    error_retries = task_error_retries(task)
+    if classification == ERROR_RETRYABLE and error_retries < task.max_retries:
+        raise task.retry(exc=error, countdown=retry_backoff_countdown(error_retries, countdown_base),
+                         max_retries=task.max_retries + task_deferrals(task))
+    logging.getLogger('celery').error("[DLQ] %s gave up (%s): %s", task.name, classification, str(error))
+    send_to_dead_letter(task.name, task.request.args, task.request.kwargs, error, classification)
+
+def defer_or_dead_letter(task, error, countdown, max_deferrals, **kwargs):
+    """因頻率限制等暫時狀況延後重試（拋出 Retry，不計入失敗重試）
+
+    延後次數記錄在任務的 deferrals 參數（任務需接受此參數），用完時送進 dead-letter queue 後返回，
+    由呼叫端走最終失敗的處理。直接呼叫任務（非經由 worker）時不重試也不記錄。
+
+    參數:
+        task: 綁定的 Celery task 物件
+        error (Exception): 造成延後的例外
+        countdown (float): 延後秒數
+        max_deferrals (int): 在 task.max_retries 之外允許的延後次數
+        **kwargs: 重試時要覆寫的任務參數
+    """
+    if task.request.called_directly:
+        return
+    deferrals = task_deferrals(task)
+    if deferrals < max_deferrals:
+        raise task.retry(exc=error, countdown=countdown,
+                         kwargs={**(task.request.kwargs or {}), **kwargs, 'deferrals': deferrals + 1},
+                         max_retries=task.max_retries + max_deferrals)
+    logging.getLogger('celery').error("[DLQ] %s gave up after %d deferrals: %s", task.name, deferrals, str(error))
+    send_to_dead_letter(task.name, task.request.args, task.request.kwargs, error, ERROR_RETRYABLE)
+
 def reply_message(reply_token, messages):
-    with ApiClient(configuration) as api_client:
+    with line_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         line_bot_api.reply_message_with_http_info(
             ReplyMessageRequest(
@@ -93,8 +537,295 @@ def reply_message(reply_token, messages):
             )
         )
 
+def push_message(to, messages):
+    with line_api_client() as api_client:
+        line_bot_api = MessagingApi(api_client)
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=to,
+                messages=messages
+            )
+        )
+
+def send_reply(reply_token, to, messages, reply_deadline=None):
+    """回覆訊息，若 reply token 已經（或即將）過期則改用 push message
+
+    參數:
+        reply_token (str): LINE 回覆令牌
+        to (str): 改用 push message 時的傳送對象（使用者或群組 ID）
+        messages (list): 要發送的訊息列表
+        reply_deadline (float): reply token 的到期時間（epoch 秒），None 表示未知
+    """
+    logger = logging.getLogger('celery')
+    if reply_token and (reply_deadline is None or time.time() < reply_deadline - REPLY_DEADLINE_MARGIN):
+        try:
+            reply_message(reply_token, messages)
+            return
+        except ApiException as e:
+            logger.warning("[LINE] Reply failed (status=%s), falling back to push message", e.status)
+            incr_metric('reply_failed_push_fallback')
+    else:
+        logger.info("[LINE] Reply deadline passed, using push message for %s", to)
+        incr_metric('reply_deadline_push_fallback')
+
+    try:
+        push_message(to, messages)
+    except Exception as e:
+        logger.error("[LINE] Push message fallback failed for %s: %s", to, str(e))
+        incr_metric('reply_lost')
+
+def get_upload_size_class(size):
+    """依檔案大小取得 UPLOAD_SIZE_CLASSES 中的級別，大小未知時視為最小級別"""
+    for size_class in UPLOAD_SIZE_CLASSES:
+        if size is None or size_class['MAX_BYTES'] is None or size <= size_class['MAX_BYTES']:
+            return size_class
+    return UPLOAD_SIZE_CLASSES[-1]
+
+def upload_task_options(size, user_id=None):
+    """依檔案大小產生上傳任務的 apply_async / signature 選項（佇列與時間限制）
+
+    最小級別的檔案在啟用分片時依目標使用者送到固定的分片佇列。
+    """
+    size_class = get_upload_size_class(size)
+    queue = size_class['QUEUE']
+    if user_id and size_class is UPLOAD_SIZE_CLASSES[0]:
+        queue = get_upload_queue(user_id, queue)
+    return {
+        'queue': queue,
+        'time_limit': size_class['TIME_LIMIT'],
+        'soft_time_limit': size_class['SOFT_TIME_LIMIT'],
+    }
+
+# 上傳分片：分片 worker 定期在 sorted set 中更新自己的到期時間，路由只使用仍存活的分片
+UPLOAD_SHARD_PREFIX = 'upload-shard-'
+UPLOAD_SHARD_MEMBERS_KEY = 'upload_shards'
+_shard_ring = {'expires_at': 0, 'ring': []}
+
+def shard_hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+def get_upload_shard_ring():
+    """取得存活分片組成的一致性雜湊環（每個行程快取幾秒）
+
+    分片加入或離線時只有雜湊環上相鄰區段的使用者會換到其他分片。
+    """
+    now = time.time()
+    if _shard_ring['expires_at'] > now:
+        return _shard_ring['ring']
+    try:
+        shards = redis_client.zrangebyscore(UPLOAD_SHARD_MEMBERS_KEY, now, '+inf')
+    except Exception as e:
+        logging.getLogger('celery').warning("[SHARD] Failed to load live shards: %s", str(e))
+        shards = []
+    _shard_ring['ring'] = sorted(
+        (shard_hash(f"{shard}#{vnode}"), shard)
+        for shard in shards
+        for vnode in range(UPLOAD_SHARD_VNODES)
+    )
+    _shard_ring['expires_at'] = now + UPLOAD_SHARD_HEARTBEAT_INTERVAL / 2
+    return _shard_ring['ring']
+
+def get_upload_queue(user_id, default):
+    """依使用者 ID 在雜湊環上找出負責的分片佇列；未啟用分片或沒有存活分片時回傳 default"""
+    if not UPLOAD_SHARDS:
+        return default
+    ring = get_upload_shard_ring()
+    if not ring:
+        return default
+    index = bisect.bisect(ring, (shard_hash(user_id), '')) % len(ring)
+    return ring[index][1]
+
+_shard_heartbeat = {'queues': [], 'stop': threading.Event()}
+
+def send_upload_shard_heartbeat(queues):
+    expires_at = time.time() + UPLOAD_SHARD_TTL
+    pipe = redis_client.pipeline()
+    pipe.zadd(UPLOAD_SHARD_MEMBERS_KEY, {queue: expires_at for queue in queues})
+    pipe.zremrangebyscore(UPLOAD_SHARD_MEMBERS_KEY, '-inf', time.time())
+    pipe.execute()
+
+@worker_ready.connect
+def start_upload_shard_heartbeat(sender=None, **kwargs):
+    """消費分片佇列的 worker 啟動後，在背景定期回報存活"""
+    queues = [queue.name for queue in sender.task_consumer.queues if queue.name.startswith(UPLOAD_SHARD_PREFIX)]
+    if not queues:
+        return
+    _shard_heartbeat['queues'] = queues
+    logger = logging.getLogger('celery')
+    logger.info("[SHARD] Serving upload shards: %s", ', '.join(queues))
+
+    def heartbeat():
+        while not _shard_heartbeat['stop'].is_set():
+            try:
+                send_upload_shard_heartbeat(queues)
+            except Exception as e:
+                logger.warning("[SHARD] Heartbeat failed: %s", str(e))
+            _shard_heartbeat['stop'].wait(UPLOAD_SHARD_HEARTBEAT_INTERVAL)
+
+    threading.Thread(target=heartbeat, name='upload-shard-heartbeat', daemon=True).start()
+
+@worker_shutdown.connect
+def stop_upload_shard_heartbeat(**kwargs):
+    """正常關閉時立即移出雜湊環，新任務改送到其他分片"""
+    if not _shard_heartbeat['queues']:
+        return
+    _shard_heartbeat['stop'].set()
+    try:
+        redis_client.zrem(UPLOAD_SHARD_MEMBERS_KEY, *_shard_heartbeat['queues'])
+    except Exception as e:
+        logging.getLogger('celery').warning("[SHARD] Failed to leave shard ring: %s", str(e))
+
+_broker_redis = None
+
+def get_broker_redis():
+    """Celery broker 所在的 Redis（與快取用的 redis_client 不同 DB）"""
+    global _broker_redis
+    if _broker_redis is None:
+        _broker_redis = Redis.from_url(CELERY_BROKER_URL)
+    return _broker_redis
+
+@celery.task(acks_late=True)
+def drain_offline_upload_shards():
+    """把已離線分片佇列中剩下的任務移到一般的 upload 佇列
+
+    分片離線後新任務會改送到其他分片，但已經排入該分片佇列的任務沒有 worker 處理；
+    這裡把它們（依優先權各自對應）移到所有上傳 worker 都會處理的 upload 佇列。
+    worker 異常結束時未 ack 的任務會在可見性逾時後回到原佇列，下一輪再移走。
+
+    回傳:
+        int: 移動的任務數
+    """
+    if not UPLOAD_SHARDS or not CELERY_BROKER_URL.startswith('redis'):
+        return 0
+    logger = logging.getLogger('celery')
+    live = set(redis_client.zrangebyscore(UPLOAD_SHARD_MEMBERS_KEY, time.time(), '+inf'))
+    options = celery.conf.broker_transport_options
+    sep = options.get('sep', ':')
+    broker = get_broker_redis()
+
+    moved = 0
+    for shard in range(UPLOAD_SHARDS):
+        queue = f'{UPLOAD_SHARD_PREFIX}{shard}'
+        if queue in live:
+            continue
+        shard_moved = 0
+        for step in options.get('priority_steps', [0]):
+            source = f"{queue}{sep}{step}" if step else queue
+            target = f"upload{sep}{step}" if step else 'upload'
+            # kombu 以 LPUSH 發佈、從右端取出，RPOPLPUSH 會依原本順序移到 upload 佇列
+            while broker.rpoplpush(source, target) is not None:
+                shard_moved += 1
+        if shard_moved:
+            logger.warning("[SHARD] Moved %d queued tasks from offline shard %s to upload", shard_moved, queue)
+        moved += shard_moved
+    if moved:
+        incr_metric('upload_shard_drained_tasks', moved)
+    return moved
+
+@worker_process_init.connect
+def warm_up_worker_process(**kwargs):
+    """prefork 子行程啟動時先建立連線並載入常用資源，自動擴充或重新啟動後的第一個任務不必負擔這些成本
+
+    在背景執行緒中進行：worker_process_init 必須在 worker_proc_alive_timeout（預設 4 秒）內返回，
+    否則子行程會被視為啟動失敗而終止，資料庫或 Redis 緩慢時會不斷重啟。
+    """
+    threading.Thread(target=run_worker_warm_up, name='worker-warm-up', daemon=True).start()
+
+def run_worker_warm_up():
+    """依序開啟資料庫連線池（含唯讀副本）、連上 Redis、載入 Drive discovery 文件、建立 LINE ApiClient，
+    並預先取得上傳分片的雜湊環。任何一步失敗只記錄警告，留待第一個任務時再處理。
+    所花的時間記錄在指標 worker_warmup_seconds（累計）與 worker_warmups（次數）。
+    """
+    logger = logging.getLogger('celery')
+    started = time.monotonic()
+
+    def open_db_pools():
+        get_db_connection().close()
+        if get_db_pool('replica') is not None:
+            get_db_pool('replica').connection().close()
+            get_replica_lag()
+
+    def load_shard_ring():
+        if UPLOAD_SHARDS:
+            get_upload_shard_ring()
+
+    steps = (
+        ('db', open_db_pools),
+        ('redis', redis_client.ping),
+        ('drive', load_drive_discovery_doc),
+        ('line', get_line_api_client),
+        ('shards', load_shard_ring),
+    )
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.warning("[WARMUP] %s warm-up failed: %s", name, str(e))
+
+    elapsed = time.monotonic() - started
+    incr_metric('worker_warmups')
+    incr_metric('worker_warmup_seconds', round(elapsed, 3))
+    logger.info("[WARMUP] Worker process %s warmed up in %.2fs", os.getpid(), elapsed)
+
+# worker 行程內快取：搭配分片路由，同一使用者的任務集中在同一個 worker，快取較容易命中
+# 以 LRU 限制筆數（WORKER_CACHE_MAX_ENTRIES），並定期清除過期項目，避免每個行程的記憶體無限成長
+_process_cache = OrderedDict()
+_process_cache_lock = threading.Lock()
+_process_cache_next_sweep = [0.0]
+
+def _sweep_process_cache(now):
+    """清除所有過期項目（每 WORKER_CACHE_TTL / 5 秒最多執行一次，需持有 _process_cache_lock）"""
+    if now < _process_cache_next_sweep[0]:
+        return
+    for key in [key for key, (_, expires_at) in _process_cache.items() if expires_at <= now]:
+        del _process_cache[key]
+    _process_cache_next_sweep[0] = now + WORKER_CACHE_TTL / 5
+
+def process_cache_get(key):
+    now = time.time()
+    with _process_cache_lock:
+        entry = _process_cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del _process_cache[key]
+            return None
+        _process_cache.move_to_end(key)
+        return entry[0]
+
+def process_cache_set(key, value, ttl=WORKER_CACHE_TTL):
+    now = time.time()
+    with _process_cache_lock:
+        _process_cache[key] = (value, now + ttl)
+        _process_cache.move_to_end(key)
+        _sweep_process_cache(now)
+        while len(_process_cache) > WORKER_CACHE_MAX_ENTRIES:
+            _process_cache.popitem(last=False)
+
+def process_cache_pop(key):
+    with _process_cache_lock:
+        _process_cache.pop(key, None)
+
+def deadline_priority(reply_deadline):
+    """依 reply token 剩餘時間換算佇列優先權，越接近期限越優先（最早期限優先）
+
+    可用時間為 REPLY_TOKEN_TTL - REPLY_DEADLINE_MARGIN（之後改用 push message），
+    平均分成 DEFAULT_TASK_PRIORITY 個等級：剛收到的事件為 8，LINE 延遲送達或重送的事件依剩餘時間往前排。
+
+    參數:
+        reply_deadline (float): reply token 的到期時間（epoch 秒），None 表示沒有期限
+
+    回傳:
+        int: 0~8 為有期限的任務，沒有期限時回傳 DEFAULT_TASK_PRIORITY
+    """
+    if reply_deadline is None:
+        return DEFAULT_TASK_PRIORITY
+    usable = reply_deadline - REPLY_DEADLINE_MARGIN - time.time()
+    window = max(1, REPLY_TOKEN_TTL - REPLY_DEADLINE_MARGIN)
+    return max(0, min(DEFAULT_TASK_PRIORITY - 1, int(usable * DEFAULT_TASK_PRIORITY / window)))
+
 def reply_loading_animation(chat_id, seconds=5):
-    with ApiClient(configuration) as api_client:
+    with line_api_client() as api_client:
         line_bot_api = MessagingApi(api_client)
         # 顯示載入動畫
         request = ShowLoadingAnimationRequest(chatId=chat_id, loadingSeconds=seconds)
@@ -103,7 +834,86 @@ def reply_loading_animation(chat_id, seconds=5):
 
 def get_db_connection():
     """從連線池取得資料庫連線"""
-    return db_pool.connection()
+    return get_db_pool().connection()
+
+# 唯讀副本的複寫延遲快取：(延遲秒數, 檢查時間)
+_replica_lag = (None, 0)
+
+def get_replica_lag():
+    """取得唯讀副本的複寫延遲（秒），每個行程每 REPLICA_LAG_CHECK_INTERVAL 秒才實際查詢一次
+
+    回傳:
+        float: 延遲秒數；複寫已停止或無法查詢時回傳 inf
+    """
+    global _replica_lag
+    lag, checked_at = _replica_lag
+    if lag is not None and time.time() - checked_at < DATABASE.get('REPLICA_LAG_CHECK_INTERVAL', 10):
+        return lag
+
+    lag = float('inf')
+    try:
+        conn = get_db_pool('replica').connection()
+        try:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                try:
+                    cursor.execute('SHOW REPLICA STATUS')
+                except pymysql.err.ProgrammingError:
+                    cursor.execute('SHOW SLAVE STATUS')  # MySQL 8.0.22 之前的語法
+                status = cursor.fetchone()
+        finally:
+            conn.close()
+        if status is None:
+            # 不是複寫副本（例如經由代理連到同步的節點），視為沒有延遲
+            lag = 0.0
+        else:
+            seconds = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+            if seconds is not None:
+                lag = float(seconds)
+    except Exception as e:
+        logging.getLogger('celery').warning("[DB] Failed to check replica lag: %s", str(e))
+
+    _replica_lag = (lag, time.time())
+    return lag
+
+def recent_write_key(user_id):
+    return f"recent_write:{user_id}"
+
+def mark_recent_write(*user_ids):
+    """記錄使用者剛變更過資料，REPLICA_MAX_LAG 秒內的報表查詢改讀主資料庫（避免讀到副本的舊資料）"""
+    if get_db_pool('replica') is None or not user_ids:
+        return
+    pipe = redis_client.pipeline()
+    for user_id in user_ids:
+        pipe.set(recent_write_key(user_id), 1, ex=max(1, int(DATABASE.get('REPLICA_MAX_LAG', 10))))
+    pipe.execute()
+
+def get_read_connection(user_id=None):
+    """取得唯讀查詢用的資料庫連線
+
+    有設定唯讀副本且複寫延遲在 REPLICA_MAX_LAG 以內時使用副本，否則改用主資料庫。
+    呼叫端只能執行查詢，不可寫入。
+
+    參數:
+        user_id (str): 查詢對象的 LINE 使用者 ID，該使用者剛變更過資料時直接讀主資料庫
+    """
+    replica_pool = get_db_pool('replica')
+    if replica_pool is None:
+        return get_db_connection()
+    logger = logging.getLogger('celery')
+    try:
+        if user_id and redis_client.exists(recent_write_key(user_id)):
+            incr_metric('db_replica_fallback_recent_write')
+            return get_db_connection()
+        lag = get_replica_lag()
+        if lag <= DATABASE.get('REPLICA_MAX_LAG', 10):
+            conn = replica_pool.connection()
+            incr_metric('db_replica_reads')
+            return conn
+        logger.warning("[DB] Replica lag %.0fs exceeds limit, reading from primary", lag)
+    except Exception as e:
+        logger.warning("[DB] Replica unavailable, reading from primary: %s", str(e))
+    incr_metric('db_replica_fallback')
+    return get_db_connection()
 
 def get_user_credentials(user_id):
     """從資料庫取得使用者的 Google OAuth 憑證
@@ -127,6 +937,206 @@ def get_user_credentials(user_id):
         conn.close()
     return None
 
+# 群組綁定使用者快取：Redis set 中除了使用者 ID 外另放一個哨兵值，
+# 用來區分「快取中沒有使用者」與「尚未建立快取」（Redis 不保存空集合）
+# 綁定、解除綁定時遞增群組的 generation，從資料庫重建快取時只有 generation 未變才寫入，
+# 避免查詢後才完成的解除綁定被舊的成員名單覆蓋
+GROUP_USERS_SENTINEL = '*'
+
+SET_GROUP_USERS_IF_GENERATION_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+  return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('SADD', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+set_group_users_if_generation_script = redis_client.register_script(SET_GROUP_USERS_IF_GENERATION_LUA)
+
+ADD_IF_CACHED_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return redis.call('SADD', KEYS[1], ARGV[1])
+end
+return 0
+"""
+add_if_cached_script = redis_client.register_script(ADD_IF_CACHED_LUA)
+
+def group_users_key(group_id):
+    return f"group_users:{group_id}"
+
+def group_users_generation_key(group_id):
+    return f"group_users_gen:{group_id}"
+
+def get_group_users_generation(group_id):
+    """取得群組綁定使用者快取的 generation（尚未遞增過時為空字串）"""
+    return redis_client.get(group_users_generation_key(group_id)) or ''
+
+def bump_group_users_generation(pipe, group_id):
+    """在 pipeline 中遞增群組的 generation，讓進行中的快取重建放棄寫入"""
+    key = group_users_generation_key(group_id)
+    pipe.incr(key)
+    pipe.expire(key, GROUP_USERS_CACHE_TTL)
+
+def cache_set_group_users(group_id, user_ids, generation=None):
+    """以 user_ids 覆寫群組的綁定使用者快取
+
+    參數:
+        generation (str): 查詢資料庫前取得的 generation，不同時表示期間有綁定變更，放棄寫入；
+                          None 表示 user_ids 為最新狀態，直接覆寫並遞增 generation
+
+    回傳:
+        bool: 是否已寫入快取
+    """
+    key = group_users_key(group_id)
+    if generation is not None:
+        return bool(set_group_users_if_generation_script(
+            keys=[key, group_users_generation_key(group_id)],
+            args=[generation, GROUP_USERS_CACHE_TTL, GROUP_USERS_SENTINEL, *user_ids]
+        ))
+    pipe = redis_client.pipeline()
+    bump_group_users_generation(pipe, group_id)
+    pipe.delete(key)
+    pipe.sadd(key, GROUP_USERS_SENTINEL, *user_ids)
+    pipe.expire(key, GROUP_USERS_CACHE_TTL)
+    pipe.execute()
+    return True
+
+def cache_add_group_user(group_id, user_id):
+    """綁定群組後同步更新快取（快取不存在時不建立，下次讀取時再從資料庫重建）"""
+    pipe = redis_client.pipeline()
+    bump_group_users_generation(pipe, group_id)
+    pipe.execute()
+    add_if_cached_script(keys=[group_users_key(group_id)], args=[user_id])
+    invalidate_report_cache(user_id)
+
+def cache_remove_group_user(group_id, user_id):
+    """解除綁定群組後同步更新快取"""
+    pipe = redis_client.pipeline()
+    bump_group_users_generation(pipe, group_id)
+    pipe.srem(group_users_key(group_id), user_id)
+    pipe.execute()
+    invalidate_report_cache(user_id)
+
+# 報表快取：依使用者保存 !listgroup / !showcompletegroup 組好的回覆訊息
+# 清除快取時遞增使用者的報表版本號，查詢前取得的版本號不同時不寫入，避免舊的報表覆蓋清除
+REPORT_CACHE_KINDS = ('listgroup', 'showcompletegroup')
+
+SET_REPORT_IF_VERSION_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+  return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+set_report_if_version_script = redis_client.register_script(SET_REPORT_IF_VERSION_LUA)
+
+def report_cache_key(user_id, kind):
+    return f"report_cache:{user_id}:{kind}"
+
+def report_version_key(user_id):
+    return f"report_version:{user_id}"
+
+def get_report_version(user_id):
+    """在查詢報表資料前取得版本號（無法讀取時回傳 None，這次不寫入快取）"""
+    try:
+        return redis_client.get(report_version_key(user_id)) or ''
+    except Exception as e:
+        logging.getLogger('celery').warning("[CACHE] Failed to read report version for %s: %s", user_id, str(e))
+        return None
+
+def get_cached_report(user_id, kind):
+    """取得快取的報表訊息
+
+    回傳:
+        list: LINE 訊息物件列表，快取不存在或無法讀取時回傳 None
+    """
+    try:
+        cached = redis_client.get(report_cache_key(user_id, kind))
+        if cached is None:
+            return None
+        return [Message.from_dict(message) for message in json.loads(cached)]
+    except Exception as e:
+        logging.getLogger('celery').warning("[CACHE] Failed to read %s report for %s: %s", kind, user_id, str(e))
+        return None
+
+def cache_report(user_id, kind, messages, version):
+    """保存組好的報表訊息，REPORT_CACHE_TTL 後過期
+
+    快取只是加速用，寫入失敗時記錄警告，不影響回覆。
+
+    參數:
+        version (str): 查詢報表資料前以 get_report_version 取得的版本號，期間有清除快取時不寫入
+    """
+    if version is None:
+        return
+    try:
+        payload = json.dumps([message.to_dict() for message in messages], ensure_ascii=False)
+        set_report_if_version_script(keys=[report_cache_key(user_id, kind), report_version_key(user_id)],
+                                     args=[version, payload, REPORT_CACHE_TTL])
+    except Exception as e:
+        logging.getLogger('celery').warning("[CACHE] Failed to save %s report for %s: %s", kind, user_id, str(e))
+
+def invalidate_report_cache(*user_ids):
+    """綁定、解除綁定或資料夾映射變更後清除使用者的報表快取"""
+    keys = [report_cache_key(user_id, kind) for user_id in user_ids for kind in REPORT_CACHE_KINDS]
+    if keys:
+        pipe = redis_client.pipeline()
+        for user_id in user_ids:
+            pipe.incr(report_version_key(user_id))
+            pipe.expire(report_version_key(user_id), REPORT_CACHE_TTL)
+        pipe.delete(*keys)
+        pipe.execute()
+    # 副本可能還沒複寫到這次變更，短時間內重建報表時改讀主資料庫
+    mark_recent_write(*user_ids)
+
+def get_group_bound_users(group_id):
+    """取得群組的綁定使用者
+
+    優先讀取 Redis 快取；快取不存在時從資料庫查詢並重建快取。
+
+    參數:
+        group_id (str): LINE 群組 ID
+
+    回傳:
+        set: 綁定此群組的 LINE 使用者 ID
+    """
+    members = redis_client.smembers(group_users_key(group_id))
+    if members:
+        return members - {GROUP_USERS_SENTINEL}
+
+    incr_metric('group_users_cache_miss')
+    generation = get_group_users_generation(group_id)
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT user_id FROM group_users WHERE group_id = %s', (group_id,))
+            user_ids = {row[0] for row in cursor.fetchall()}
+    finally:
+        conn.close()
+    if not cache_set_group_users(group_id, user_ids, generation):
+        # 查詢期間有綁定變更，這次的結果可能已過時，留給下次讀取重建
+        incr_metric('group_users_cache_rebuild_skipped')
+    return user_ids
+
+def folder_map_version_key(source_id):
+    return f"folder_map_version:{source_id}"
+
+def get_folder_map_version(source_id):
+    """取得來源資料夾映射的版本號（Redis 無法使用時回傳 None，視為快取失效）"""
+    try:
+        return redis_client.get(folder_map_version_key(source_id)) or '0'
+    except Exception:
+        return None
+
+def bump_folder_map_version(*source_ids):
+    """刪除 folder_map 後呼叫，讓所有行程中快取的資料夾 ID 失效"""
+    if source_ids:
+        pipe = redis_client.pipeline()
+        for source_id in source_ids:
+            pipe.incr(folder_map_version_key(source_id))
+        pipe.execute()
+
 def delete_folder_map(source_id, user_id):
     """從資料庫中刪除指定的資料夾映射關係
     
@@ -137,11 +1147,19 @@ def delete_folder_map(source_id, user_id):
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
+            cursor.execute("SELECT folder_id FROM folder_map WHERE source_id = %s AND user_id = %s", (source_id, user_id))
+            folder_ids = [row[0] for row in cursor.fetchall()]
             sql = "DELETE FROM folder_map WHERE source_id = %s AND user_id = %s"
             cursor.execute(sql, (source_id, user_id))
+            cursor.execute("DELETE FROM folder_month_map WHERE source_id = %s AND user_id = %s", (source_id, user_id))
         conn.commit()
     finally:
         conn.close()
+    process_cache_pop(('folder_id', source_id, user_id))
+    bump_folder_map_version(source_id)
+    if folder_ids:
+        redis_client.hdel(drive_folder_names_key(user_id), *folder_ids)
+    invalidate_report_cache(user_id)
 
 def get_source_name(source_type, source_id):
     """更新或建立來源名稱記錄
@@ -157,7 +1175,7 @@ def get_source_name(source_type, source_id):
     
     try:
         # 從 LINE API 取得最新名稱
-        with ApiClient(configuration) as api_client:
+        with line_api_client() as api_client:
             line_bot_api = MessagingApi(api_client)
             
             if source_type == 'group':
@@ -231,6 +1249,12 @@ def get_or_create_folder_for_source_id(source_type, source_id, target_user_id, d
 
     回傳資料夾 ID (str) 或 None 表示失敗。
     """
+    # 快取的資料夾 ID 帶有 folder_map 版本號，其他行程刪除映射後版本不同即視為失效
+    version = get_folder_map_version(source_id)
+    cached = process_cache_get(('folder_id', source_id, target_user_id))
+    if cached and version is not None and cached[1] == version:
+        return cached[0]
+
     # 取得群組或使用者名稱（若無法取得，就用 source_id）
     folder_name = get_source_name(source_type, source_id) or source_id
 
@@ -274,8 +1298,17 @@ def get_or_create_folder_for_source_id(source_type, source_id, target_user_id, d
             
             # 提交交易，釋放鎖
             conn.commit()
+            if not row:
+                invalidate_report_cache(target_user_id)
+            if version is not None:
+                process_cache_set(('folder_id', source_id, target_user_id), (folder_id, version))
             return folder_id
 
+    except (HttpError, RefreshError):
+        # Drive 錯誤交給上傳任務判斷（資料夾不存在、頻率限制、認證失效等）
+        conn.rollback()
+        raise
+
     except Exception as e:
         conn.rollback()
         logger.error(f"Failed to create/get folder (source_id={source_id}, user={target_user_id}): {e}")
@@ -284,176 +1317,1124 @@ def get_or_create_folder_for_source_id(source_type, source_id, target_user_id, d
     finally:
         conn.close()
 
-@celery.task(
-    time_limit=300,
-    soft_time_limit=270,
-    autoretry_for=(ConnectionError, SoftTimeLimitExceeded, HttpError, ),
-    retry_kwargs={'max_retries': 3, 'countdown': 10},
-    retry_backoff=True,
-    bind=True
-)
-def upload_file_to_drive_task(self, dist_path, dist_name, source_type, source_id, target_user_id, reply_token=None,retry=False):
-    """上傳檔案到使用者的 Google Drive
-    
-    參數:
-        self: Celery task 物件
-        dist_path (str): 暫存檔案路徑
-        dist_name (str): 目標檔案名稱
-        source_type (str): 來源類型（'group' 或 'user'）
-        source_id (str): 來源 ID
-        target_user_id (str): 目標使用者 ID
-        reply_token (str): 回應 token
+def get_month_folder(drive_service, folder_id, source_id, target_user_id, client_id, logger):
+    """DRIVE_FOLDER_LAYOUT = 'monthly' 時取得（或建立）來源資料夾下本月的 YYYY/MM 子資料夾
+
+    子資料夾 ID 依 (來源資料夾, 月份) 快取在行程內並記錄在 folder_month_map，
+    來源資料夾更換後舊的記錄不再相符，會重新建立。快取帶有 folder_map 版本號，
+    刪除映射（例如資料夾被刪除回報 404）後所有行程的快取一併失效。
+    建立時鎖定 folder_map 的對應列，同一 (來源, 使用者) 同時只有一個任務建立資料夾。
+
+    參數:
+        drive_service: Google Drive service
+        folder_id (str): folder_map 中的來源資料夾 ID
+        source_id (str): 來源 ID
+        target_user_id (str): 目標使用者 ID
+        client_id (str): OAuth client ID（建立資料夾時取得額外的 Drive 請求額度）
+
+    回傳:
+        str: 上傳目標資料夾 ID
+    """
+    if DRIVE_FOLDER_LAYOUT != 'monthly':
+        return folder_id
+    month = datetime.datetime.now().strftime('%Y-%m')
+    version = get_folder_map_version(source_id)
+    cache_key = ('month_folder', folder_id, month)
+    cached = process_cache_get(cache_key)
+    if cached and version is not None and cached[1] == version:
+        return cached[0]
+
+    select_sql = 'SELECT parent_folder_id, folder_id FROM folder_month_map WHERE source_id = %s AND user_id = %s AND month = %s'
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(select_sql, (source_id, target_user_id, month))
+            row = cursor.fetchone()
+            if row and row[0] == folder_id:
+                month_folder_id = row[1]
+            else:
+                # 本月第一次上傳：鎖定 folder_map 列後再確認一次，避免並行任務各自建立重複的資料夾
+                cursor.execute("START TRANSACTION")
+                cursor.execute(
+                    'SELECT folder_id FROM folder_map WHERE source_id = %s AND user_id = %s FOR UPDATE',
+                    (source_id, target_user_id)
+                )
+                cursor.execute(select_sql, (source_id, target_user_id, month))
+                row = cursor.fetchone()
+                if row and row[0] == folder_id:
+                    month_folder_id = row[1]
+                    logger.info("[RowLock] Month folder created by another task: %s (source_id=%s, user_id=%s)",
+                                month_folder_id, source_id, target_user_id)
+                else:
+                    acquire_drive_quota(target_user_id, client_id, cost=4)
+                    year, month_number = month.split('-')
+                    year_folder_id = get_or_create_folder_by_name(drive_service, year, parent_id=folder_id)
+                    month_folder_id = get_or_create_folder_by_name(drive_service, month_number, parent_id=year_folder_id)
+                    cursor.execute('''
+                        INSERT INTO folder_month_map (source_id, user_id, month, parent_folder_id, folder_id)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE parent_folder_id = VALUES(parent_folder_id), folder_id = VALUES(folder_id)
+                    ''', (source_id, target_user_id, month, folder_id, month_folder_id))
+                    logger.info("[DRIVE] Created month folder %s/%s: %s (source_id=%s, user_id=%s)",
+                                year, month_number, month_folder_id, source_id, target_user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if version is not None:
+        process_cache_set(cache_key, (month_folder_id, version))
+    return month_folder_id
+
+def prepare_drive_folder(user_creds, source_type, source_id, target_user_id, current_name, logger, cost=3):
+    """建立 Drive service 並取得來源專屬資料夾，來源名稱變更時同步更新資料夾名稱
+
+    DRIVE_FOLDER_LAYOUT = 'monthly' 時回傳來源資料夾下本月的 YYYY/MM 子資料夾。
+
+    參數:
+        user_creds (Credentials): 使用者的 Google OAuth 憑證
+        source_type (str): 來源類型（'group' 或 'user'）
+        source_id (str): 來源 ID
+        target_user_id (str): 目標使用者 ID
+        current_name (str): 來源目前的名稱，None 時不檢查資料夾名稱
+        logger: 日誌記錄器
+        cost (int): 預先取得的 Drive 請求額度（資料夾查詢、改名、上傳）
+
+    回傳:
+        tuple: (Drive service, 上傳目標資料夾 ID)
+    """
+    # 同一份授權的 Drive service 在行程內重複使用，省去每次 build 的成本
+    service_key = ('drive_service', target_user_id, user_creds.refresh_token)
+    service = process_cache_get(service_key)
+    if service is None:
+        service = build_drive_service(user_creds)
+        process_cache_set(service_key, service)
+    acquire_drive_quota(target_user_id, user_creds.client_id, cost=cost)
+
+    folder_id = get_or_create_folder_for_source_id(source_type, source_id, target_user_id, service, logger)
+    if not folder_id:
+        logger.error("[DRIVE] Failed to get/create folder for source_id=%s, user_id=%s",
+                    source_id, target_user_id)
+        raise Exception("Failed to get/create folder")
+
+    # 在上傳前檢查並更新資料夾名稱（最近確認過相同名稱時略過）
+    if current_name and process_cache_get(('folder_name', folder_id)) != current_name:
+        try:
+            # 先取得現有資料夾資訊
+            folder_metadata = service.files().get(fileId=folder_id, fields='name').execute()
+            existing_name = folder_metadata.get('name')
+
+            # 只在名稱不同時才更新
+            if existing_name != current_name:
+                service.files().update(
+                    fileId=folder_id,
+                    body={'name': current_name}
+                ).execute()
+                logger.info(f"Updated folder name: {existing_name} -> {current_name}")
+            else:
+                logger.debug(f"Folder name unchanged: {existing_name}")
+            process_cache_set(('folder_name', folder_id), current_name)
+        except Exception as e:
+            logger.warning(f"Failed to update folder name: {str(e)}")
+
+    return service, get_month_folder(service, folder_id, source_id, target_user_id, user_creds.client_id, logger)
+
+def upload_spool_file(service, folder_id, spool_key, dist_name, target_user_id, client_id, logger):
+    """從暫存區取得本機副本並上傳到指定資料夾（可從上次中斷的位置續傳），並更新空間快照
+
+    回傳:
+        str: Drive 檔案 ID
+    """
+    with get_spool_backend().local_copy(spool_key) as dist_path:
+        file_metadata = {
+            'name': dist_name,
+            'parents': [folder_id]
+        }
+        file = upload_media_resumable(
+            service, dist_path, file_metadata,
+            f"drive_resume:{target_user_id}:{spool_key}",
+            target_user_id, client_id, logger
+        )
+        add_cached_drive_usage(target_user_id, os.path.getsize(dist_path))
+    return file.get('id')
+
+@celery.task(
+    time_limit=UPLOAD_SIZE_CLASSES[0]['TIME_LIMIT'],  # 預設為最小級別，分派時依檔案大小覆寫
+    soft_time_limit=UPLOAD_SIZE_CLASSES[0]['SOFT_TIME_LIMIT'],
+    max_retries=3,
+    bind=True
+)
+def upload_file_to_drive_task(self, spool_key, dist_name, source_type, source_id, target_user_id, reply_token=None, retry=False, reply_deadline=None, deferrals=0, release_ref=True):
+    """上傳檔案到使用者的 Google Drive
+    
+    參數:
+        self: Celery task 物件
+        spool_key (str): 暫存區中的檔案 key
+        dist_name (str): 目標檔案名稱
+        source_type (str): 來源類型（'group' 或 'user'）
+        source_id (str): 來源 ID
+        target_user_id (str): 目標使用者 ID
+        reply_token (str): 回應 token
+        retry (bool): 是否為重試上傳（重試時不另外記錄日誌）
+        reply_deadline (float): reply token 的到期時間（epoch 秒）
+        deferrals (int): 因頻率限制延後重試的次數（由 defer_or_dead_letter 帶入）
+        release_ref (bool): 結束時是否釋放暫存檔參照；!retryupload 直接呼叫時沒有取得參照，需設為 False
+
+    成功或最終失敗時釋放對暫存檔的參照（最終失敗時保留檔案供 !retryupload 使用）。
+    release_ref 為 False 時不釋放，避免遞減其他仍在重試的上傳任務持有的參照。
+
+    回傳:
+        str: 上傳後的 Google Drive 檔案 ID
+    """
+    current_retry = task_error_retries(self)  # 這次進到 except block 前的錯誤重試計數（不含延後重試）
+    max_retry = self.max_retries
+    logger = logging.getLogger('celery')
+    logger.info("[TASK] Starting upload task: source_type=%s, source_id=%s, target_user_id=%s",
+                source_type, source_id, target_user_id)
+
+    uploaded_successfully = False
+    user_creds = None
+    try:
+        current_name = get_source_name(source_type, source_id)
+    except Exception as e:
+        logger.error("[TASK] Failed to get source name: %s", str(e))
+        current_name = None
+
+    try:
+        # 1. 取得該使用者的 Google OAuth Credentials
+        user_creds = get_user_credentials(target_user_id)
+        if not user_creds:
+            logger.error("[AUTH] Failed to get credentials for user_id=%s", target_user_id)
+            raise UserCredentialsError
+
+        # 2. 取得(或建立)針對「(群組, 該使用者)」的專屬資料夾，並同步資料夾名稱
+        service, folder_id = prepare_drive_folder(user_creds, source_type, source_id, target_user_id,
+                                                  current_name, logger, cost=3)
+
+        # 3. 上傳檔案（從暫存區取得本機副本，可從上次中斷的位置續傳）
+        file_id = upload_spool_file(service, folder_id, spool_key, dist_name, target_user_id,
+                                    user_creds.client_id, logger)
+
+        # 記錄上傳日誌
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, "success", file_id)
+
+        logger.info("[DRIVE] Upload successful: file_id=%s, user_id=%s", file_id, target_user_id)
+        if reply_token:
+            send_reply(reply_token, target_user_id, [TextMessage(text=f"測試圖片已成功上傳到您的 Google Drive\n連結: https://drive.google.com/file/d/{file_id}/view?usp=sharing")], reply_deadline)
+        
+        uploaded_successfully = True
+
+    except SoftTimeLimitExceeded as e:
+        logger.error("[TASK] Soft time limit exceeded for user_id=%s", target_user_id)
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"timeout{current_retry}/{max_retry}")
+        retry_or_dead_letter(self, e, ERROR_RETRYABLE)
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    except DriveRateLimited as e:
+        # 額度不足時延後重試，不計入失敗日誌
+        logger.warning("[DRIVE] Rate limited for user_id=%s, retry in %.1fs", target_user_id, e.wait)
+        defer_or_dead_letter(self, e, e.wait, DRIVE_RATE_LIMIT['MAX_DEFERRALS'])
+        # 延後次數用完：視為最終失敗，保留暫存檔供 !retryupload 使用
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"rate_limited{current_retry}/{max_retry}")
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    except ConnectionError as exc:
+        logger.error("[NETWORK] Upload failed for user_id=%s: %s", target_user_id, str(exc))
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"connection_error{current_retry}/{max_retry}")
+        retry_or_dead_letter(self, exc, ERROR_RETRYABLE)
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    except HttpError as e:
+        retry_after = record_drive_rate_limit(e, target_user_id, user_creds.client_id if user_creds else None)
+        if retry_after is not None:
+            # Drive 回報頻率限制：依回應提示的時間退避，避免重試風暴
+            logger.warning("[DRIVE] Rate limit response for user_id=%s, retry in %.1fs", target_user_id, retry_after)
+            defer_or_dead_letter(self, e, retry_after, DRIVE_RATE_LIMIT['MAX_DEFERRALS'])
+            # 延後次數用完才記錄失敗日誌，延後重試期間不留下失敗紀錄
+            if not retry:
+                log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"rate_limited{current_retry}/{max_retry}")
+            if release_ref:
+                release_spool_file(spool_key, keep=True)
+            raise
+        if e.resp.status == 404:
+            logger.warning("[DRIVE] 404 error: Folder might be deleted. Removing folder_map: %s", str(e))
+            delete_folder_map(source_id, target_user_id)
+        if is_auth_error(e):
+            open_auth_breaker(target_user_id, f"http_error {e.resp.status}")
+        if get_drive_error_reason(e) == 'storageQuotaExceeded':
+            mark_drive_quota_full(target_user_id)
+            notify_drive_quota_full(target_user_id)
+        logger.error("[DRIVE] Upload failed for user_id=%s: %s", target_user_id, str(e))
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"http_error{current_retry}/{max_retry}")
+        retry_or_dead_letter(self, e)
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    except UserCredentialsError as e:
+        open_auth_breaker(target_user_id, "user_credentials_error")
+        # 記錄上傳失敗日誌
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"user_credentials_error")
+        if reply_token:
+            send_reply(reply_token, target_user_id, [TextMessage(text="Google 帳號認證失敗，請重新綁定")], reply_deadline)
+        retry_or_dead_letter(self, e, ERROR_USER_ACTION)
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    except Exception as e:
+        logger.error("[TASK] Unexpected error for user_id=%s: %s", target_user_id, str(e))
+        if is_auth_error(e):
+            open_auth_breaker(target_user_id, type(e).__name__)
+        if reply_token:
+            send_reply(reply_token, target_user_id, [TextMessage(text="上傳失敗，請稍後再試")], reply_deadline)
+        
+        # 記錄上傳失敗日誌
+        if not retry:
+            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"unknown_error")
+        retry_or_dead_letter(self, e)
+        if release_ref:
+            release_spool_file(spool_key, keep=True)
+        raise
+
+    finally:
+        if uploaded_successfully and release_ref:
+            release_spool_file(spool_key)
+            logger.info("[TASK] Upload completed, released temp file: %s", spool_key)
+
+    return file_id
+
+# 暫存檔參照計數：分派上傳時設定需要此檔案的上傳任務數，每個任務結束時遞減，
+# 最後一個任務負責刪除檔案（取代 chord 回調，不需要 result backend 保存子任務結果）
+# 有任務最終失敗時保留檔案供 !retryupload 使用，之後由 clean_spool 依保留期限清除
+RELEASE_SPOOL_REF_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return -1
+end
+if ARGV[1] == '1' then
+  redis.call('HSET', KEYS[1], 'keep', 1)
+end
+local refs = redis.call('HINCRBY', KEYS[1], 'refs', -1)
+if refs > 0 then
+  return 0
+end
+local keep = redis.call('HGET', KEYS[1], 'keep')
+redis.call('DEL', KEYS[1])
+if keep then
+  return 0
+end
+return 1
+"""
+release_spool_ref_script = redis_client.register_script(RELEASE_SPOOL_REF_LUA)
+
+def spool_refs_key(spool_key):
+    return f"spool_refs:{spool_key}"
+
+def set_spool_refs(spool_key, refs):
+    """設定暫存檔的參照數（需在分派上傳任務之前呼叫）"""
+    key = spool_refs_key(spool_key)
+    pipe = redis_client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, 'refs', refs)
+    pipe.expire(key, SPOOL_REFS_TTL)
+    pipe.execute()
+
+def release_spool_file(spool_key, keep=False):
+    """上傳任務結束時釋放對暫存檔的參照，最後一個參照釋放時刪除檔案
+
+    參數:
+        spool_key (str): 暫存檔案 key
+        keep (bool): 此任務最終失敗，檔案需保留供重試
+
+    回傳:
+        bool: 檔案是否已刪除
+    """
+    logger = logging.getLogger('celery')
+    try:
+        if release_spool_ref_script(keys=[spool_refs_key(spool_key)], args=['1' if keep else '0']) != 1:
+            return False
+        if get_spool_backend().delete(spool_key):
+            logger.info("[CLEANUP] File deleted: %s", spool_key)
+            return True
+        logger.info("[CLEANUP] File does not exist: %s", spool_key)
+    except Exception as e:
+        logger.error("[CLEANUP] Failed to release %s: %s", spool_key, str(e))
+    return False
+
+def hand_off_batch_files(files, source_type, source_id, target_user_id):
+    """把批次中無法處理的檔案改交給 upload_file_to_drive_task 個別上傳（沿用單檔任務的重試與錯誤處理）
+
+    批次對暫存檔的參照轉交給單檔任務，由單檔任務結束時釋放。
+    """
+    for entry in files:
+        upload_file_to_drive_task.apply_async(
+            (entry['spool_key'], entry['dist_name'], source_type, source_id, target_user_id),
+            **upload_task_options(entry.get('size'), target_user_id)
+        )
+    incr_metric('upload_batch_handed_off_files', len(files))
+
+def release_batch_files(files):
+    """批次不再需要這些檔案（已略過），釋放對暫存檔的參照"""
+    for entry in files:
+        release_spool_file(entry['spool_key'])
+
+def defer_upload_batch(task, files, source_type, source_id, target_user_id, wait):
+    """Drive 額度不足時延後重試批次中剩下的檔案（拋出 Retry）；延後次數用完則改交給單檔任務"""
+    max_retries = task.max_retries + DRIVE_RATE_LIMIT['MAX_DEFERRALS']
+    if task.request.called_directly or task.request.retries >= max_retries:
+        hand_off_batch_files(files, source_type, source_id, target_user_id)
+        return
+    logging.getLogger('celery').warning("[BATCH] Rate limited for user_id=%s, %d files retry in %.1fs",
+                                        target_user_id, len(files), wait)
+    raise task.retry(args=(files, source_type, source_id, target_user_id), countdown=wait, max_retries=max_retries)
+
+@celery.task(
+    time_limit=UPLOAD_BATCH_TIME_LIMIT,
+    soft_time_limit=UPLOAD_BATCH_TIME_LIMIT - 30,
+    max_retries=3,
+    bind=True
+)
+def upload_batch_to_drive_task(self, files, source_type, source_id, target_user_id):
+    """將同一時間窗口內收到的多個檔案一次上傳到使用者的 Google Drive
+
+    來源名稱、憑證、Drive service 與資料夾只取得一次，之後逐一上傳檔案。
+    單一檔案失敗時改交給 upload_file_to_drive_task 個別重試，不影響批次中的其他檔案。
+    每個檔案上傳成功或被略過時釋放對暫存檔的參照；交給單檔任務的檔案由單檔任務釋放。
+
+    參數:
+        self: Celery task 物件
+        files (list): {'spool_key', 'dist_name', 'size'} 的列表
+        source_type (str): 來源類型（'group' 或 'user'）
+        source_id (str): 來源 ID
+        target_user_id (str): 目標使用者 ID
+
+    回傳:
+        int: 成功上傳的檔案數
+    """
+    logger = logging.getLogger('celery')
+    logger.info("[BATCH] Starting batch upload: %d files, source_id=%s, target_user_id=%s",
+                len(files), source_id, target_user_id)
+
+    current_name = get_source_name(source_type, source_id)
+
+    # 1. 每個批次只取得一次憑證與資料夾
+    user_creds = None
+    try:
+        user_creds = get_user_credentials(target_user_id)
+        if not user_creds:
+            raise UserCredentialsError
+        service, folder_id = prepare_drive_folder(user_creds, source_type, source_id, target_user_id,
+                                                  current_name, logger, cost=2)
+    except DriveRateLimited as e:
+        defer_upload_batch(self, files, source_type, source_id, target_user_id, e.wait)
+        return 0
+    except Exception as e:
+        if isinstance(e, HttpError):
+            retry_after = record_drive_rate_limit(e, target_user_id, user_creds.client_id if user_creds else None)
+            if retry_after is not None:
+                defer_upload_batch(self, files, source_type, source_id, target_user_id, retry_after)
+                return 0
+        if is_auth_error(e):
+            open_auth_breaker(target_user_id, type(e).__name__)
+            for entry in files:
+                record_auth_breaker_skip(target_user_id, entry['dist_name'], source_type, source_id)
+            release_batch_files(files)
+            return 0
+        logger.error("[BATCH] Setup failed for user_id=%s, falling back to single uploads: %s",
+                     target_user_id, str(e))
+        hand_off_batch_files(files, source_type, source_id, target_user_id)
+        return 0
+
+    # 2. 逐一上傳（第一個檔案的額度已在準備資料夾時取得）
+    uploaded = 0
+    for index, entry in enumerate(files):
+        spool_key, dist_name = entry['spool_key'], entry['dist_name']
+        remaining = files[index:]
+        try:
+            if index:
+                acquire_drive_quota(target_user_id, user_creds.client_id)
+            file_id = upload_spool_file(service, folder_id, spool_key, dist_name, target_user_id,
+                                        user_creds.client_id, logger)
+        except DriveRateLimited as e:
+            defer_upload_batch(self, remaining, source_type, source_id, target_user_id, e.wait)
+            return uploaded
+        except SoftTimeLimitExceeded:
+            logger.warning("[BATCH] Time limit reached, handing off %d files", len(remaining))
+            hand_off_batch_files(remaining, source_type, source_id, target_user_id)
+            return uploaded
+        except Exception as e:
+            if isinstance(e, HttpError):
+                retry_after = record_drive_rate_limit(e, target_user_id, user_creds.client_id)
+                if retry_after is not None:
+                    defer_upload_batch(self, remaining, source_type, source_id, target_user_id, retry_after)
+                    return uploaded
+                if e.resp.status == 404:
+                    # 資料夾已被刪除，交給單檔任務重新建立資料夾
+                    logger.warning("[BATCH] 404 error: Folder might be deleted. Removing folder_map: %s", str(e))
+                    delete_folder_map(source_id, target_user_id)
+                    hand_off_batch_files(remaining, source_type, source_id, target_user_id)
+                    return uploaded
+                if get_drive_error_reason(e) == 'storageQuotaExceeded':
+                    # 空間已滿，剩下的檔案也不會成功
+                    mark_drive_quota_full(target_user_id)
+                    for skipped in remaining:
+                        record_drive_quota_skip(target_user_id, skipped['dist_name'], source_type, source_id, 0)
+                    release_batch_files(remaining)
+                    return uploaded
+            if is_auth_error(e):
+                open_auth_breaker(target_user_id, type(e).__name__)
+                for skipped in remaining:
+                    record_auth_breaker_skip(target_user_id, skipped['dist_name'], source_type, source_id)
+                release_batch_files(remaining)
+                return uploaded
+            logger.error("[BATCH] Upload failed for %s (user_id=%s), handing off: %s",
+                         dist_name, target_user_id, str(e))
+            hand_off_batch_files([entry], source_type, source_id, target_user_id)
+            continue
+
+        log_upload(target_user_id, dist_name, source_type, source_id, current_name, "success", file_id)
+        logger.info("[DRIVE] Upload successful: file_id=%s, user_id=%s", file_id, target_user_id)
+        release_spool_file(spool_key)
+        uploaded += 1
+
+    incr_metric('upload_batches')
+    incr_metric('upload_batch_files', uploaded)
+    logger.info("[BATCH] Batch upload done: %d/%d files, user_id=%s", uploaded, len(files), target_user_id)
+    return uploaded
+
+def query_resumable_session(http, session_uri, total_size):
+    """向 Drive 查詢可續傳上傳 session 目前已確認接收的位移
+
+    參數:
+        http: 已授權的 httplib2 物件
+        session_uri (str): 可續傳上傳的 session URI
+        total_size (int): 檔案總大小
+
+    回傳:
+        tuple: ('incomplete', 已確認位移) / ('complete', 檔案資訊 dict) / ('expired', None)
+    """
+    resp, content = http.request(
+        session_uri,
+        method='PUT',
+        headers={'Content-Length': '0', 'Content-Range': f'bytes */{total_size}'}
+    )
+    if resp.status == 308:
+        # Range: bytes=0-12345，沒有 Range 表示尚未收到任何資料
+        range_header = resp.get('range')
+        offset = int(range_header.rsplit('-', 1)[1]) + 1 if range_header else 0
+        return 'incomplete', offset
+    if resp.status in (200, 201):
+        return 'complete', json.loads(content)
+    if resp.status in (404, 410):
+        return 'expired', None
+    raise HttpError(resp, content, uri=session_uri)
+
+def save_resumable_state(resume_key, request):
+    """保存可續傳上傳的 session URI 與已確認位移"""
+    pipe = redis_client.pipeline()
+    pipe.hset(resume_key, mapping={'uri': request.resumable_uri, 'offset': request.resumable_progress})
+    pipe.expire(resume_key, DRIVE_RESUMABLE_SESSION_TTL)
+    pipe.execute()
+
+def upload_media_resumable(service, dist_path, file_metadata, resume_key, user_id, client_id, logger):
+    """以可續傳方式上傳檔案，並在每個區塊完成後把 session URI 與已確認位移存入 Redis
+
+    重試時若 Redis 中已有同一 (檔案, 目標使用者) 的 session，會先查詢 Drive 已接收的位移，
+    從最後確認的區塊繼續上傳，而不是從頭開始。
+
+    參數:
+        service: Drive service
+        dist_path (str): 本機檔案路徑
+        file_metadata (dict): 檔案名稱與上層資料夾
+        resume_key (str): Redis 中保存續傳狀態的 key
+        user_id (str): 目標使用者 ID（頻率限制用）
+        client_id (str): OAuth client ID（頻率限制用）
+        logger: 日誌記錄器
+
+    回傳:
+        dict: Drive 回傳的檔案資訊（含 id）
+    """
+    media = MediaFileUpload(dist_path, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=True)
+    request = service.files().create(body=file_metadata, media_body=media)
+
+    saved = redis_client.hgetall(resume_key)
+    resumed = False
+    if saved.get('uri'):
+        state, result = query_resumable_session(request.http, saved['uri'], media.size())
+        if state == 'complete':
+            # 上一次其實已上傳完成，只是沒有收到回應
+            logger.info("[DRIVE] Resumable session already complete: %s", resume_key)
+            redis_client.delete(resume_key)
+            return result
+        if state == 'incomplete':
+            request.resumable_uri = saved['uri']
+            request.resumable_progress = result
+            resumed = True
+            incr_metric('drive_upload_resumed')
+            logger.info("[DRIVE] Resuming upload at byte %d/%d: %s", result, media.size(), resume_key)
+        else:
+            logger.info("[DRIVE] Saved resumable session expired, restarting: %s", resume_key)
+            redis_client.delete(resume_key)
+
+    response = None
+    first_chunk = True
+    try:
+        while response is None:
+            if not first_chunk:
+                acquire_drive_quota(user_id, client_id)
+            first_chunk = False
+            try:
+                _, response = request.next_chunk()
+            except HttpError as e:
+                if e.resp.status in (404, 410) and (resumed or request.resumable_progress):
+                    # session 在上傳途中失效，與資料夾不存在的 404 區分開來
+                    redis_client.delete(resume_key)
+                    raise ResumableSessionExpired(str(e)) from e
+                raise
+            if response is None and request.resumable_uri:
+                save_resumable_state(resume_key, request)
+    except ResumableSessionExpired:
+        raise
+    except BaseException:
+        # 逾時或連線中斷時保存最後確認的位移，讓重試從這裡繼續
+        if request.resumable_uri:
+            save_resumable_state(resume_key, request)
+        raise
+
+    redis_client.delete(resume_key)
+    return response
+
+# 上傳狀態分類：upload_stats_daily 的 outcome 與 !listfailed 的錯誤類型共用
+UPLOAD_OUTCOME_LABELS = {
+    'success': '成功',
+    'retry_success': '重試成功',
+    'connection_error': '連線錯誤',
+    'timeout': '超時錯誤',
+    'user_credentials_error': '認證錯誤',
+    'http_error': 'API錯誤',
+    'rate_limited': '頻率限制',
+    'file_missing': '檔案不存在',
+    'evicted': '暫存已清除',
+    'skipped_auth_revoked': '授權失效已略過',
+    'skipped_quota_full': '空間不足已略過',
+    'retry_failed': '重試失敗',
+    'other': '其他錯誤',
+}
+UPLOAD_SUCCESS_OUTCOMES = {'success', 'retry_success'}
+
+def classify_upload_status(status):
+    """將 upload_logs.status 歸類為 UPLOAD_OUTCOME_LABELS 中的 outcome"""
+    status = status or ''
+    if status == 'success':
+        return 'success'
+    if status == '重試成功':
+        return 'retry_success'
+    if status == '重試失敗':
+        return 'retry_failed'
+    for outcome in ('connection_error', 'timeout', 'user_credentials_error', 'http_error', 'rate_limited'):
+        if outcome in status:
+            return outcome
+    if "檔案不存在" in status:
+        return 'file_missing'
+    for outcome in ('evicted', 'skipped_auth_revoked', 'skipped_quota_full'):
+        if status.startswith(outcome):
+            return outcome
+    return 'other'
+
+def bump_upload_stats(cursor, user_id, upload_time, source_type, outcome, delta):
+    """調整 upload_stats_daily 的計數（需在呼叫端的交易中執行）
+
+    參數:
+        upload_time (datetime): 日誌的上傳時間，None 表示現在
+        delta (int): 增減的筆數
+    """
+    cursor.execute("""
+        INSERT INTO upload_stats_daily (user_id, day, source_type, outcome, count)
+        VALUES (%s, DATE(COALESCE(%s, CURRENT_TIMESTAMP)), %s, %s, %s)
+        ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+    """, (user_id, upload_time, source_type or '', outcome, delta))
+
+def update_upload_status(cursor, log_ids, status, touch=False, drive_file_id=None):
+    """更新上傳日誌的狀態並同步調整 upload_stats_daily（需在呼叫端的交易中執行）
+
+    參數:
+        cursor: 資料庫 cursor
+        log_ids (list): upload_logs.id 列表
+        status (str): 新狀態
+        touch (bool): 是否同時把 upload_time 更新為現在時間
+        drive_file_id (str): 重試上傳成功時的 Google Drive 檔案 ID
+    """
+    log_ids = list(log_ids)
+    if not log_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(log_ids))
+    cursor.execute(
+        f"SELECT user_id, upload_time, source_type, status FROM upload_logs WHERE id IN ({placeholders}) FOR UPDATE",
+        log_ids
+    )
+    rows = cursor.fetchall()
+    set_time = ", upload_time = CURRENT_TIMESTAMP" if touch else ""
+    cursor.execute(
+        f"UPDATE upload_logs SET status = %s, drive_file_id = COALESCE(%s, drive_file_id){set_time} WHERE id IN ({placeholders})",
+        [status, drive_file_id] + log_ids
+    )
+
+    new_outcome = classify_upload_status(status)
+    for user_id, upload_time, source_type, old_status in rows:
+        old_outcome = classify_upload_status(old_status)
+        if old_outcome == new_outcome and not touch:
+            continue
+        bump_upload_stats(cursor, user_id, upload_time, source_type, old_outcome, -1)
+        bump_upload_stats(cursor, user_id, None if touch else upload_time, source_type, new_outcome, 1)
+
+def get_upload_stats(user_id, days):
+    """從 upload_stats_daily 讀取使用者最近幾天的上傳統計
+
+    參數:
+        user_id (str): LINE 使用者 ID
+        days (int): 天數（含今天）
+
+    回傳:
+        list: (source_type, outcome, 筆數) 的列表
+    """
+    conn = get_read_connection(user_id)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT source_type, outcome, SUM(count)
+                FROM upload_stats_daily
+                WHERE user_id = %s
+                  AND day > CURDATE() - INTERVAL %s DAY
+                GROUP BY source_type, outcome
+                HAVING SUM(count) > 0
+            """, (user_id, days))
+            return [(source_type, outcome, int(count)) for source_type, outcome, count in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def rebuild_upload_stats():
+    """由 upload_logs 重新計算 upload_stats_daily（建立統計表後補上既有日誌用）"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT user_id, DATE(upload_time), source_type, status, COUNT(*)
+                FROM upload_logs
+                GROUP BY user_id, DATE(upload_time), source_type, status
+            """)
+            totals = {}
+            for user_id, day, source_type, status, count in cursor.fetchall():
+                key = (user_id, day, source_type or '', classify_upload_status(status))
+                totals[key] = totals.get(key, 0) + count
+            cursor.execute("DELETE FROM upload_stats_daily")
+            cursor.executemany(
+                "INSERT INTO upload_stats_daily (user_id, day, source_type, outcome, count) VALUES (%s, %s, %s, %s, %s)",
+                [key + (count,) for key, count in totals.items()]
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+def log_upload(user_id, file_name, source_type, source_id, source_name, status, drive_file_id=None):
+    """記錄上傳日誌，並在同一交易中累加 upload_stats_daily
+
+    參數:
+        drive_file_id (str): 上傳成功時 Google Drive 的檔案 ID（!searchlog 顯示連結用）
+
+    回傳:
+        int: 新增日誌的 id
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            sql = "INSERT INTO upload_logs (user_id, file_name, source_type, source_id, source_name, status, drive_file_id) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+            cursor.execute(sql, (user_id, file_name, source_type, source_id, source_name, status, drive_file_id))
+            log_id = cursor.lastrowid
+            bump_upload_stats(cursor, user_id, None, source_type, classify_upload_status(status), 1)
+        conn.commit()
+        return log_id
+    finally:
+        conn.close()
+
+def is_auth_error(error):
+    """判斷例外是否代表使用者的 Google 授權已失效（需要重新綁定）"""
+    if isinstance(error, (UserCredentialsError, RefreshError)):
+        return True
+    return isinstance(error, HttpError) and error.resp.status == 401
+
+def auth_breaker_key(user_id):
+    return f"auth_breaker:{user_id}"
+
+def open_auth_breaker(user_id, reason):
+    """Google 授權失效時開啟該帳號的斷路器，在使用者重新綁定前跳過該帳號的上傳"""
+    key = auth_breaker_key(user_id)
+    if redis_client.hsetnx(key, 'opened_at', datetime.datetime.now().isoformat(timespec='seconds')):
+        redis_client.hset(key, 'reason', reason[:200])
+        incr_metric('auth_breaker_opened')
+        logging.getLogger('celery').warning("[AUTH] Circuit breaker opened for user_id=%s: %s", user_id, reason)
+    redis_client.expire(key, AUTH_BREAKER_TTL)
+
+def close_auth_breaker(user_id):
+    """使用者重新綁定 Google 帳號後關閉斷路器"""
+    redis_client.delete(auth_breaker_key(user_id))
+
+def get_open_auth_breakers(user_ids):
+    """回傳 user_ids 中斷路器為開啟狀態的使用者集合"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    pipe = redis_client.pipeline()
+    for user_id in user_ids:
+        pipe.exists(auth_breaker_key(user_id))
+    return {user_id for user_id, is_open in zip(user_ids, pipe.execute()) if is_open}
+
+# 斷路器 key 存在時才更新計數與日誌 ID，避免在 key 過期後以 HINCRBY/HSET 重建出沒有期限的斷路器
+AUTH_BREAKER_SKIP_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return {0, 0}
+end
+local skipped = redis.call('HINCRBY', KEYS[1], 'skipped', 1)
+local first = redis.call('HSETNX', KEYS[1], 'log_id', 'pending')
+return {skipped, first}
+"""
+auth_breaker_skip_script = redis_client.register_script(AUTH_BREAKER_SKIP_LUA)
+
+AUTH_BREAKER_SET_LOG_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('HSET', KEYS[1], 'log_id', ARGV[1])
+end
+"""
+auth_breaker_set_log_script = redis_client.register_script(AUTH_BREAKER_SET_LOG_LUA)
+
+def record_auth_breaker_skip(user_id, file_name, source_type, source_id):
+    """記錄因斷路器開啟而跳過的上傳
+
+    每次斷路器開啟期間只新增一筆日誌，之後跳過的檔案只更新該筆日誌的計數。
+    呼叫前斷路器剛好過期時只記錄這一個檔案，不重建斷路器。
+    """
+    key = auth_breaker_key(user_id)
+    skipped, first = auth_breaker_skip_script(keys=[key])
+    incr_metric('auth_breaker_skipped_uploads')
+    if not skipped:
+        log_upload(user_id, file_name, source_type, source_id, None,
+                   "skipped_auth_revoked (1 個檔案，請重新綁定 Google 帳號)")
+        return
+    status = f"skipped_auth_revoked ({skipped} 個檔案，請重新綁定 Google 帳號)"
+
+    if first:
+        log_id = log_upload(user_id, file_name, source_type, source_id, None, status)
+        if log_id:
+            auth_breaker_set_log_script(keys=[key], args=[log_id])
+        return
+
+    log_id = redis_client.hget(key, 'log_id')
+    if not log_id or log_id == 'pending':
+        return
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            update_upload_status(cursor, [int(log_id)], status, touch=True)
+            cursor.execute("UPDATE upload_logs SET file_name = %s WHERE id = %s", (file_name, int(log_id)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def drive_quota_key(user_id):
+    return f"drive_quota:{user_id}"
+
+def refresh_drive_quota(user_id, service):
+    """以 about().get 取得使用者的 Drive 儲存空間並存入 Redis 快照
+
+    回傳:
+        dict: Drive 回傳的 storageQuota（limit 不存在表示沒有容量上限）
     """
-    current_retry = self.request.retries  # 這次進到 except block 前的重試計數
-    max_retry = self.max_retries
-    logger = logging.getLogger('celery')
-    logger.info("[TASK] Starting upload task: source_type=%s, source_id=%s, target_user_id=%s",
-                source_type, source_id, target_user_id)
+    quota = service.about().get(fields='storageQuota').execute().get('storageQuota', {})
+    key = drive_quota_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={
+        'limit': quota.get('limit', ''),
+        'usage': quota.get('usage', 0),
+        'updated_at': int(time.time()),
+    })
+    pipe.expire(key, DRIVE_QUOTA_CACHE_TTL)
+    pipe.execute()
+    return quota
+
+def add_cached_drive_usage(user_id, size):
+    """上傳成功後把檔案大小加到快照的已使用空間（快照不存在時不建立）"""
+    key = drive_quota_key(user_id)
+    if size and redis_client.exists(key):
+        redis_client.hincrby(key, 'usage', int(size))
+
+def mark_drive_quota_full(user_id):
+    """Drive 回報 storageQuotaExceeded 時把快照標記為已滿，下次定期更新前都略過此使用者"""
+    key = drive_quota_key(user_id)
+    limit = redis_client.hget(key, 'limit')
+    if limit:
+        redis_client.hset(key, 'usage', limit)
+    else:
+        redis_client.hset(key, mapping={'limit': 0, 'usage': 0, 'updated_at': int(time.time())})
+        redis_client.expire(key, DRIVE_QUOTA_CACHE_TTL)
 
-    uploaded_successfully = False
+def get_drive_free_bytes(user_ids):
+    """從快照取得使用者的 Drive 剩餘空間
+
+    回傳:
+        dict: {user_id: 剩餘位元組}；沒有快照或沒有容量上限的使用者不列入
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    pipe = redis_client.pipeline()
+    for user_id in user_ids:
+        pipe.hmget(drive_quota_key(user_id), 'limit', 'usage')
+    free = {}
+    for user_id, (limit, usage) in zip(user_ids, pipe.execute()):
+        if limit not in (None, ''):
+            free[user_id] = int(limit) - int(usage or 0)
+    return free
+
+def notify_drive_quota_full(user_id):
+    """通知使用者 Drive 空間不足（每 DRIVE_QUOTA_NOTICE_INTERVAL 最多一次）"""
+    if not redis_client.set(f"quota_notice:{user_id}", 1, nx=True, ex=DRIVE_QUOTA_NOTICE_INTERVAL):
+        return
     try:
-        current_name = get_source_name(source_type, source_id)
+        push_message(user_id, [TextMessage(
+            text="您的 Google Drive 儲存空間不足，新的檔案將暫停上傳。\n"
+                 "因空間不足而略過的檔案不會保留，釋放空間後請重新傳送這些檔案；"
+                 "上傳途中失敗的檔案可使用 !retryupload 重試。"
+        )])
     except Exception as e:
-        logger.error("[TASK] Failed to get source name: %s", str(e))
-        current_name = None
+        logging.getLogger('celery').warning("[QUOTA] Failed to notify user_id=%s: %s", user_id, str(e))
 
-    try:
-        # 1. 取得該使用者的 Google OAuth Credentials
-        user_creds = get_user_credentials(target_user_id)
-        if not user_creds:
-            logger.error("[AUTH] Failed to get credentials for user_id=%s", target_user_id)
-            raise UserCredentialsError
+def record_drive_quota_skip(user_id, file_name, source_type, source_id, free_bytes):
+    """記錄因 Drive 空間不足而略過的上傳並通知使用者"""
+    log_upload(user_id, file_name, source_type, source_id, None,
+               f"skipped_quota_full (剩餘 {max(free_bytes, 0) / 1024 / 1024:.1f} MB)")
+    incr_metric('drive_quota_skipped_uploads')
+    logging.getLogger('celery').info("[QUOTA] Skipped %s for user_id=%s: %d bytes free",
+                                     file_name, user_id, free_bytes)
+    notify_drive_quota_full(user_id)
 
-        # 2. 建立 Drive Service
-        service = build('drive', 'v3', credentials=user_creds)
+@celery.task(acks_late=True)
+def record_drive_quota_skip_task(user_id, file_name, source_type, source_id, free_bytes):
+    """webhook 端略過的上傳改由 worker 記錄日誌與通知，不佔用 webhook 請求的時間"""
+    record_drive_quota_skip(user_id, file_name, source_type, source_id, free_bytes)
 
-        # 3. 取得(或建立)針對「(群組, 該使用者)」的專屬資料夾
-        folder_id = get_or_create_folder_for_source_id(source_type, source_id, target_user_id, service, logger)
-        if not folder_id:
-            logger.error("[DRIVE] Failed to get/create folder for source_id=%s, user_id=%s",
-                        source_id, target_user_id)
-            raise Exception
+def fit_files_to_drive_quota(user_id, files, free_bytes, source_type, source_id):
+    """依剩餘空間挑出放得下的檔案，放不下的記錄為 skipped_quota_full 並通知使用者
 
-        # 在上傳前檢查並更新資料夾名稱
-        
-        if current_name:
-            try:
-                # 先取得現有資料夾資訊
-                folder_metadata = service.files().get(fileId=folder_id, fields='name').execute()
-                existing_name = folder_metadata.get('name')
-                
-                # 只在名稱不同時才更新
-                if existing_name != current_name:
-                    service.files().update(
-                        fileId=folder_id,
-                        body={'name': current_name}
-                    ).execute()
-                    logger.info(f"Updated folder name: {existing_name} -> {current_name}")
-                else:
-                    logger.debug(f"Folder name unchanged: {existing_name}")
-            except Exception as e:
-                logger.warning(f"Failed to update folder name: {str(e)}")
+    參數:
+        user_id (str): 目標使用者 ID
+        files (list): {'spool_key', 'dist_name', 'size'} 的列表
+        free_bytes (int): 剩餘空間，None 表示未知（全部上傳）
 
-        # 4. 上傳檔案
-        media = MediaFileUpload(dist_path, chunksize=1024*1024, resumable=True)
-        file_metadata = {
-            'name': dist_name,
-            'parents': [folder_id]
-        }
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media
-        ).execute()
-        file_id = file.get('id')
+    回傳:
+        list: 可以上傳的檔案
+    """
+    if free_bytes is None:
+        return files
+    accepted = []
+    for entry in files:
+        size = entry.get('size') or 0
+        if size <= free_bytes:
+            accepted.append(entry)
+            free_bytes -= size
+            continue
+        record_drive_quota_skip(user_id, entry['dist_name'], source_type, source_id, free_bytes)
+    return accepted
+
+def save_drive_change_cursor(user_id, page_token):
+    """保存使用者 Drive Changes API 的讀取位置"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO drive_change_cursors (user_id, page_token) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE page_token = VALUES(page_token)
+            """, (user_id, page_token))
+        conn.commit()
+    finally:
+        conn.close()
 
-        # 記錄上傳日誌
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, "success")
+# 資料夾上次看到的名稱在使用者停止同步（例如解除綁定 Google 帳號）後保留的時間
+DRIVE_FOLDER_NAMES_TTL = DRIVE_CHANGES_SYNC_INTERVAL * 12
 
-        logger.info("[DRIVE] Upload successful: file_id=%s, user_id=%s", file_id, target_user_id)
-        if reply_token:
-            reply_message(reply_token, [TextMessage(text=f"測試圖片已成功上傳到您的 Google Drive\n連結: https://drive.google.com/file/d/{file_id}/view?usp=sharing")])
-        
-        uploaded_successfully = True
+def drive_folder_names_key(user_id):
+    return f"drive_folder_names:{user_id}"
 
-    except SoftTimeLimitExceeded:
-        logger.error("[TASK] Soft time limit exceeded for user_id=%s", target_user_id)
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"timeout{current_retry}/{max_retry}")
-        raise
+def sync_user_folder_changes(user_id, client_id, service, page_token, folders, logger):
+    """讀取使用者自上次位置以來的 Drive 變更，更新受影響的資料夾映射
 
-    except ConnectionError as exc:
-        logger.error("[NETWORK] Upload failed for user_id=%s: %s", target_user_id, str(exc))
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"connection_error{current_retry}/{max_retry}")
-        raise
+    參數:
+        user_id (str): LINE 使用者 ID
+        client_id (str): OAuth client ID（頻率限制用）
+        service: Drive service
+        page_token (str): 上次保存的讀取位置
+        folders (dict): {folder_id: source_id}，此使用者在 folder_map 中的資料夾
+        logger: 日誌記錄器
 
-    except HttpError as e:
-        if e.resp.status == 404:
-            logger.warning("[DRIVE] 404 error: Folder might be deleted. Removing folder_map: %s", str(e))
-            delete_folder_map(source_id, target_user_id)
-        logger.error("[DRIVE] Upload failed for user_id=%s: %s", target_user_id, str(e))
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"http_error{current_retry}/{max_retry}")
-        raise
+    回傳:
+        tuple: (新的讀取位置, 移除的映射數, 改名的資料夾數)
 
-    except UserCredentialsError:
-        # 記錄上傳失敗日誌
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"user_credentials_error")
-        if reply_token:
-            reply_message(reply_token, [TextMessage(text="Google 帳號認證失敗，請重新綁定")])
-        raise
+    資料夾上次看到的名稱記錄在 drive_folder_names:{user_id}，只有名稱與記錄不同時才算改名；
+    其他變更（例如資料夾內新增檔案）也會出現在變更列表中，不應清除快取。
+    """
+    removed = renamed = 0
+    names_key = drive_folder_names_key(user_id)
+    while True:
+        acquire_drive_quota(user_id, client_id)
+        response = service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            pageSize=1000,
+            fields='nextPageToken,newStartPageToken,changes(fileId,removed,file(name,trashed))'
+        ).execute()
 
-    except Exception as e:
-        logger.error("[TASK] Unexpected error for user_id=%s: %s", target_user_id, str(e))
-        if reply_token:
-            reply_message(reply_token, [TextMessage(text="上傳失敗，請稍後再試")])
-        
-        # 記錄上傳失敗日誌
-        if not retry:
-            log_upload(target_user_id, dist_name, source_type, source_id, current_name, f"unknown_error")
-        raise
+        for change in response.get('changes', []):
+            source_id = folders.get(change.get('fileId'))
+            if not source_id:
+                continue
+            file = change.get('file') or {}
+            if change.get('removed') or file.get('trashed'):
+                logger.info("[CHANGES] Folder %s removed or trashed, dropping folder_map (source_id=%s, user=%s)",
+                            change['fileId'], source_id, user_id)
+                delete_folder_map(source_id, user_id)
+                folders.pop(change['fileId'], None)
+                removed += 1
+            elif file.get('name'):
+                previous_name = redis_client.hget(names_key, change['fileId'])
+                if previous_name == file['name']:
+                    continue
+                redis_client.hset(names_key, change['fileId'], file['name'])
+                # 名稱會在下次上傳時同步回來源名稱，這裡只清除顯示用的快取
+                invalidate_report_cache(user_id)
+                if previous_name is None:
+                    # 第一次記錄名稱，無法判斷是否改名
+                    continue
+                logger.info("[CHANGES] Folder %s renamed from %s to %s (source_id=%s, user=%s)",
+                            change['fileId'], previous_name, file['name'], source_id, user_id)
+                renamed += 1
 
-    finally:
-        if uploaded_successfully:
-            logger.info("[TASK] Upload completed, keeping temp file: %s", dist_path)
-        else:
-            logger.info("[TASK] Keeping temp file (upload failed): %s", dist_path)
+        if 'newStartPageToken' in response:
+            redis_client.expire(names_key, DRIVE_FOLDER_NAMES_TTL)
+            return response['newStartPageToken'], removed, renamed
+        page_token = response['nextPageToken']
+
+@celery.task(acks_late=True)
+def sync_drive_folder_changes():
+    """定期以 Drive Changes API 增量檢查資料夾是否被刪除、移到垃圾桶或改名
 
-def log_upload(user_id, file_name, source_type, source_id, source_name, status):
-    """記錄上傳日誌"""
+    每位使用者在 drive_change_cursors 保存一個讀取位置，每次只讀取新的變更，
+    不需要逐一查詢每個資料夾，也不用等到上傳時遇到 404 才發現資料夾已不存在。
+    """
+    logger = logging.getLogger('celery')
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            sql = "INSERT INTO upload_logs (user_id, file_name, source_type, source_id, source_name, status) VALUES (%s, %s, %s, %s, %s, %s)"
-            cursor.execute(sql, (user_id, file_name, source_type, source_id, source_name, status))
-        conn.commit()
+            cursor.execute("""
+                SELECT fm.user_id, fm.folder_id, fm.source_id, dc.page_token
+                FROM folder_map fm
+                LEFT JOIN drive_change_cursors dc ON dc.user_id = fm.user_id
+            """)
+            rows = cursor.fetchall()
     finally:
         conn.close()
 
-@celery.task
-def clean_temp_file(results, dist_path):
-    """清理暫存檔案（Celery chord 的回調函數）
-    
-    參數:
-        results: chord group 的執行結果
-        dist_path (str): 要刪除的暫存檔案路徑
-    """
+    users = {}
+    for user_id, folder_id, source_id, page_token in rows:
+        user = users.setdefault(user_id, {'page_token': page_token, 'folders': {}})
+        user['folders'][folder_id] = source_id
+
+    skipped_users = get_open_auth_breakers(users)
+    total_removed = 0
+    for user_id, user in users.items():
+        if user_id in skipped_users:
+            continue
+        try:
+            user_creds = get_user_credentials(user_id)
+            if not user_creds:
+                continue
+            service = build_drive_service(user_creds)
+            page_token = user['page_token']
+            if not page_token:
+                # 第一次追蹤：只記下目前位置，之後才讀取變更
+                acquire_drive_quota(user_id, user_creds.client_id)
+                save_drive_change_cursor(user_id, service.changes().getStartPageToken().execute()['startPageToken'])
+                continue
+            try:
+                new_token, removed, renamed = sync_user_folder_changes(
+                    user_id, user_creds.client_id, service, page_token, user['folders'], logger)
+            except HttpError as e:
+                if e.resp.status not in (400, 404, 410):
+                    raise
+                # 讀取位置已失效，重新從目前位置開始追蹤
+                logger.warning("[CHANGES] Page token expired for user_id=%s, resetting cursor", user_id)
+                new_token, removed, renamed = service.changes().getStartPageToken().execute()['startPageToken'], 0, 0
+            save_drive_change_cursor(user_id, new_token)
+            total_removed += removed
+            if removed or renamed:
+                logger.info("[CHANGES] user_id=%s: %d folder maps removed, %d folders renamed",
+                            user_id, removed, renamed)
+        except DriveRateLimited:
+            logger.info("[CHANGES] Rate limited, will sync user_id=%s next time", user_id)
+        except Exception as e:
+            if is_auth_error(e):
+                open_auth_breaker(user_id, type(e).__name__)
+            logger.warning("[CHANGES] Failed to sync changes for user_id=%s: %s", user_id, str(e))
+
+    incr_metric('drive_changes_folder_maps_removed', total_removed)
+    return total_removed
+
+@celery.task(acks_late=True)
+def refresh_drive_quotas():
+    """定期更新所有已綁定使用者的 Drive 儲存空間快照"""
     logger = logging.getLogger('celery')
-    # (可選) logger.info(f"chord group results: {results}")
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT user_id FROM user_tokens')
+            user_ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
 
-    if os.path.exists(dist_path):
+    skipped_users = get_open_auth_breakers(user_ids)
+    refreshed = 0
+    for user_id in user_ids:
+        if user_id in skipped_users:
+            continue
         try:
-            os.remove(dist_path)
-            logger.info("[CLEANUP] File deleted: %s", dist_path)
-        except OSError as e:
-            logger.error("[CLEANUP] Failed to delete file: %s", str(e))
-    else:
-        logger.info("[CLEANUP] File does not exist: %s", dist_path)
+            user_creds = get_user_credentials(user_id)
+            if not user_creds:
+                continue
+            acquire_drive_quota(user_id, user_creds.client_id)
+            refresh_drive_quota(user_id, build_drive_service(user_creds))
+            refreshed += 1
+        except DriveRateLimited:
+            logger.info("[QUOTA] Rate limited, keeping old snapshot for user_id=%s", user_id)
+        except Exception as e:
+            if is_auth_error(e):
+                open_auth_breaker(user_id, type(e).__name__)
+            logger.warning("[QUOTA] Failed to refresh quota for user_id=%s: %s", user_id, str(e))
+    logger.info("[QUOTA] Refreshed %d/%d quota snapshots", refreshed, len(user_ids))
+    return refreshed
 
 @celery.task
-def check_google_status(reply_token, line_user_id):
+def check_google_status(reply_token, line_user_id, reply_deadline=None):
     logger = logging.getLogger('celery')
     conn = get_db_connection()
     try:
@@ -476,7 +2457,7 @@ def check_google_status(reply_token, line_user_id):
                         ]
                     )
                 )
-                reply_message(reply_token, [template_message])
+                send_reply(reply_token, line_user_id, [template_message], reply_deadline)
             else:
                 template_message = TemplateMessage(
                     alt_text='Google 帳號狀態',
@@ -491,7 +2472,7 @@ def check_google_status(reply_token, line_user_id):
                         ]
                     )
                 )
-                reply_message(reply_token, [template_message])
+                send_reply(reply_token, line_user_id, [template_message], reply_deadline)
     except Exception as e:
         logger.error(f"檢查 Google 狀態時發生錯誤: {str(e)}")
         template_message = TemplateMessage(
@@ -507,19 +2488,65 @@ def check_google_status(reply_token, line_user_id):
                 ]
             )
         )
-        reply_message(reply_token, [template_message])
+        send_reply(reply_token, line_user_id, [template_message], reply_deadline)
     finally:
         conn.close()
 
-@celery.task(bind=True, max_retries=3, default_retry_delay=5)
-def download_line_file_task(self, message_id, ext, filename=None):
+# 需要等待 LINE 轉檔完成才能下載的類型
+TRANSCODED_CONTENT_EXTS = {'mp4', 'm4a'}
+
+def wait_for_line_content(blob_api, message_id, interval=None):
+    """輪詢 LINE 影片 / 音訊的轉檔狀態，直到可以下載為止
+
+    輪詢間隔依 LINE_CONTENT_POLL 逐次拉長；在 worker 內等待超過 INLINE_BUDGET 時
+    拋出 LineContentNotReady，由呼叫端延後重試任務，不佔住 worker。
+
+    參數:
+        blob_api (MessagingApiBlob): LINE Blob API
+        message_id (str): 訊息 ID
+        interval (float): 第一次等待的間隔，None 表示使用 INITIAL_INTERVAL
+
+    回傳:
+        float: 在 worker 內等待的秒數
+    """
+    logger = logging.getLogger('celery')
+    interval = interval or LINE_CONTENT_POLL['INITIAL_INTERVAL']
+    waited = 0.0
+    while True:
+        status = blob_api.get_message_content_transcoding_by_message_id(message_id=message_id).status
+        if status == 'succeeded':
+            return waited
+        if status == 'failed':
+            raise LineContentFailed(f"LINE transcoding failed for message {message_id}")
+
+        if waited + interval > LINE_CONTENT_POLL['INLINE_BUDGET']:
+            raise LineContentNotReady(interval)
+        logger.info("[LINE] Content %s still %s, checking again in %.1fs", message_id, status, interval)
+        time.sleep(interval)
+        waited += interval
+        interval = min(LINE_CONTENT_POLL['MAX_INTERVAL'], interval * LINE_CONTENT_POLL['BACKOFF'])
+
+@celery.task(bind=True, max_retries=3, default_retry_delay=5, acks_late=True)
+def download_line_file_task(self, message_id, ext, filename=None, poll_interval=None, deferrals=0):
     """
-    從 LINE Messaging API 下載檔案，並保存到暫存路徑。
+    從 LINE Messaging API 下載檔案，並存入暫存區。
+    影片與音訊會先確認 LINE 已轉檔完成，尚未完成時延後重試（不計入一般重試次數）。
     若下載或寫檔過程出現任何例外，會自動重試 (最多 3 次)。
+
+    參數:
+        poll_interval (float): 延後重試時沿用的轉檔狀態輪詢間隔
+        deferrals (int): 因轉檔尚未完成延後重試的次數（由 defer_or_dead_letter 帶入）
+
+    回傳:
+        tuple: (spool_key, dist_name)，後續任務以 spool key 取得檔案
     """
     try:
-        with ApiClient(configuration) as api_client:
+        with line_api_client() as api_client:
             line_bot_blob_api = MessagingApiBlob(api_client)
+            if ext in TRANSCODED_CONTENT_EXTS:
+                waited = wait_for_line_content(line_bot_blob_api, message_id, poll_interval)
+                if waited:
+                    incr_metric('line_content_wait_seconds', waited)
             message_content = line_bot_blob_api.get_message_content(message_id=message_id)
             if not message_content:
                 raise ValueError("無法取得檔案內容，message_content 為 None。")
@@ -540,35 +2567,41 @@ def download_line_file_task(self, message_id, ext, filename=None):
         # 根據檔案類型處理
         if ext == 'file':
             if filename:
-                # 如果有提供檔名，使用它
-                dist_path = f"{STATIC_TMP_PATH}/{timestamp}_{filename}"
+                # 如果有提供檔名，使用它（只取檔名部分）
+                dist_name = f"{timestamp}_{os.path.basename(filename)}"
             else:
                 # 如果沒有提供檔名，直接使用臨時檔名
-                dist_path = f"{STATIC_TMP_PATH}/{timestamp}_{temp_basename}"
+                dist_name = f"{timestamp}_{temp_basename}"
         else:
             # 對於媒體檔案，在臨時檔名基礎上加上副檔名
-            dist_path = f"{STATIC_TMP_PATH}/{timestamp}_{temp_basename}.{ext}"
+            dist_name = f"{timestamp}_{temp_basename}.{ext}"
 
-        # 重命名臨時檔案
-        os.rename(tempfile_path, dist_path)
+        # 存入暫存區，spool key 與檔名相同
+        spool_key = dist_name
+        get_spool_backend().put_file(tempfile_path, spool_key)
 
-        # 直接從 dist_path 提取檔名
-        dist_name = os.path.basename(dist_path)
+        return spool_key, dist_name
 
-        return dist_path, dist_name
+    except LineContentNotReady as e:
+        # 內容仍在轉檔，拉長間隔後再檢查
+        incr_metric('line_content_not_ready_deferred')
+        next_interval = min(LINE_CONTENT_POLL['MAX_INTERVAL'], e.wait * LINE_CONTENT_POLL['BACKOFF'])
+        defer_or_dead_letter(self, e, e.wait, LINE_CONTENT_POLL['MAX_DEFERRALS'], poll_interval=next_interval)
+        raise
 
     except Exception as e:
-        raise self.retry(exc=e, countdown=5)
+        retry_or_dead_letter(self, e, countdown_base=5)
+        raise
     
 @celery.task
 def handle_upload_task(download_result, event_data):
     """
     取代原本在主程式的 handle_upload() 函式：
-    1) 根據 download_result 拿 dist_path, dist_name
+    1) 根據 download_result 拿 spool_key, dist_name
     2) 判斷來源是 user / group，進行上傳
-    3) 上傳完後 chord callback -> clean_temp_file
+    3) 依上傳任務數設定暫存檔參照數，最後一個上傳任務結束時刪除暫存檔
     """
-    dist_path, dist_name = download_result
+    spool_key, dist_name = download_result
     source_type = event_data['source_type']
     source_id = event_data['source_id']
     reply_token = event_data.get('reply_token', None)
@@ -577,6 +2610,20 @@ def handle_upload_task(download_result, event_data):
     print(f"[TASK] Creating upload tasks for {source_type}: id={source_id}")
 
     if source_type == 'user':
+        if get_open_auth_breakers([source_id]):
+            # Google 授權已失效，重新綁定前不嘗試上傳
+            record_auth_breaker_skip(source_id, dist_name, source_type, source_id)
+            print(f"[TASK] Auth breaker open, skipped upload for user: {source_id}")
+            get_spool_backend().delete(spool_key)
+            return "SKIPPED"
+
+        # 已知 Drive 空間不足時不上傳
+        file_entry = {'spool_key': spool_key, 'dist_name': dist_name, 'size': get_spool_backend().size(spool_key)}
+        if not fit_files_to_drive_quota(source_id, [file_entry], get_drive_free_bytes([source_id]).get(source_id),
+                                        source_type, source_id):
+            get_spool_backend().delete(spool_key)
+            return "SKIPPED"
+
         # 查使用者 debug_mode (範例)
         debug_mode = False
         with get_db_connection() as conn:
@@ -585,50 +2632,232 @@ def handle_upload_task(download_result, event_data):
                 result = cursor.fetchone()
                 debug_mode = (result[0] if result else False)
 
-        # 若要在 worker 端用 reply_token 回應, 要注意 token 30秒有效; 建議改成 push_message
+        # reply_token 約 30 秒有效，依期限提高優先權，逾時則在 worker 端改用 push message
+        reply_deadline = event_data.get('reply_deadline')
         if debug_mode:
             reply_loading_animation(source_id, 15)
         else:
             reply_token = None
-
-        # 單一任務 + clean_temp_file
-        task = upload_file_to_drive_task.s(dist_path, dist_name, source_type, source_id, source_id, reply_token)
-        callback = clean_temp_file.s(dist_path)
-        return chord(task)(callback)
+            reply_deadline = None
+
+        # 單一任務，結束時釋放暫存檔
+        set_spool_refs(spool_key, 1)
+        upload_file_to_drive_task.apply_async(
+            (spool_key, dist_name, source_type, source_id, source_id, reply_token),
+            kwargs={'reply_deadline': reply_deadline},
+            priority=deadline_priority(reply_deadline),
+            **upload_task_options(file_entry['size'], source_id)
+        )
+        return "OK"
 
     else:  # group
-        bound_users = []
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute('SELECT user_id FROM group_users WHERE group_id = %s', (source_id,))
-                bound_users = cursor.fetchall()
+        file_entry = {'spool_key': spool_key, 'dist_name': dist_name, 'size': get_spool_backend().size(spool_key)}
+        if UPLOAD_COALESCE_WINDOW > 0 and get_upload_size_class(file_entry['size']) is UPLOAD_SIZE_CLASSES[0]:
+            # 相簿等短時間內的大量小型檔案合併成批次任務，每位使用者的狀態只解析一次
+            # 大型檔案則各自送到對應級別的佇列
+            return coalesce_group_upload(source_type, source_id, file_entry)
+
+        bound_users = get_group_bound_users(source_id)
+
+        # 跳過 Google 授權已失效的使用者，每位使用者只保留一筆彙總的略過日誌
+        skipped_users = get_open_auth_breakers(bound_users)
+        for user_id in skipped_users:
+            record_auth_breaker_skip(user_id, dist_name, source_type, source_id)
+        bound_users = [user_id for user_id in bound_users if user_id not in skipped_users]
+
+        # 跳過已知 Drive 空間不足的使用者
+        free_bytes = get_drive_free_bytes(bound_users)
+        bound_users = [
+            user_id for user_id in bound_users
+            if fit_files_to_drive_quota(user_id, [file_entry], free_bytes.get(user_id), source_type, source_id)
+        ]
 
         if bound_users:
-            task_list = [
-                upload_file_to_drive_task.s(dist_path, dist_name, source_type, source_id, row[0])
-                for row in bound_users
-            ]
-            callback = clean_temp_file.s(dist_path)
-            return chord(group(task_list))(callback)
+            set_spool_refs(spool_key, len(bound_users))
+            for user_id in bound_users:
+                upload_file_to_drive_task.apply_async(
+                    (spool_key, dist_name, source_type, source_id, user_id),
+                    **upload_task_options(file_entry['size'], user_id)
+                )
+            return "OK"
         else:
             # 無綁定使用者 -> 直接刪掉暫存檔
-            if os.path.exists(dist_path):
-                os.remove(dist_path)
-            print(f"[CLEANUP] No bound users, deleted temp file: {dist_path}")
+            get_spool_backend().delete(spool_key)
+            print(f"[CLEANUP] No bound users, deleted temp file: {spool_key}")
             return "OK"
 
-@celery.task
-def clean_old_upload_logs(days=7):
-    """清理超過指定天數的上傳日誌"""
+def start_media_workflow(entry, producer=None):
+    """送出單一媒體訊息的 chain：先下載 -> 再分派上傳
+
+    參數:
+        entry (dict): {'message_id', 'ext', 'file_name'（選用）, 'queue'（選用，下載任務的佇列）, 'event_data'}
+        producer: 共用的 broker producer，整批送出時避免每個 chain 各自取得連線
+    """
+    download = download_line_file_task.s(entry['message_id'], entry['ext'], entry.get('file_name'))
+    if entry.get('queue'):
+        download = download.set(queue=entry['queue'])
+    return chain(download, handle_upload_task.s(entry['event_data'])).apply_async(producer=producer)
+
+@celery.task(acks_late=True)
+def dispatch_media_workflows_task(entries):
+    """webhook 一次收到多個媒體訊息時，只送出這一則任務，由 worker 展開成各自的 chain
+
+    worker 中途結束時整批任務會重新投遞（acks_late），已送出的 chain 以訊息 ID 標記，不會重複送出。
+
+    參數:
+        entries (list): start_media_workflow 的工作項目列表
+    """
+    started = 0
+    with celery.producer_or_acquire() as producer:
+        for entry in entries:
+            if not redis_client.set(f"media_workflow:{entry['message_id']}", 1, nx=True, ex=WEBHOOK_EVENT_TTL):
+                continue
+            try:
+                start_media_workflow(entry, producer)
+            except Exception:
+                # 送出失敗時移除標記，讓重新投遞的任務可以再送一次
+                redis_client.delete(f"media_workflow:{entry['message_id']}")
+                raise
+            started += 1
+    incr_metric('webhook_batched_media_events', started)
+    logging.getLogger('celery').info("[LINE] Started %d/%d media workflows from one webhook batch", started, len(entries))
+    return started
+
+def coalesce_key(source_id, window_id):
+    return f"coalesce:{source_id}:{window_id}"
+
+def coalesce_group_upload(source_type, source_id, file_entry):
+    """把檔案加入來源目前時間窗口的合併清單，窗口內第一個檔案負責排程 flush_upload_batch
+
+    參數:
+        file_entry (dict): {'spool_key', 'dist_name', 'size'}
+
+    若 flush 已執行過（檔案在窗口結束時才下載完成），RPUSH 會建立新的清單並重新排程。
+    """
+    now = time.time()
+    window_id = int(now // UPLOAD_COALESCE_WINDOW)
+    key = coalesce_key(source_id, window_id)
+    countdown = (window_id + 1) * UPLOAD_COALESCE_WINDOW - now + UPLOAD_COALESCE_GRACE
+
+    pipe = redis_client.pipeline()
+    pipe.rpush(key, json.dumps(file_entry))
+    pipe.expire(key, int(countdown) + 3600)
+    length, _ = pipe.execute()
+
+    if length == 1:
+        flush_upload_batch.apply_async((source_type, source_id, window_id), countdown=countdown)
+    logging.getLogger('celery').info("[TASK] Coalesced %s into %s (%d files)", file_entry['dist_name'], key, length)
+    return "COALESCED"
+
+@celery.task(acks_late=True)
+def flush_upload_batch(source_type, source_id, window_id):
+    """取出一個時間窗口內合併的檔案，為每位綁定使用者建立批次上傳任務
+
+    每個暫存檔的參照數為包含它的批次數，最後一個結束的上傳任務刪除檔案。
+    """
+    key = coalesce_key(source_id, window_id)
+    pipe = redis_client.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    entries, _ = pipe.execute()
+    files = [json.loads(entry) for entry in entries]
+    if not files:
+        return "EMPTY"
+    spool_keys = [entry['spool_key'] for entry in files]
+    incr_metric('upload_coalesced_files', len(files))
+
+    bound_users = get_group_bound_users(source_id)
+
+    # 跳過 Google 授權已失效的使用者，每位使用者只保留一筆彙總的略過日誌
+    skipped_users = get_open_auth_breakers(bound_users)
+    for user_id in skipped_users:
+        for entry in files:
+            record_auth_breaker_skip(user_id, entry['dist_name'], source_type, source_id)
+    bound_users = [user_id for user_id in bound_users if user_id not in skipped_users]
+
+    # 每位使用者只上傳放得下的檔案，其餘記錄為空間不足
+    free_bytes = get_drive_free_bytes(bound_users)
+    batches = []
+    refs = {spool_key: 0 for spool_key in spool_keys}
+    for user_id in bound_users:
+        user_files = fit_files_to_drive_quota(user_id, files, free_bytes.get(user_id), source_type, source_id)
+        for entry in user_files:
+            refs[entry['spool_key']] += 1
+        for i in range(0, len(user_files), UPLOAD_COALESCE_MAX_FILES):
+            batches.append((user_id, user_files[i:i + UPLOAD_COALESCE_MAX_FILES]))
+
+    # 沒有任何使用者需要的檔案直接刪除，其餘先設定參照數再分派
+    spool = get_spool_backend()
+    for spool_key, count in refs.items():
+        if count:
+            set_spool_refs(spool_key, count)
+        else:
+            spool.delete(spool_key)
+
+    for user_id, batch in batches:
+        upload_batch_to_drive_task.apply_async(
+            (batch, source_type, source_id, user_id),
+            queue=get_upload_queue(user_id, UPLOAD_SIZE_CLASSES[0]['QUEUE'])
+        )
+    logging.getLogger('celery').info("[TASK] Flushing %s: %d files, %d batch tasks", key, len(files), len(batches))
+    return "OK"
+
+@celery.task(acks_late=True)
+def clean_old_upload_logs(days=UPLOAD_LOG_RETENTION_DAYS):
+    """清理超過指定天數的上傳日誌（upload_stats_daily 保留 UPLOAD_STATS_RETENTION_DAYS 天）
+
+    有設定 UPLOAD_LOG_ARCHIVE 時先匯出到封存區再刪除。每批最多 BATCH_SIZE 筆，
+    每批各自 commit，避免一次刪除大量資料長時間鎖住上傳流程寫入的表格。
+    """
+    logger = logging.getLogger('celery')
+    batch_size = (UPLOAD_LOG_ARCHIVE or {}).get('BATCH_SIZE', 5000)
+    archived = deleted = 0
     conn = get_db_connection()
     try:
+        while True:
+            with conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                if UPLOAD_LOG_ARCHIVE:
+                    cursor.execute("""
+                        SELECT * FROM upload_logs
+                        WHERE upload_time < NOW() - INTERVAL %s DAY
+                        ORDER BY id
+                        LIMIT %s
+                    """, (days, batch_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    # 先寫入封存檔再刪除；中斷時可能重複匯出，查詢時以 id 去除重複
+                    by_day = {}
+                    for row in rows:
+                        by_day.setdefault(row['upload_time'].date(), []).append(row)
+                    for day, day_rows in by_day.items():
+                        key = write_archive_part(day, day_rows)
+                        logger.info("[ARCHIVE] Exported %d upload logs to %s", len(day_rows), key)
+                    ids = [row['id'] for row in rows]
+                    cursor.execute('DELETE FROM upload_logs WHERE id IN %s', (ids,))
+                    archived += len(rows)
+                    batch_count = len(rows)
+                else:
+                    cursor.execute('DELETE FROM upload_logs WHERE upload_time < NOW() - INTERVAL %s DAY LIMIT %s',
+                                   (days, batch_size))
+                    batch_count = cursor.rowcount
+            conn.commit()
+            deleted += batch_count
+            if batch_count < batch_size:
+                break
+
         with conn.cursor() as cursor:
-            cursor.execute('DELETE FROM upload_logs WHERE upload_time < NOW() - INTERVAL %s DAY', (days,))
+            cursor.execute('DELETE FROM upload_stats_daily WHERE day < CURDATE() - INTERVAL %s DAY',
+                           (UPLOAD_STATS_RETENTION_DAYS,))
         conn.commit()
     finally:
         conn.close()
+    if archived:
+        incr_metric('upload_logs_archived', archived)
+    logger.info("[CLEANUP] Removed %d upload logs older than %d days (%d archived)", deleted, days, archived)
+    return deleted
 
-@celery.task
+@celery.task(acks_late=True)
 def clean_tmp_logs(minutes=30):
     """清理暫存日誌檔案"""
     now = time.time()
@@ -641,17 +2870,150 @@ def clean_tmp_logs(minutes=30):
             if file_mtime < cutoff:
                 os.remove(file_path)
                 print(f"Deleted {file_path}")
-    
-@celery.task
-def showlog_task(reply_token, user_id):
+
+def get_retry_eligible_files(hours):
+    """取得在保留期限內上傳失敗、仍可用 !retryupload 重試的檔名集合
+
+    參數:
+        hours (int): 保留期限（小時）
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT file_name
+                FROM upload_logs
+                WHERE upload_time > DATE_SUB(NOW(), INTERVAL %s HOUR)
+                  AND status NOT LIKE 'success'
+                  AND status NOT LIKE '重試成功'
+            """, (hours,))
+            return {row[0] for row in cursor.fetchall()}
+    finally:
+        conn.close()
+
+def mark_evicted_uploads(file_name):
+    """將暫存檔已被清除的失敗上傳記錄標記為 evicted，避免之後重試時找不到檔案"""
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute('SELECT file_name, upload_time, source_type, source_name, status FROM upload_logs WHERE user_id = %s ORDER BY upload_time DESC', (user_id,))
+            cursor.execute("""
+                SELECT id
+                FROM upload_logs
+                WHERE file_name = %s
+                  AND status NOT LIKE 'success'
+                  AND status NOT LIKE '重試成功'
+            """, (file_name,))
+            log_ids = [row[0] for row in cursor.fetchall()]
+            update_upload_status(
+                cursor, log_ids, f"evicted (清除於 {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')})"
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+@celery.task(acks_late=True)
+def clean_spool(max_bytes=SPOOL_MAX_BYTES, retention_hours=SPOOL_RETENTION_HOURS):
+    """依容量上限與保留期限清理暫存區
+
+    清除順序:
+    1. 處理中（仍有上傳任務持有參照，或建立後 SPOOL_INFLIGHT_GRACE_MINUTES 分鐘內）的檔案一律保留
+    2. 已不需重試且超過保留期限的檔案直接清除
+    3. 若仍超過容量上限，依最後使用時間由舊到新清除不需重試的檔案
+    4. 最後才清除仍可重試的檔案，並記錄警告
+
+    參數:
+        max_bytes (int): 暫存區容量上限（位元組）
+        retention_hours (int): 失敗檔案保留供重試的時間（小時）
+    """
+    logger = logging.getLogger('celery')
+    now = time.time()
+    grace_cutoff = now - SPOOL_INFLIGHT_GRACE_MINUTES * 60
+    retention_cutoff = now - retention_hours * 3600
+
+    spool = get_spool_backend()
+    entries = spool.list()
+    total_bytes = sum(size for _, size, _ in entries)
+    retry_eligible = get_retry_eligible_files(retention_hours)
+
+    # 仍有參照計數的檔案還有上傳任務在排隊或延後重試中，不論存放多久都保留
+    candidates = [entry for entry in entries if entry[2] < grace_cutoff]
+    pipe = redis_client.pipeline()
+    for filename, _, _ in candidates:
+        pipe.exists(spool_refs_key(filename))
+    in_flight = pipe.execute() if candidates else []
+    candidates = [entry for entry, referenced in zip(candidates, in_flight) if not referenced]
+
+    # 不需重試的排前面，其次依最後使用時間由舊到新
+    candidates.sort(key=lambda entry: (entry[0] in retry_eligible, entry[2]))
+
+    evicted_files = 0
+    evicted_bytes = 0
+    for filename, size, last_used in candidates:
+        retry_needed = filename in retry_eligible
+        expired = not retry_needed and last_used < retention_cutoff
+        if not expired and total_bytes <= max_bytes:
+            break
+        if retry_needed:
+            logger.warning("[SPOOL] Over budget, evicting retry-eligible file: %s", filename)
+
+        try:
+            spool.delete(filename)
+        except Exception as e:
+            logger.error("[SPOOL] Failed to evict %s: %s", filename, str(e))
+            continue
+
+        total_bytes -= size
+        evicted_files += 1
+        evicted_bytes += size
+        mark_evicted_uploads(filename)
+        logger.info("[SPOOL] Evicted %s (%d bytes, expired=%s)", filename, size, expired)
+
+    if total_bytes > max_bytes:
+        logger.warning("[SPOOL] Spool still over budget: %d / %d bytes", total_bytes, max_bytes)
+
+    set_metric('spool_bytes', total_bytes)
+    set_metric('spool_files', len(entries) - evicted_files)
+    set_metric('spool_retry_eligible_files', len(retry_eligible))
+    set_metric('spool_in_flight_files', sum(1 for referenced in in_flight if referenced))
+    incr_metric('spool_evicted_files', evicted_files)
+    incr_metric('spool_evicted_bytes', evicted_bytes)
+    logger.info("[SPOOL] Cleanup done: evicted=%d files (%d bytes), remaining=%d bytes",
+                evicted_files, evicted_bytes, total_bytes)
+    return evicted_files
+
+# !showlog 詳細列表最多列出的筆數（統計摘要讀 upload_stats_daily，不受此限制）
+SHOWLOG_MAX_ENTRIES = 100
+
+@celery.task
+def showlog_task(reply_token, user_id, reply_deadline=None):
+    """回覆 !showlog：上傳統計摘要讀取每日統計表，原始日誌只用於最近幾筆的詳細列表"""
+    stats = get_upload_stats(user_id, UPLOAD_LOG_RETENTION_DAYS)
+    conn = get_read_connection(user_id)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT file_name, upload_time, source_type, source_name, status FROM upload_logs '
+                'WHERE user_id = %s ORDER BY upload_time DESC LIMIT %s',
+                (user_id, SHOWLOG_MAX_ENTRIES)
+            )
             logs = cursor.fetchall()
             
-            if logs:
-                full_logs = []
+            if logs or stats:
+                count_by_outcome = {}      # 依結果統計
+                count_by_source_type = {}  # 依來源類型統計
+                for source_type, outcome, count in stats:
+                    count_by_outcome[outcome] = count_by_outcome.get(outcome, 0) + count
+                    count_by_source_type[source_type] = count_by_source_type.get(source_type, 0) + count
+                succeeded = sum(count for outcome, count in count_by_outcome.items() if outcome in UPLOAD_SUCCESS_OUTCOMES)
+                failed = sum(count for outcome, count in count_by_outcome.items() if outcome not in UPLOAD_SUCCESS_OUTCOMES)
+
+                summary = f"近 {UPLOAD_LOG_RETENTION_DAYS} 天：成功 {succeeded} 筆，失敗 {failed} 筆\n"
+                for outcome, count in sorted(count_by_outcome.items(), key=lambda item: -item[1]):
+                    if outcome not in UPLOAD_SUCCESS_OUTCOMES:
+                        summary += f"• {UPLOAD_OUTCOME_LABELS.get(outcome, outcome)}: {count}筆\n"
+                for source_type, count in count_by_source_type.items():
+                    summary += f"• 來源 {source_type}: {count}筆\n"
+                full_logs = [summary + f"\n最近 {len(logs)} 筆紀錄：\n\n"]
                 for log in logs:
                     file_name, upload_time, source_type, source_name, status = log
                     full_logs.append(f"{file_name}\n時間: {upload_time}\n來源: {source_type} ({source_name})\n狀態: {status}\n\n")
@@ -678,20 +3040,97 @@ def showlog_task(reply_token, user_id):
                             ]
                         )
                     )
-                    reply_message(reply_token, [button_template])
+                    send_reply(reply_token, user_id, [button_template], reply_deadline)
                 else:
-                    reply_message(reply_token, [TextMessage(text=full_text)])
+                    send_reply(reply_token, user_id, [TextMessage(text=full_text)], reply_deadline)
 
 
             else:
-                reply_message(reply_token, [TextMessage(text="您尚未上傳任何檔案。")])
+                send_reply(reply_token, user_id, [TextMessage(text="您尚未上傳任何檔案。")], reply_deadline)
+    finally:
+        conn.close()
+
+# !searchlog：關鍵字至少需要的字數（與 MySQL ngram_token_size 預設值相同，較短的關鍵字無法使用全文索引）
+SEARCH_KEYWORD_MIN_LENGTH = 2
+
+# 搜尋結果網頁的連結以 Flask secret key 簽章，連結中不會出現可竄改的使用者 ID
+search_link_serializer = URLSafeTimedSerializer(FLASK_SECRET_KEY, salt='searchlog')
+
+def drive_file_link(file_id):
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+def search_log_url(user_id, keyword, page=1):
+    """產生搜尋結果網頁的簽章連結（SEARCH_LOG_LINK_TTL 後失效）"""
+    query = urllib.parse.urlencode({'token': search_link_serializer.dumps([user_id, keyword]), 'page': page})
+    return f"https://{BASE_URI}/linebot/searchlog?{query}"
+
+def load_search_token(token):
+    """驗證搜尋結果網頁的連結
+
+    回傳:
+        tuple: (user_id, keyword)，連結過期或遭竄改時回傳 None
+    """
+    try:
+        user_id, keyword = search_link_serializer.loads(token, max_age=SEARCH_LOG_LINK_TTL)
+    except (BadSignature, ValueError, TypeError):
+        return None
+    return user_id, keyword
+
+def search_upload_logs(user_id, keyword, page=1, page_size=SEARCH_LOG_PAGE_SIZE):
+    """以全文索引（ft_upload_logs_names）搜尋使用者的上傳紀錄，比對檔名與來源名稱
+
+    參數:
+        user_id (str): LINE 使用者 ID
+        keyword (str): 關鍵字（整段視為一個詞組比對）
+        page (int): 頁數（從 1 開始）
+        page_size (int): 每頁筆數
+
+    回傳:
+        tuple: (紀錄列表, 是否還有下一頁)
+               紀錄為 (file_name, upload_time, source_type, source_name, status, drive_file_id)
+    """
+    phrase = '"' + keyword.replace('"', ' ').strip() + '"'
+    conn = get_read_connection(user_id)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT file_name, upload_time, source_type, source_name, status, drive_file_id
+                FROM upload_logs
+                WHERE user_id = %s
+                  AND MATCH(file_name, source_name) AGAINST (%s IN BOOLEAN MODE)
+                ORDER BY upload_time DESC, id DESC
+                LIMIT %s OFFSET %s
+            """, (user_id, phrase, page_size + 1, (page - 1) * page_size))
+            rows = cursor.fetchall()
     finally:
         conn.close()
+    return rows[:page_size], len(rows) > page_size
+
+@celery.task
+def search_log_task(reply_token, user_id, keyword, reply_deadline=None):
+    """回覆 !searchlog 的第一頁搜尋結果，結果較多時附上搜尋結果網頁的連結"""
+    rows, has_more = search_upload_logs(user_id, keyword)
+    if not rows:
+        reply_text = (f"過去 {UPLOAD_LOG_RETENTION_DAYS} 天內找不到符合「{keyword}」的上傳紀錄。\n"
+                      f"上傳紀錄只保留 {UPLOAD_LOG_RETENTION_DAYS} 天，較早的檔案請直接到 Google Drive 的資料夾中查看。")
+    else:
+        entries = [f"「{keyword}」的搜尋結果（過去 {UPLOAD_LOG_RETENTION_DAYS} 天內）："]
+        for file_name, upload_time, source_type, source_name, status, drive_file_id in rows:
+            entry = f"{file_name}\n時間: {upload_time}\n來源: {source_type} ({source_name})\n狀態: {status}"
+            if drive_file_id:
+                entry += f"\n連結: {drive_file_link(drive_file_id)}"
+            entries.append(entry)
+        reply_text = "\n\n".join(entries)
+        if has_more:
+            reply_text += (f"\n\n查看更多結果（{SEARCH_LOG_LINK_TTL // 60} 分鐘內有效）：\n"
+                           f"{search_log_url(user_id, keyword, 2)}")
+    send_reply(reply_token, user_id, [TextMessage(text=reply_text)], reply_deadline)
 
 @celery.task
-def handle_list_group_task(reply_token, user_id):
+def handle_list_group_task(reply_token, user_id, reply_deadline=None):
     logger = logging.getLogger('celery')
-    conn = get_db_connection()
+    report_version = get_report_version(user_id)
+    conn = get_read_connection(user_id)
     try:
         with conn.cursor() as cursor:
             # 先查詢個人資料夾
@@ -720,7 +3159,10 @@ def handle_list_group_task(reply_token, user_id):
         if not rows:
             logger.info("[LISTGROUP] No folders found for user_id=%s", user_id)
             reply_text = "您尚未建立任何資料夾。"
-            reply_message(reply_token, [TextMessage(text=reply_text)])
+            messages = [TextMessage(text=reply_text)]
+            send_reply(reply_token, user_id, messages, reply_deadline)
+            cache_report(user_id, 'listgroup', messages, report_version)
+            return
         
         columns = []
         
@@ -775,7 +3217,8 @@ def handle_list_group_task(reply_token, user_id):
         )
         logger.info("[LISTGROUP] Sending carousel template with %d columns", len(columns))
 
-        reply_message(reply_token, [template_message])
+        send_reply(reply_token, user_id, [template_message], reply_deadline)
+        cache_report(user_id, 'listgroup', [template_message], report_version)
     except Exception as e:
         logger.error(f"[LISTGROUP] Error processing listgroup command: {str(e)}")
         raise
@@ -783,7 +3226,7 @@ def handle_list_group_task(reply_token, user_id):
         conn.close()
 
 @celery.task
-def handle_update_folder_task(reply_token, user_id):
+def handle_update_folder_task(reply_token, user_id, reply_deadline=None):
     """更新使用者綁定群組的資料夾名稱
     
     此任務會檢查使用者綁定的所有群組資料夾，並確保資料夾名稱與群組名稱一致。
@@ -795,6 +3238,7 @@ def handle_update_folder_task(reply_token, user_id):
     參數:
         reply_token (str): LINE 回覆令牌
         user_id (str): LINE 使用者 ID
+        reply_deadline (float): reply token 的到期時間（epoch 秒）
     """
     logger = logging.getLogger('celery')
     logger.info("[UPDATEFOLDER] 開始檢查使用者 %s 的群組資料夾", user_id)
@@ -803,11 +3247,11 @@ def handle_update_folder_task(reply_token, user_id):
     user_creds = get_user_credentials(user_id)
     if not user_creds:
         logger.error("[UPDATEFOLDER] 無法獲取使用者 %s 的 Google 憑證", user_id)
-        reply_message(reply_token, [TextMessage(text="您尚未綁定 Google 帳號，請先輸入 !bindgoogle")])
+        send_reply(reply_token, user_id, [TextMessage(text="您尚未綁定 Google 帳號，請先輸入 !bindgoogle")], reply_deadline)
         return
     
     # 建立 Drive Service
-    service = build('drive', 'v3', credentials=user_creds)
+    service = build_drive_service(user_creds)
     
     conn = get_db_connection()
     try:
@@ -828,7 +3272,7 @@ def handle_update_folder_task(reply_token, user_id):
             groups = cursor.fetchall()
             
             if not groups:
-                reply_message(reply_token, [TextMessage(text="您尚未綁定任何群組或尚未建立群組資料夾。")])
+                send_reply(reply_token, user_id, [TextMessage(text="您尚未綁定任何群組或尚未建立群組資料夾。")], reply_deadline)
                 return
             
             updated_count = 0        # 已更新的資料夾數量
@@ -844,6 +3288,7 @@ def handle_update_folder_task(reply_token, user_id):
                 try:
                     # 1. 檢查資料夾是否存在與是否有效 - 透過嘗試獲取資料夾元數據
                     try:
+                        acquire_drive_quota(user_id, user_creds.client_id, cost=2)
                         # 嘗試獲取資料夾詳細資訊，包括資料夾名稱、權限等
                         folder_metadata = service.files().get(
                             fileId=folder_id, 
@@ -946,22 +3391,23 @@ def handle_update_folder_task(reply_token, user_id):
             else:
                 reply_text = summary
                 
-            reply_message(reply_token, [TextMessage(text=reply_text)])
+            send_reply(reply_token, user_id, [TextMessage(text=reply_text)], reply_deadline)
             
     except Exception as e:
         logger.error("[UPDATEFOLDER] 更新資料夾時發生錯誤: %s", str(e))
-        reply_message(reply_token, [TextMessage(text="檢查群組資料夾時發生錯誤，請稍後再試。")])
+        send_reply(reply_token, user_id, [TextMessage(text="檢查群組資料夾時發生錯誤，請稍後再試。")], reply_deadline)
     finally:
         conn.close()
 
 @celery.task
-def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
+def retry_failed_uploads_task(reply_token, user_id, hours_ago=24, reply_deadline=None):
     """重試指定使用者在指定時間內失敗的上傳
     
     參數:
         reply_token (str): LINE 回覆令牌
         user_id (str): LINE 使用者 ID
         hours_ago (int): 檢索多少小時前的失敗記錄
+        reply_deadline (float): reply token 的到期時間（epoch 秒）
     """
     logger = logging.getLogger('celery')
     logger.info(f"[RETRY] 開始處理使用者 {user_id} 的失敗上傳（{hours_ago}小時內）...")
@@ -976,6 +3422,7 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
     }
     
     # 從資料庫獲取該使用者的失敗記錄
+    spool = get_spool_backend()
     conn = get_db_connection()
     failed_uploads = []
     try:
@@ -988,6 +3435,7 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
                   AND upload_time > DATE_SUB(NOW(), INTERVAL %s HOUR)
                   AND status NOT LIKE 'success'
                   AND status NOT LIKE '重試成功'
+                  AND status NOT LIKE 'evicted%%'
                 ORDER BY upload_time DESC
             """, (user_id, hours_ago))
             failed_uploads = cursor.fetchall()
@@ -999,28 +3447,27 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
             record_id, file_name, source_type, source_id, status = record
             logger.info(f"[RETRY] 處理記錄 ID={record_id}, 檔案={file_name}")
             
-            # 檢查檔案是否存在
-            dist_path = os.path.join(STATIC_TMP_PATH, file_name)
-            if not os.path.exists(dist_path):
-                logger.warning(f"[RETRY] 檔案不存在: {dist_path}")
+            # 檢查檔案是否存在於暫存區
+            spool_key = os.path.basename(file_name)
+            if not spool.exists(spool_key):
+                logger.warning(f"[RETRY] 檔案不存在: {spool_key}")
                 results["檔案不存在"] += 1
                 
                 # 嘗試查找只有基本名稱匹配的檔案
-                base_name = os.path.basename(file_name)
                 found = False
-                for tmp_file in os.listdir(STATIC_TMP_PATH):
-                    if base_name in tmp_file:
-                        dist_path = os.path.join(STATIC_TMP_PATH, tmp_file)
-                        logger.info(f"[RETRY] 找到可能匹配的檔案: {tmp_file}")
+                for tmp_key, _, _ in spool.list():
+                    if spool_key in tmp_key:
+                        spool_key = tmp_key
+                        logger.info(f"[RETRY] 找到可能匹配的檔案: {tmp_key}")
                         found = True
                         break
                 
                 if not found:
                     # 更新日誌狀態
                     with conn.cursor() as cursor:
-                        cursor.execute(
-                            "UPDATE upload_logs SET status = %s WHERE id = %s",
-                            (f"檔案不存在 (重試於 {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')})", record_id)
+                        update_upload_status(
+                            cursor, [record_id],
+                            f"檔案不存在 (重試於 {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')})"
                         )
                     conn.commit()
                     continue
@@ -1031,14 +3478,11 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
                 
                 
                 # 執行上傳任務
-                upload_file_to_drive_task(dist_path, file_name, source_type, source_id, user_id)
+                file_id = upload_file_to_drive_task(spool_key, file_name, source_type, source_id, user_id, release_ref=False)
                 
                 # 更新日誌狀態
                 with conn.cursor() as cursor:
-                    cursor.execute(
-                        "UPDATE upload_logs SET status = %s WHERE id = %s",
-                        ("重試成功", record_id)
-                    )
+                    update_upload_status(cursor, [record_id], "重試成功", drive_file_id=file_id)
                 conn.commit()
                 results["重試成功"] += 1
                 logger.info(f"[RETRY] 重試上傳成功: {file_name}")
@@ -1049,10 +3493,7 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
                 
                 # 更新日誌狀態
                 with conn.cursor() as cursor:
-                    cursor.execute(
-                        "UPDATE upload_logs SET status = %s WHERE id = %s",
-                        ("重試失敗", record_id)
-                    )
+                    update_upload_status(cursor, [record_id], "重試失敗")
                 conn.commit()
     
     except Exception as e:
@@ -1072,22 +3513,23 @@ def retry_failed_uploads_task(reply_token, user_id, hours_ago=24):
 
     
     if reply_token:
-        reply_message(reply_token, [TextMessage(text=reply_text)])
+        send_reply(reply_token, user_id, [TextMessage(text=reply_text)], reply_deadline)
     return results
 
 @celery.task
-def list_failed_uploads_task(reply_token, user_id, hours_ago=24):
+def list_failed_uploads_task(reply_token, user_id, hours_ago=24, reply_deadline=None):
     """列出指定使用者在指定時間內的失敗上傳記錄
     
     參數:
         reply_token (str): LINE 回覆令牌
         user_id (str): LINE 使用者 ID
         hours_ago (int): 檢索多少小時前的失敗記錄
+        reply_deadline (float): reply token 的到期時間（epoch 秒）
     """
     logger = logging.getLogger('celery')
     logger.info(f"[LIST_FAILED] 開始查詢使用者 {user_id} 的失敗上傳（{hours_ago}小時內）...")
     
-    conn = get_db_connection()
+    conn = get_read_connection(user_id)
     try:
         with conn.cursor() as cursor:
             logger.info("[LIST_FAILED] 查詢使用者的失敗上傳記錄")
@@ -1109,35 +3551,22 @@ def list_failed_uploads_task(reply_token, user_id, hours_ago=24):
             # 準備回覆訊息
             if failed_logs is None or len(failed_logs) == 0:
                 reply_text = f"過去 {hours_ago} 小時內沒有失敗的上傳紀錄。"
-                reply_message(reply_token, [TextMessage(text=reply_text)])
+                send_reply(reply_token, user_id, [TextMessage(text=reply_text)], reply_deadline)
                 logger.info("[LIST_FAILED] 無失敗記錄，返回空訊息")
                 return
             
-            # 計算統計資訊
+            # 統計資訊與詳細列表使用同一批記錄，確保時間範圍一致
+            # （查詢範圍以小時計，無法由每日統計表取得；這裡只計算已取出的記錄，不另外掃描）
             count_by_source_type = {}  # 依來源類型統計
-            count_by_status = {}       # 依狀態統計
+            count_by_status = {}       # 依錯誤類型統計
+            for _, _, _, source_type, _, status in failed_logs:
+                count_by_source_type[source_type] = count_by_source_type.get(source_type, 0) + 1
+                error_type = UPLOAD_OUTCOME_LABELS[classify_upload_status(status)]
+                count_by_status[error_type] = count_by_status.get(error_type, 0) + 1
             
             # 準備詳細列表
             logs_text = []
             for i, (record_id, file_name, upload_time, source_type, source_name, status) in enumerate(failed_logs, 1):
-                # 更新統計
-                count_by_source_type[source_type] = count_by_source_type.get(source_type, 0) + 1
-                
-                # 統計各種錯誤類型
-                error_type = "其他錯誤"
-                if "connection_error" in status:
-                    error_type = "連線錯誤"
-                elif "timeout" in status:
-                    error_type = "超時錯誤"
-                elif "user_credentials_error" in status:
-                    error_type = "認證錯誤"
-                elif "http_error" in status:
-                    error_type = "API錯誤"
-                elif "檔案不存在" in status:
-                    error_type = "檔案不存在"
-                
-                count_by_status[error_type] = count_by_status.get(error_type, 0) + 1
-                
                 # 組合詳細記錄
                 logs_text.append(
                     f"{i}. 檔案：{file_name}\n"
@@ -1191,22 +3620,23 @@ def list_failed_uploads_task(reply_token, user_id, hours_ago=24):
                         ]
                     )
                 )
-                reply_message(reply_token, [button_template])
+                send_reply(reply_token, user_id, [button_template], reply_deadline)
             else:
                 # 直接回覆完整訊息
-                reply_message(reply_token, [TextMessage(text=full_text)])
+                send_reply(reply_token, user_id, [TextMessage(text=full_text)], reply_deadline)
                 
     except Exception as e:
         logger.error(f"[LIST_FAILED] 處理失敗上傳記錄時發生錯誤: {str(e)}")
-        reply_message(reply_token, [TextMessage(text="查詢失敗上傳記錄時發生錯誤，請稍後再試。")])
+        send_reply(reply_token, user_id, [TextMessage(text="查詢失敗上傳記錄時發生錯誤，請稍後再試。")], reply_deadline)
     finally:
         conn.close()
 
 @celery.task
-def handle_show_complete_group_task(reply_token, user_id):
+def handle_show_complete_group_task(reply_token, user_id, reply_deadline=None):
     logger = logging.getLogger('celery')
             
-    conn = get_db_connection()
+    report_version = get_report_version(user_id)
+    conn = get_read_connection(user_id)
     try:
         with conn.cursor() as cursor:
             # 查詢使用者綁定的所有群組
@@ -1245,10 +3675,12 @@ def handle_show_complete_group_task(reply_token, user_id):
 
             logger.info("[SHOWCOMPLETEGROUP] 找到 %d 個群組", len(groups))
             
-        reply_message(reply_token, [TextMessage(text=reply_text)])
+        messages = [TextMessage(text=reply_text)]
+        send_reply(reply_token, user_id, messages, reply_deadline)
+        cache_report(user_id, 'showcompletegroup', messages, report_version)
     except Exception as e:
         logger.error("[SHOWCOMPLETEGROUP] 處理群組列表時發生錯誤: %s", str(e))
         reply_text = "取得群組列表時發生錯誤，請稍後再試。"
-        reply_message(reply_token, [TextMessage(text=reply_text)])
+        send_reply(reply_token, user_id, [TextMessage(text=reply_text)], reply_deadline)
     finally:
         conn.close()
@@ -0,0 +1,82 @@
+# worker_launcher.py
+#
+# 依 CELERY_WORKER_PROFILES 啟動 / 停止各佇列的 Celery worker
+#
+# 用法:
+#   python worker_launcher.py start                 # 啟動所有設定檔
+#   python worker_launcher.py start upload ingest   # 只啟動指定設定檔
+#   python worker_launcher.py stop|restart [設定檔...]
+#   python worker_launcher.py show [設定檔...]      # 只印出指令，不執行
+
+# === 基本設定 ===
+from settings import *
+
+import os
+import sys
+import shlex
+import argparse
+import subprocess
+
+
+def get_worker_profiles():
+    """CELERY_WORKER_PROFILES 加上 UPLOAD_SHARDS 個上傳分片 worker"""
+    profiles = dict(CELERY_WORKER_PROFILES)
+    for shard in range(UPLOAD_SHARDS):
+        profiles[f'upload-shard-{shard}'] = {
+            'queues': [f'upload-shard-{shard}'],
+            'concurrency': UPLOAD_SHARD_CONCURRENCY,
+            'prefetch_multiplier': 1,
+        }
+    return profiles
+
+
+def build_command(action, name, profile):
+    """產生單一設定檔的 celery multi 指令
+
+    參數:
+        action (str): start / stop / restart
+        name (str): 設定檔名稱（同時作為 worker 節點名稱）
+        profile (dict): CELERY_WORKER_PROFILES 中的設定
+    """
+    command = [
+        sys.executable, '-m', 'celery', 'multi', action, name,
+        '-A', 'worker_app.celery',
+        f"--pidfile={os.path.join(CELERY_WORKER_RUN_PATH, '%n.pid')}",
+        f"--logfile={os.path.join(CELERY_WORKER_RUN_PATH, '%n%I.log')}",
+    ]
+    if action != 'stop':
+        command += [
+            '-l', 'info',
+            '-Q', ','.join(profile['queues']),
+            '-c', str(profile['concurrency']),
+            f"--prefetch-multiplier={profile['prefetch_multiplier']}",
+        ]
+    return command
+
+
+def main():
+    parser = argparse.ArgumentParser(description="啟動 / 停止各佇列的 Celery worker")
+    parser.add_argument('action', choices=['start', 'stop', 'restart', 'show'])
+    parser.add_argument('profiles', nargs='*', help="要操作的設定檔（預設全部）")
+    args = parser.parse_args()
+
+    profiles = get_worker_profiles()
+    names = args.profiles or list(profiles)
+    unknown = [name for name in names if name not in profiles]
+    if unknown:
+        parser.error(f"未知的設定檔: {', '.join(unknown)}")
+
+    os.makedirs(CELERY_WORKER_RUN_PATH, exist_ok=True)
+    exit_code = 0
+    for name in names:
+        action = 'start' if args.action == 'show' else args.action
+        command = build_command(action, name, profiles[name])
+        if args.action == 'show':
+            print(shlex.join(command))
+            continue
+        exit_code = subprocess.call(command, cwd=BASE_DIR) or exit_code
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())